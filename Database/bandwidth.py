@@ -0,0 +1,131 @@
+import asyncio
+import functools
+import time
+from collections import deque
+from config import GLOBAL_DOWNLOAD_MBPS, GLOBAL_UPLOAD_MBPS, PLAN_BANDWIDTH, BANDWIDTH_BURST_SECONDS
+from logger import logger # Import logger
+
+# Bandwidth governor: hierarchical token buckets (global -> plan -> user) for one transfer direction.
+# Transfer loops call a limiter before every chunk. The chunk is charged to all three buckets at
+# once and the caller sleeps for the longest debt, so the slowest level decides the pace. Buckets
+# may go into debt, which keeps concurrent workers of a parallel transfer queued fairly behind
+# each other instead of all waking at the same moment.
+# Rates are in MB/s from config.py (0 = unlimited); unlimited buckets only measure throughput.
+
+MB = 1024 * 1024
+RATE_WINDOW = 10 # Seconds of history behind the live rates in /stats
+IDLE_USER_SECONDS = 60 # Per-user buckets unused for this long are dropped
+
+
+class TokenBucket:
+    def __init__(self, mbps: float, burst_seconds: float):
+        self.rate = max(0.0, mbps) * MB # Bytes per second, 0 = unlimited
+        self.capacity = self.rate * max(burst_seconds, 0.1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.history = deque() # (whole second, bytes) for the live rate
+
+    def reserve(self, nbytes: int, now: float):
+        """Charges `nbytes` and returns how many seconds the caller must wait before sending them."""
+        self._record(nbytes, now)
+        if not self.rate:
+            self.updated = now
+            return 0.0
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= nbytes
+        return max(0.0, -self.tokens / self.rate)
+
+    def _record(self, nbytes: int, now: float):
+        second = int(now)
+        if self.history and self.history[-1][0] == second:
+            self.history[-1] = (second, self.history[-1][1] + nbytes)
+        else:
+            self.history.append((second, nbytes))
+        while self.history and self.history[0][0] <= second - RATE_WINDOW:
+            self.history.popleft()
+
+    def current_rate(self, now: float):
+        """Average bytes/second charged over the last RATE_WINDOW seconds."""
+        return sum(nbytes for second, nbytes in self.history if second > now - RATE_WINDOW) / RATE_WINDOW
+
+    def stats(self, now: float):
+        rate = self.current_rate(now)
+        return {
+            "rate": rate,
+            "limit": self.rate,
+            "utilization": (rate / self.rate) if self.rate else None,
+        }
+
+
+class BandwidthGovernor:
+    def __init__(self, direction: str, global_mbps: float, plan_limits: dict, burst_seconds: float):
+        self.direction = direction
+        self.plan_limits = plan_limits
+        self.burst_seconds = burst_seconds
+        self.global_bucket = TokenBucket(global_mbps, burst_seconds)
+        self.plan_buckets = {} # plan -> TokenBucket
+        self.user_buckets = {} # user id -> (plan, TokenBucket)
+        self._last_prune = time.monotonic()
+        # Metrics
+        self.throttled_seconds = 0.0
+        self.throttled_chunks = 0
+
+    def _limits(self, plan: str):
+        return self.plan_limits.get(plan, self.plan_limits.get("free", {}))
+
+    def _plan_bucket(self, plan: str):
+        if plan not in self.plan_buckets:
+            self.plan_buckets[plan] = TokenBucket(self._limits(plan).get("plan_mbps", 0), self.burst_seconds)
+        return self.plan_buckets[plan]
+
+    def _user_bucket(self, user_id: int, plan: str):
+        entry = self.user_buckets.get(user_id)
+        if entry is None or entry[0] != plan: # New user, or their plan changed
+            entry = (plan, TokenBucket(self._limits(plan).get("user_mbps", 0), self.burst_seconds))
+            self.user_buckets[user_id] = entry
+        return entry[1]
+
+    async def acquire(self, user_id: int, plan: str, nbytes: int):
+        """Waits until `nbytes` of this user's transfer fit all three buckets."""
+        now = time.monotonic()
+        if now - self._last_prune > IDLE_USER_SECONDS:
+            self._drop_idle_users(now)
+        buckets = (self.global_bucket, self._plan_bucket(plan), self._user_bucket(user_id, plan))
+        delay = max(bucket.reserve(nbytes, now) for bucket in buckets)
+        if delay > 0:
+            self.throttled_chunks += 1
+            self.throttled_seconds += delay
+            await asyncio.sleep(delay)
+
+    def limiter(self, user_id: int, plan: str):
+        """A `throttle(nbytes)` coroutine function for one job's transfer loops."""
+        return functools.partial(self.acquire, user_id, plan)
+
+    def _drop_idle_users(self, now: float):
+        self._last_prune = now
+        idle = [user_id for user_id, (_, bucket) in self.user_buckets.items() if now - bucket.updated > IDLE_USER_SECONDS and not bucket.current_rate(now)]
+        for user_id in idle:
+            del self.user_buckets[user_id]
+        if idle:
+            logger.debug(f"Bandwidth ({self.direction}): Dropped {len(idle)} idle user buckets.")
+
+    def stats(self):
+        now = time.monotonic()
+        self._drop_idle_users(now)
+        plans = {}
+        for plan, bucket in self.plan_buckets.items():
+            plans[plan] = bucket.stats(now)
+            plans[plan]["active_users"] = sum(
+                1 for user_plan, user_bucket in self.user_buckets.values() if user_plan == plan and user_bucket.current_rate(now)
+            )
+        return {
+            "global": self.global_bucket.stats(now),
+            "plans": plans,
+            "throttled_chunks": self.throttled_chunks,
+            "throttled_seconds": self.throttled_seconds,
+        }
+
+
+download_governor = BandwidthGovernor("download", GLOBAL_DOWNLOAD_MBPS, PLAN_BANDWIDTH, BANDWIDTH_BURST_SECONDS)
+upload_governor = BandwidthGovernor("upload", GLOBAL_UPLOAD_MBPS, PLAN_BANDWIDTH, BANDWIDTH_BURST_SECONDS)
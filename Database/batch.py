@@ -0,0 +1,154 @@
+import asyncio
+import os
+import re
+import string
+import time
+from pyrogram import Client
+from pyrogram.types import Message
+from database import db
+from pipeline import submit_rename
+from logger import logger # Import logger
+
+# Batch mode: many files renamed with one name template.
+# Every file becomes a normal rename job in the global scheduler, so the batch runs as a pipeline
+# limited by the user's `parallel_processes`. Instead of one status message per file, each job
+# reports into a `BatchItemStatus` and `BatchProgress` renders all of them into a single message.
+
+TEMPLATE_FIELDS = ("n", "orig_name", "orig_stem", "ext")
+MAX_SPEC_DIGITS = 3 # Widths/precisions in format specs stay below 1000, so a template cannot allocate huge names
+_SPEC_NUMBER = re.compile(r"\d+")
+TEMPLATE_HELP = (
+    "`{n}` - position in the batch (`{n:02d}` for 01, 02, ...)\n"
+    "`{orig_name}` - original file name\n"
+    "`{orig_stem}` - original name without extension\n"
+    "`{ext}` - original extension, including the dot"
+)
+
+
+def validate_template(template: str):
+    """Raises ValueError with a user-facing message if `template` is not a usable name template."""
+    try:
+        fields = [field for _, field, _, _ in string.Formatter().parse(template) if field is not None]
+    except ValueError as e:
+        raise ValueError(f"The template is malformed: {e}")
+    for field in fields:
+        if field not in TEMPLATE_FIELDS:
+            raise ValueError(f"Unknown placeholder `{{{field}}}`.")
+    for _, field, spec, _ in string.Formatter().parse(template):
+        if not spec:
+            continue
+        if "{" in spec or "}" in spec:
+            raise ValueError(f"Nested placeholders are not allowed in `{{{field}:{spec}}}`.")
+        if any(len(number) > MAX_SPEC_DIGITS for number in _SPEC_NUMBER.findall(spec)):
+            raise ValueError(f"Widths in `{{{field}:{spec}}}` are limited to {MAX_SPEC_DIGITS} digits.")
+    render_name(template, 1, "sample.mkv") # Catches bad format specs such as {orig_stem:d}
+
+
+def render_name(template: str, n: int, original_name: str):
+    stem, ext = os.path.splitext(original_name)
+    return template.format(n=n, orig_name=original_name, orig_stem=stem, ext=ext).strip()
+
+
+class BatchItemStatus:
+    """Stands in for a per-file status message: the pipeline edits it, the batch message shows it."""
+
+    def __init__(self, batch, index: int):
+        self.batch = batch
+        self.index = index
+
+    async def edit_text(self, text: str, **kwargs):
+        self.batch.update(self.index, text)
+        return self
+
+
+class BatchProgress:
+    """One aggregated, rate-limited status message for a whole batch."""
+
+    EDIT_INTERVAL = 4 # Seconds between edits of the batch message
+
+    def __init__(self, message: Message, names: list):
+        self.message = message
+        self.names = names
+        self.lines = ["Waiting..."] * len(names)
+        self.results = [None] * len(names) # True sent / False failed / None pending
+        self._last_edit = 0.0
+        self._pending = None
+
+    def item(self, index: int):
+        return BatchItemStatus(self, index)
+
+    def update(self, index: int, text: str):
+        self.lines[index] = self._summarize(text)
+        self._schedule()
+
+    async def finish(self, index: int, completed: bool, text: str = None):
+        self.results[index] = completed
+        if text:
+            self.lines[index] = text
+        else:
+            self.lines[index] = "Done" if completed else self.lines[index]
+        if all(result is not None for result in self.results):
+            await self._flush() # Always show the final state
+        else:
+            self._schedule()
+
+    @staticmethod
+    def _summarize(text: str):
+        """Condenses a pipeline status text (e.g. a ProgressReporter block) into one line."""
+        first_line = next((line for line in text.splitlines() if line.strip()), "")
+        summary = first_line.replace("*", "").strip()
+        percentage = re.search(r"`([\d.]+)%`", text)
+        if percentage:
+            summary += f" {float(percentage.group(1)):.0f}%"
+        return summary[:80]
+
+    def render(self):
+        done = sum(1 for result in self.results if result)
+        failed = sum(1 for result in self.results if result is False)
+        header = f"**Batch:** `{done}/{len(self.names)}` sent"
+        if failed:
+            header += f", `{failed}` failed"
+        lines = [header, ""]
+        for index, (name, line) in enumerate(zip(self.names, self.lines), start=1):
+            mark = {True: "✅", False: "❌", None: "⏳"}[self.results[index - 1]]
+            lines.append(f"{mark} {index}. `{name}` - {line}")
+        return "\n".join(lines)[:4096]
+
+    def _schedule(self):
+        if self._pending is None or self._pending.done():
+            delay = max(0.0, self.EDIT_INTERVAL - (time.monotonic() - self._last_edit))
+            self._pending = asyncio.create_task(self._flush(delay))
+
+    async def _flush(self, delay: float = 0.0):
+        if delay:
+            await asyncio.sleep(delay)
+        self._last_edit = time.monotonic()
+        try:
+            await self.message.edit_text(self.render())
+        except Exception as e:
+            logger.debug(f"Batch: Could not update progress message: {e}")
+
+
+async def run_batch(client: Client, message: Message, user_data: dict, operations: list, template: str):
+    """Renders the new names and submits one rename job per file, reporting into a single message."""
+    user_id = message.from_user.id
+    names = [render_name(template, n, op["original_name"]) or op["original_name"] for n, op in enumerate(operations, start=1)]
+    progress = BatchProgress(await message.reply_text(f"Starting a batch of {len(operations)} files..."), names)
+    logger.info(f"User {user_id}: Starting batch of {len(operations)} files with template '{template}'.")
+
+    for index, (active_op, new_name) in enumerate(zip(operations, names)):
+        reserved_user = await db.reserve_upload(user_id, active_op["file_size"])
+        if not reserved_user:
+            for skipped in range(index, len(operations)):
+                await progress.finish(skipped, False, "Skipped: daily upload limit reached")
+            logger.warning(f"User {user_id}: Batch stopped at file {index + 1}, daily upload limit reached.")
+            break
+
+        async def on_finish(completed, index=index):
+            await progress.finish(index, completed)
+
+        await submit_rename(
+            client, message, reserved_user, active_op, new_name,
+            status_message=progress.item(index), on_finish=on_finish
+        )
+    return progress
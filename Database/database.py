@@ -1,123 +1,454 @@
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument
 from pymongo.errors import ConnectionFailure
-from config import MONGO_DB_URI, DB_NAME, DEFAULT_USER_PLAN
+from collections import OrderedDict
+from config import MONGO_DB_URI, DB_NAME, DEFAULT_USER_PLAN, USER_CACHE_MAX_SIZE, USER_CACHE_TTL, SESSION_BACKEND
+import copy
 import datetime
+import time
+from migrations import SCHEMA_VERSION, run_migrations
 from logger import logger # Import logger
 
+
+# Fields needed to render plan information (/start, /myplan, start menu)
+PLAN_FIELDS = (
+    "current_plan", "daily_upload_limit_gb", "daily_uploaded_gb", "last_upload_date",
+    "parallel_processes", "plan_expiry_date"
+)
+
+
+def _set_path(doc: dict, field_name: str, value):
+    """
+    Applies a MongoDB-style dotted `$set` to a local document.
+    Nested dicts along the path are copied, so snapshots handed out earlier are not mutated.
+    """
+    parts = field_name.split(".")
+    node = doc
+    for part in parts[:-1]:
+        child = node.get(part)
+        child = dict(child) if isinstance(child, dict) else {}
+        node[part] = child
+        node = child
+    node[parts[-1]] = value
+
+
+def _unset_path(doc: dict, field_name: str):
+    """Applies a MongoDB-style dotted `$unset` to a local document, copying nested dicts like `_set_path`."""
+    parts = field_name.split(".")
+    node = doc
+    for part in parts[:-1]:
+        child = node.get(part)
+        if not isinstance(child, dict):
+            return
+        child = dict(child)
+        node[part] = child
+        node = child
+    node.pop(parts[-1], None)
+
+
+def _is_subpath(path: str, parent: str):
+    return path.startswith(parent + ".")
+
+
+class UserUpdate:
+    """
+    Collects several field changes for one user and writes them as a single `$set`/`$unset` update.
+    Use through `Database.user_update`:
+
+        async with db.user_update(user_id) as update:
+            update.set("active_file_operation.custom_thumbnail_id", file_id)
+            update.set("active_file_operation.custom_caption_text", None)
+    """
+
+    def __init__(self, database, user_id: int):
+        self.database = database
+        self.user_id = user_id
+        self._set = {}
+        self._unset = set()
+
+    def _drop_children(self, field_name: str):
+        # Writing a parent field replaces its children, and MongoDB rejects
+        # updates that touch both "a" and "a.b", so pending child writes are dropped.
+        for path in [p for p in self._set if _is_subpath(p, field_name)]:
+            del self._set[path]
+        self._unset = {p for p in self._unset if not _is_subpath(p, field_name)}
+
+    def _pending_parent(self, field_name: str):
+        for path in self._set:
+            if _is_subpath(field_name, path):
+                return path
+        return None
+
+    def _pending_unset_parent(self, field_name: str):
+        for path in self._unset:
+            if _is_subpath(field_name, path):
+                return path
+        return None
+
+    def set(self, field_name: str, value):
+        self._drop_children(field_name)
+        self._unset.discard(field_name)
+        unset_parent = self._pending_unset_parent(field_name)
+        if unset_parent is not None:
+            # Removing the parent and then writing into it leaves a parent holding only the new field
+            self._unset.discard(unset_parent)
+            self._set[unset_parent] = {}
+        parent = self._pending_parent(field_name)
+        if parent is not None:
+            if not isinstance(self._set[parent], dict):
+                raise ValueError(f"Cannot set {field_name}: {parent} is set to a non-document value in the same update.")
+            # Fold the child write into the pending parent value instead of emitting a conflicting path
+            parent_value = dict(self._set[parent])
+            _set_path(parent_value, field_name[len(parent) + 1:], value)
+            self._set[parent] = parent_value
+        else:
+            self._set[field_name] = value
+        return self
+
+    def unset(self, field_name: str):
+        self._drop_children(field_name)
+        self._set.pop(field_name, None)
+        if self._pending_unset_parent(field_name) is not None:
+            return self # Already removed with its parent
+        parent = self._pending_parent(field_name)
+        if parent is not None:
+            if isinstance(self._set[parent], dict):
+                parent_value = dict(self._set[parent])
+                _unset_path(parent_value, field_name[len(parent) + 1:])
+                self._set[parent] = parent_value
+            # A non-document parent value has no fields to remove
+        else:
+            self._unset.add(field_name)
+        return self
+
+    def clear_active_operation(self):
+        return self.set("active_file_operation", None)
+
+    def to_update(self):
+        update = {}
+        if self._set:
+            update["$set"] = dict(self._set)
+        if self._unset:
+            update["$unset"] = {field_name: "" for field_name in self._unset}
+        return update
+
+    async def flush(self):
+        """Sends the pending changes as one update. Returns True if nothing was pending or the write succeeded."""
+        update = self.to_update()
+        if not update:
+            return True
+        pending_set, pending_unset = self._set, self._unset
+        self._set, self._unset = {}, set()
+        return await self.database._apply_update(self.user_id, update, pending_set, pending_unset)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.flush()
+        return False
+
+
+class UserCache:
+    """Bounded LRU cache of user documents with a per-entry TTL."""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict() # user_id -> (expires_at, doc)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, user_id: int, doc: dict):
+        if self.max_size <= 0:
+            return
+        self._entries[user_id] = (time.monotonic() + self.ttl, doc)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def peek(self, user_id: int):
+        """Returns the cached document without touching LRU order or counters (used for write-through)."""
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+        }
+
+
 class Database:
     def __init__(self):
         self.client = None
         self.db = None
         self.users_collection = None
+        self.user_cache = UserCache(USER_CACHE_MAX_SIZE, USER_CACHE_TTL)
         self._connect()
 
     def _connect(self):
-        """Establishes connection to MongoDB."""
+        """Creates the Motor client. The actual connection is verified in `ping`."""
         try:
-            self.client = MongoClient(MONGO_DB_URI)
-            self.client.admin.command('ismaster')
+            # Motor connects lazily and binds to the running event loop on first use,
+            # so creating the client at import time is safe.
+            self.client = AsyncIOMotorClient(MONGO_DB_URI)
             self.db = self.client[DB_NAME]
             self.users_collection = self.db["users"]
-            logger.info("MongoDB connected successfully!")
-        except ConnectionFailure as e:
-            logger.error(f"MongoDB connection failed: {e}")
+        except Exception as e:
+            logger.error(f"An unexpected error occurred while creating the MongoDB client: {e}", exc_info=True)
             self.client = None
             self.db = None
             self.users_collection = None
+
+    async def ping(self):
+        """Checks that MongoDB is reachable. Must be awaited once on the bot's event loop at startup."""
+        if self.client is None:
+            return False
+        try:
+            await self.client.admin.command('ping')
+            logger.info("MongoDB connected successfully!")
+            return True
+        except ConnectionFailure as e:
+            logger.error(f"MongoDB connection failed: {e}")
         except Exception as e:
             logger.error(f"An unexpected error occurred during MongoDB connection: {e}", exc_info=True)
-            self.client = None
-            self.db = None
-            self.users_collection = None
+        self.client = None
+        self.db = None
+        self.users_collection = None
+        return False
 
-    def get_user(self, user_id: int):
-        """Fetches user data from the database. Creates a new entry if user doesn't exist."""
-        if not self.users_collection: 
+    async def migrate(self):
+        """Runs pending schema migrations (see migrations.py) and drops cached documents."""
+        if self.users_collection is None:
+            logger.warning("Attempted to run migrations, but MongoDB connection is not active.")
+            return []
+        applied = await run_migrations(self.users_collection)
+        if applied:
+            self.user_cache = UserCache(USER_CACHE_MAX_SIZE, USER_CACHE_TTL)
+        return applied
+
+    async def get_user(self, user_id: int, fields=None):
+        """
+        Fetches user data, from the in-process cache when possible.
+        Creates a new entry if user doesn't exist.
+        Pass `fields` (an iterable of top-level field names) to read only those fields when
+        the user is not cached; projected reads are not cached.
+        The returned document is shared with the cache and must be treated as read-only;
+        use `update_user_field` to change it.
+        """
+        if self.users_collection is None:
             logger.warning("Attempted to get user, but MongoDB connection is not active.")
             return None
-        
-        user = self.users_collection.find_one({"_id": user_id})
+
+        cached = self.user_cache.get(user_id)
+        if cached is not None:
+            return self._apply_daily_reset(cached)
+
+        if fields is not None:
+            projection = {field: 1 for field in fields}
+            projection["schema_version"] = 1
+            user = await self.users_collection.find_one({"_id": user_id}, projection)
+            if user:
+                if user.get("schema_version", 0) < SCHEMA_VERSION:
+                    for field in fields:
+                        user.setdefault(field, copy.deepcopy(DEFAULT_USER_PLAN.get(field)))
+                return self._apply_daily_reset(user)
+            # Unknown user: fall through to the full read, which creates the document
+
+        user = await self.users_collection.find_one({"_id": user_id})
         if not user:
             # Create a new user with default plan
-            new_user_data = DEFAULT_USER_PLAN.copy()
+            new_user_data = copy.deepcopy(DEFAULT_USER_PLAN) # Defaults contain lists, which must not be shared
             new_user_data["_id"] = user_id
-            self.users_collection.insert_one(new_user_data)
+            new_user_data["schema_version"] = SCHEMA_VERSION
+            await self.users_collection.insert_one(new_user_data)
             logger.info(f"New user {user_id} added to DB.")
+            self.user_cache.put(user_id, new_user_data)
             return new_user_data
-        
-        # --- Migration/Update for existing users to new fields ---
-        # Add any missing fields from DEFAULT_USER_PLAN to existing user documents
-        updated = False
-        for key, default_value in DEFAULT_USER_PLAN.items():
-            if key not in user:
-                user[key] = default_value
-                self.users_collection.update_one({"_id": user_id}, {"$set": {key: default_value}})
-                updated = True
-        if updated:
-            logger.info(f"User {user_id} data updated with new fields.")
-        # --- End Migration ---
-
-        # Check and reset daily upload if new day
-        today = datetime.date.today()
-        if user.get("last_upload_date") and user["last_upload_date"].date() < today:
-            self.users_collection.update_one(
-                {"_id": user_id},
-                {"$set": {"daily_uploaded_gb": 0, "last_upload_date": datetime.datetime.now()}}
-            )
+
+        # Documents are brought up to date in bulk by `migrate` at startup. A document
+        # that slipped through (e.g. written by an older instance) only gets in-memory defaults here.
+        if user.get("schema_version", 0) < SCHEMA_VERSION:
+            for key, default_value in DEFAULT_USER_PLAN.items():
+                user.setdefault(key, copy.deepcopy(default_value))
+
+        self.user_cache.put(user_id, user)
+        return self._apply_daily_reset(user)
+
+    @staticmethod
+    def _apply_daily_reset(user: dict):
+        """
+        Shows a zero daily counter if the last upload was before today.
+        Only the view is reset; the stored counter is reset atomically by `reserve_upload`.
+        """
+        last_upload = user.get("last_upload_date")
+        if last_upload and last_upload.date() < datetime.date.today() and user.get("daily_uploaded_gb"):
             user["daily_uploaded_gb"] = 0
-            user["last_upload_date"] = datetime.datetime.now()
-            logger.info(f"User {user_id} daily upload limit reset.")
-        
         return user
 
-    def update_user_field(self, user_id: int, field_name: str, value):
+    async def update_user_field(self, user_id: int, field_name: str, value):
         """Updates a specific field for a user."""
-        if not self.users_collection: 
+        if self.users_collection is None:
             logger.warning(f"Attempted to update user {user_id} field {field_name}, but MongoDB connection is not active.")
             return False
         try:
-            self.users_collection.update_one(
+            await self.users_collection.update_one(
                 {"_id": user_id},
                 {"$set": {field_name: value}}
             )
+            cached = self.user_cache.peek(user_id)
+            if cached is not None:
+                _set_path(cached, field_name, value) # Write-through
             logger.debug(f"User {user_id} field '{field_name}' updated.")
             return True
         except Exception as e:
+            self.user_cache.invalidate(user_id)
             logger.error(f"Error updating user {user_id} field {field_name}: {e}", exc_info=True)
             return False
 
-    def increment_daily_upload(self, user_id: int, size_bytes: int):
-        """Increments daily uploaded GB for a user."""
-        if not self.users_collection: 
-            logger.warning(f"Attempted to increment daily upload for user {user_id}, but MongoDB connection is not active.")
+    def user_update(self, user_id: int):
+        """Starts a batched update for a user; see `UserUpdate`."""
+        return UserUpdate(self, user_id)
+
+    async def _apply_update(self, user_id: int, update: dict, set_fields: dict, unset_fields):
+        """Runs one combined update for `UserUpdate.flush` and writes it through to the cache."""
+        if self.users_collection is None:
+            logger.warning(f"Attempted to update user {user_id}, but MongoDB connection is not active.")
+            return False
+        try:
+            await self.users_collection.update_one({"_id": user_id}, update)
+            cached = self.user_cache.peek(user_id)
+            if cached is not None:
+                for field_name in unset_fields:
+                    _unset_path(cached, field_name)
+                for field_name, value in set_fields.items():
+                    _set_path(cached, field_name, value)
+            logger.debug(f"User {user_id} fields {sorted(set(set_fields) | set(unset_fields))} updated.")
+            return True
+        except Exception as e:
+            self.user_cache.invalidate(user_id)
+            logger.error(f"Error updating user {user_id} with {update}: {e}", exc_info=True)
+            return False
+
+    async def reserve_upload(self, user_id: int, size_bytes: int):
+        """
+        Atomically reserves `size_bytes` of the user's daily upload quota in one round trip.
+        The daily counter is reset server-side if the last upload was before today.
+        Returns the updated user document, or None if the reservation would exceed the limit.
+        Call `release_upload` with the same size if the job does not complete.
+        """
+        if self.users_collection is None:
+            logger.warning(f"Attempted to reserve upload quota for user {user_id}, but MongoDB connection is not active.")
+            return None
+        gb_requested = (size_bytes or 0) / (1024**3) # Convert bytes to GB
+        now = datetime.datetime.now()
+        today_start = datetime.datetime.combine(now.date(), datetime.time.min)
+        used_today = {
+            "$cond": [
+                {"$lt": ["$last_upload_date", today_start]}, # Missing/null sorts before any date
+                0,
+                "$daily_uploaded_gb"
+            ]
+        }
+        try:
+            user = await self.users_collection.find_one_and_update(
+                {"_id": user_id, "$expr": {"$lte": [{"$add": [used_today, gb_requested]}, "$daily_upload_limit_gb"]}},
+                [{"$set": {"daily_uploaded_gb": {"$add": [used_today, gb_requested]}, "last_upload_date": now}}],
+                return_document=ReturnDocument.AFTER
+            )
+        except Exception as e:
+            self.user_cache.invalidate(user_id)
+            logger.error(f"Error reserving upload quota for user {user_id}: {e}", exc_info=True)
+            return None
+        if user is None:
+            logger.info(f"User {user_id}: Quota reservation of {gb_requested:.2f} GB rejected.")
+            return None
+        self.user_cache.put(user_id, user) # Write-through with the server's view of the counter
+        logger.info(f"User {user_id} reserved {gb_requested:.2f} GB, total: {user['daily_uploaded_gb']:.2f} GB.")
+        return user
+
+    async def release_upload(self, user_id: int, size_bytes: int):
+        """Returns quota taken by `reserve_upload` for a job that failed or was cancelled."""
+        if self.users_collection is None:
+            logger.warning(f"Attempted to release upload quota for user {user_id}, but MongoDB connection is not active.")
             return False
-        gb_uploaded = size_bytes / (1024**3) # Convert bytes to GB
+        gb_released = (size_bytes or 0) / (1024**3)
+        today_start = datetime.datetime.combine(datetime.date.today(), datetime.time.min)
         try:
-            self.users_collection.update_one(
-                {"_id": user_id},
-                {"$inc": {"daily_uploaded_gb": gb_uploaded},
-                 "$set": {"last_upload_date": datetime.datetime.now()}}
+            # A reservation made before midnight was already wiped by the daily reset, so only release same-day ones.
+            user = await self.users_collection.find_one_and_update(
+                {"_id": user_id, "last_upload_date": {"$gte": today_start}},
+                [{"$set": {"daily_uploaded_gb": {"$max": [0, {"$subtract": ["$daily_uploaded_gb", gb_released]}]}}}],
+                return_document=ReturnDocument.AFTER
             )
-            logger.info(f"User {user_id} uploaded {gb_uploaded:.2f} GB, total: {self.get_user(user_id)['daily_uploaded_gb']:.2f} GB.")
-            return True
         except Exception as e:
-            logger.error(f"Error incrementing daily upload for user {user_id}: {e}", exc_info=True)
+            self.user_cache.invalidate(user_id)
+            logger.error(f"Error releasing upload quota for user {user_id}: {e}", exc_info=True)
             return False
-            
-    def set_active_operation(self, user_id: int, file_data: dict):
+        if user is not None:
+            self.user_cache.put(user_id, user)
+            logger.info(f"User {user_id} released {gb_released:.2f} GB, total: {user['daily_uploaded_gb']:.2f} GB.")
+        return True
+
+    async def set_active_operation(self, user_id: int, file_data: dict):
         """Stores the active file operation context for a user."""
         logger.debug(f"Setting active operation for user {user_id}: {file_data.get('original_name')}")
-        return self.update_user_field(user_id, "active_file_operation", file_data)
+        return await self.update_user_field(user_id, "active_file_operation", file_data)
 
-    def get_active_operation(self, user_id: int):
-        """Retrieves the active file operation context for a user."""
-        user = self.get_user(user_id)
-        return user.get("active_file_operation") if user else None
+    async def get_active_operation(self, user_id: int):
+        """
+        Retrieves the active file operation context for a user.
+        With the mongo session backend several instances serve the same user, and another instance may
+        have replaced the operation since this one cached the document, so it is read from MongoDB.
+        """
+        if SESSION_BACKEND != "mongo" or self.users_collection is None:
+            user = await self.get_user(user_id, fields=("active_file_operation",))
+            return user.get("active_file_operation") if user else None
+        user = await self.users_collection.find_one({"_id": user_id}, {"active_file_operation": 1})
+        if user is None:
+            return None
+        active_op = user.get("active_file_operation")
+        cached = self.user_cache.peek(user_id)
+        if cached is not None:
+            _set_path(cached, "active_file_operation", active_op) # Refresh the stale cached copy
+        return active_op
 
-    def clear_active_operation(self, user_id: int):
+    async def clear_active_operation(self, user_id: int):
         """Clears the active file operation context for a user."""
         logger.debug(f"Clearing active operation for user {user_id}.")
-        return self.update_user_field(user_id, "active_file_operation", None)
+        return await self.update_user_field(user_id, "active_file_operation", None)
+
+    async def count_users(self):
+        """Returns the total number of user documents."""
+        if self.users_collection is None:
+            return 0
+        return await self.users_collection.count_documents({})
+
+    def iter_user_ids(self):
+        """Async iterator over all user IDs, streamed from the server in batches."""
+        return self.users_collection.find({}, {"_id": 1})
 
     def close(self):
         """Closes the MongoDB connection."""
@@ -0,0 +1,121 @@
+import datetime
+import hashlib
+from database import db
+from config import DEDUP_ENABLED, DEDUP_TTL_DAYS
+from logger import logger # Import logger
+
+# Content-addressed dedup index for finished renames.
+# Telegram gives every file a stable `file_unique_id`, so a rename of the same file to the same
+# name with the same thumbnail produces the same output. The index maps
+# (file_unique_id, new name, thumbnail fingerprint) to the `file_id` of the message we sent last
+# time, and repeat requests are answered with `send_cached_media` instead of a full transfer.
+# Entries expire DEDUP_TTL_DAYS after they were last used (TTL index on `last_used`).
+
+
+def thumbnail_fingerprint(active_op: dict):
+    """Identifies the thumbnail a rename will get. Files without a custom one always get the same automatic thumbnail."""
+    if active_op.get("custom_thumbnail_unique_id"):
+        return f"custom:{active_op['custom_thumbnail_unique_id']}"
+    if active_op.get("custom_thumbnail_id"):
+        return f"custom-id:{active_op['custom_thumbnail_id']}"
+    return "auto"
+
+
+def sent_file_id(message):
+    """The file_id of the media in a message we sent, or None."""
+    if message is None:
+        return None
+    for attribute in ("document", "video", "audio", "photo"):
+        media = getattr(message, attribute, None)
+        if media:
+            return media.file_id
+    return None
+
+
+class DedupIndex:
+    def __init__(self, collection, enabled: bool, ttl_days: int):
+        self.collection = collection
+        self.enabled = enabled and collection is not None
+        self.ttl = ttl_days * 24 * 3600
+        # Metrics
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0 # Entries dropped because their file_id no longer worked
+
+    async def setup(self):
+        if self.enabled:
+            await self.collection.create_index("last_used", expireAfterSeconds=self.ttl)
+
+    @staticmethod
+    def key(active_op: dict, new_name: str):
+        unique_id = (active_op.get("media") or {}).get("file_unique_id")
+        if not unique_id:
+            return None
+        raw_key = f"{unique_id}\0{active_op['file_type']}\0{new_name}\0{thumbnail_fingerprint(active_op)}"
+        return hashlib.sha256(raw_key.encode("utf-8")).hexdigest()
+
+    async def lookup(self, active_op: dict, new_name: str):
+        """Returns the cached output file_id for this rename, or None."""
+        key = self.key(active_op, new_name) if self.enabled else None
+        if key is None:
+            return None
+        try:
+            entry = await self.collection.find_one_and_update(
+                {"_id": key},
+                {"$set": {"last_used": datetime.datetime.utcnow()}, "$inc": {"hits": 1}},
+                projection={"file_id": 1}
+            )
+        except Exception as e:
+            logger.warning(f"Dedup: Lookup failed: {e}")
+            return None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["file_id"]
+
+    async def remember(self, active_op: dict, new_name: str, message):
+        """Records the output of a finished rename (the Message we sent)."""
+        key = self.key(active_op, new_name) if self.enabled else None
+        file_id = sent_file_id(message)
+        if key is None or file_id is None:
+            return
+        now = datetime.datetime.utcnow()
+        try:
+            await self.collection.update_one(
+                {"_id": key},
+                {"$set": {"file_id": file_id, "file_type": active_op["file_type"], "last_used": now},
+                 "$setOnInsert": {"created_at": now, "hits": 0}},
+                upsert=True
+            )
+            self.stores += 1
+        except Exception as e:
+            logger.warning(f"Dedup: Could not store {new_name}: {e}")
+
+    async def forget(self, active_op: dict, new_name: str):
+        """Drops an entry whose file_id could not be resent."""
+        key = self.key(active_op, new_name) if self.enabled else None
+        if key is None:
+            return
+        self.evictions += 1
+        try:
+            await self.collection.delete_one({"_id": key})
+        except Exception as e:
+            logger.warning(f"Dedup: Could not drop entry for {new_name}: {e}")
+
+    async def stats(self):
+        lookups = self.hits + self.misses
+        size = await self.collection.estimated_document_count() if self.enabled else 0
+        return {
+            "enabled": self.enabled,
+            "entries": size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits / lookups) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
+
+
+dedup = DedupIndex(db.db["dedup"] if db.db is not None else None, DEDUP_ENABLED, DEDUP_TTL_DAYS)
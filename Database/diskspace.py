@@ -0,0 +1,208 @@
+import os
+import shutil
+import time
+from config import (
+    DOWNLOAD_DIR, SCRATCH_MIN_FREE_MB, SCRATCH_HEADROOM_MB,
+    SCRATCH_RAM_DIR, SCRATCH_RAM_MAX_FILE_MB, SCRATCH_RAM_BUDGET_MB
+)
+from logger import logger # Import logger
+
+# Scratch space admission control.
+# Before a job starts, the scheduler asks its ScratchRequest whether the file (plus headroom) fits
+# on the scratch volume. Free space comes from `shutil.disk_usage`, minus what running jobs have
+# reserved but not written yet, minus SCRATCH_MIN_FREE_MB. A job that does not fit stays queued
+# until space frees up. A job that could not fit even with every other job finished is rejected
+# when it is submitted.
+# With SCRATCH_RAM_DIR set (e.g. a tmpfs such as /dev/shm/renamer), files up to
+# SCRATCH_RAM_MAX_FILE_MB are processed there instead, within SCRATCH_RAM_BUDGET_MB.
+# Prefetches (prefetch.py) reserve their file on the disk tier too, so bytes they are still writing
+# count as outstanding. A job that takes over a prefetched file only reserves the headroom; if the
+# handoff fails, the job grows its reservation to the whole file before downloading it itself.
+# How much of a reservation a running job has written is measured by walking its directory, which
+# the scheduler asks for on every dispatch pass, so the result is cached for WRITTEN_CACHE_SECONDS.
+
+MB = 1024 * 1024
+WRITTEN_CACHE_SECONDS = 2.0
+
+
+def _bytes_on_disk(directory: str):
+    """Allocated bytes under `directory` (0 if it does not exist yet)."""
+    total = 0
+    for root, _, files in os.walk(directory or ""):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            total += stat.st_blocks * 512 if hasattr(stat, "st_blocks") else stat.st_size
+    return total
+
+
+class ScratchTier:
+    """One place jobs can work in: the DOWNLOAD_DIR volume, or the optional RAM directory."""
+
+    def __init__(self, name: str, root: str, budget: int = None, min_free: int = 0):
+        self.name = name
+        self.root = os.path.abspath(root)
+        self.budget = budget # Bytes this tier may hold at once, None = bounded by the volume only
+        self.min_free = min_free
+        self.reservations = set()
+
+    def outstanding(self):
+        """Bytes reserved by running jobs that they have not written yet."""
+        return sum(max(0, reservation.size - reservation.written()) for reservation in self.reservations)
+
+    def available(self):
+        os.makedirs(self.root, exist_ok=True)
+        free = shutil.disk_usage(self.root).free - self.min_free - self.outstanding()
+        if self.budget is not None:
+            free = min(free, self.budget - sum(reservation.size for reservation in self.reservations))
+        return free
+
+    def possible(self, size: int):
+        """Whether `size` bytes could fit here once all running jobs have finished."""
+        if self.budget is not None and size > self.budget:
+            return False
+        os.makedirs(self.root, exist_ok=True)
+        return size <= shutil.disk_usage(self.root).free - self.min_free + sum(
+            reservation.written() for reservation in self.reservations
+        )
+
+
+class ScratchRequest:
+    """
+    The scratch space one job needs. Used by the scheduler as the job's `resources`:
+    `fits` decides whether the job may start, `acquire` reserves the space in the first tier
+    (in order of preference) that has room, and `release` returns it when the job ends.
+    """
+
+    def __init__(self, space, tiers: list, size: int):
+        self.space = space
+        self.tiers = tiers
+        self.tier = tiers[-1]
+        self.size = size
+        self.directory = None # Set by the job once it knows its scratch directory
+        self.held = False
+        self._written = (0.0, 0) # (monotonic time, bytes) of the last measurement
+
+    def written(self):
+        """Bytes the job has written to its directory so far (cached for WRITTEN_CACHE_SECONDS)."""
+        now = time.monotonic()
+        if self.directory and now - self._written[0] >= WRITTEN_CACHE_SECONDS:
+            self._written = (now, _bytes_on_disk(self.directory))
+        return self._written[1]
+
+    @property
+    def root(self):
+        return self.tier.root
+
+    def _free_tier(self):
+        for tier in self.tiers:
+            try:
+                if tier.available() >= self.size:
+                    return tier
+            except OSError as e:
+                logger.error(f"Scratch: Could not check free space in {tier.root}: {e}")
+        return None
+
+    def fits(self):
+        return self._free_tier() is not None
+
+    def acquire(self):
+        self.tier = self._free_tier() or self.tier
+        self.held = True
+        self.tier.reservations.add(self)
+        if self.tier is self.space.ram:
+            self.space.ram_jobs += 1
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.tier.reservations.discard(self)
+
+    def grow(self, file_size: int):
+        """
+        Raises a held reservation to a whole file of `file_size` bytes (plus headroom).
+        Returns False, leaving it unchanged, if its tier has no room for the difference right now.
+        """
+        size = file_size + self.space.headroom
+        if size <= self.size:
+            return True
+        try:
+            if self.tier.available() < size - self.size:
+                return False
+        except OSError as e:
+            logger.error(f"Scratch: Could not check free space in {self.tier.root}: {e}")
+            return False
+        self.size = size
+        return True
+
+    def possible(self, file_size: int):
+        """Whether a whole file of `file_size` bytes could ever fit in this reservation's tier."""
+        return self.tier.possible(file_size + self.space.headroom)
+
+
+class ScratchSpace:
+    def __init__(self, disk: ScratchTier, ram: ScratchTier = None, ram_max_file: int = 0, headroom: int = 0):
+        self.disk = disk
+        self.ram = ram
+        self.ram_max_file = ram_max_file
+        self.headroom = headroom
+        # Metrics
+        self.rejected = 0
+        self.ram_jobs = 0
+
+    def request(self, file_size: int, streamed: bool = False, prefetched: bool = False):
+        """
+        The ScratchRequest for a file of `file_size` bytes, or None if it can never fit.
+        Streamed renames only keep a thumbnail on disk, so they only need the headroom. So do
+        prefetched files: they already sit on the disk volume and are hardlinked into the job
+        directory, so they stay on the disk tier instead of being copied into RAM.
+        """
+        in_place = streamed or prefetched
+        size = (0 if in_place else file_size or 0) + self.headroom
+        tiers = []
+        if self.ram is not None and not in_place and file_size <= self.ram_max_file and self.ram.possible(size):
+            tiers.append(self.ram)
+        if self.disk.possible(size):
+            tiers.append(self.disk)
+        if not tiers:
+            self.rejected += 1
+            logger.warning(f"Scratch: A job needing {size / MB:.0f} MB can never fit in {self.disk.root}.")
+            return None
+        return ScratchRequest(self, tiers, size)
+
+    def reserve(self, file_size: int, directory: str):
+        """
+        Reserves `file_size` bytes on the disk tier right away for a download into `directory`
+        (used by prefetches). Returns the held ScratchRequest, or None if it does not fit now.
+        """
+        request = ScratchRequest(self, [self.disk], file_size or 0)
+        if not request.fits():
+            return None
+        request.acquire()
+        request.directory = directory
+        return request
+
+    def stats(self):
+        tiers = {}
+        for tier in filter(None, (self.disk, self.ram)):
+            try:
+                free = shutil.disk_usage(tier.root).free
+            except OSError:
+                free = 0
+            tiers[tier.name] = {
+                "free": free,
+                "reserved": sum(reservation.size for reservation in tier.reservations),
+                "jobs": len(tier.reservations),
+                "budget": tier.budget,
+            }
+        return {"tiers": tiers, "rejected": self.rejected, "ram_jobs": self.ram_jobs}
+
+
+scratch_space = ScratchSpace(
+    ScratchTier("disk", DOWNLOAD_DIR, min_free=SCRATCH_MIN_FREE_MB * MB),
+    ScratchTier("ram", SCRATCH_RAM_DIR, budget=SCRATCH_RAM_BUDGET_MB * MB) if SCRATCH_RAM_DIR else None,
+    ram_max_file=SCRATCH_RAM_MAX_FILE_MB * MB,
+    headroom=SCRATCH_HEADROOM_MB * MB
+)
@@ -0,0 +1,147 @@
+import asyncio
+import math
+import os
+import time
+from pyrogram import Client, raw
+from pyrogram.file_id import FileId, FileType
+from uploader import call_progress
+from mtproto import media_pool, TransferMetrics
+from config import PARALLEL_DOWNLOAD_MIN_MB
+from logger import logger # Import logger
+
+# Chunked downloads that write straight into the target file and record every finished chunk
+# in a TransferCheckpoint (transfers.py), so an interrupted download continues where it stopped.
+# Large files are fetched with raw upload.GetFile requests over several media connections to the
+# file's data center at once (`download_parallel`); small ones use Pyrogram's single stream.
+# The optional `throttle(nbytes)` coroutine function (a bandwidth.py limiter) is awaited for every chunk.
+
+CHUNK_SIZE = 1024 * 1024 # Chunk size used by `client.stream_media`; offsets are counted in chunks
+
+download_metrics = TransferMetrics()
+
+
+class CdnRedirect(Exception):
+    """The file is served from a CDN DC, which only the sequential Pyrogram downloader supports."""
+
+
+async def download_file(client: Client, file_id: str, path: str, file_size: int, checkpoint, connections: int = 1, progress=None, throttle=None):
+    """Downloads to `path` with the parallel downloader when it is worth it, otherwise with a single stream."""
+    started_at = time.monotonic()
+    resumed_bytes = min(len(checkpoint.downloaded) * CHUNK_SIZE, file_size) if os.path.exists(path) else 0
+    if connections > 1 and file_size >= PARALLEL_DOWNLOAD_MIN_MB * 1024 * 1024:
+        try:
+            await download_parallel(client, file_id, path, file_size, checkpoint, connections, progress, throttle)
+        except CdnRedirect:
+            logger.info(f"{path} is served from a CDN, downloading with a single stream instead.")
+            await download_resumable(client, file_id, path, file_size, checkpoint, progress, throttle)
+    else:
+        await download_resumable(client, file_id, path, file_size, checkpoint, progress, throttle)
+    speed = download_metrics.record(file_size - resumed_bytes, started_at)
+    logger.info(f"Downloaded {path} at {speed / (1024 * 1024):.2f} MB/s using up to {connections} connections.")
+    return path
+
+
+def _file_location(file_id: FileId):
+    """The raw InputFileLocation for a photo or document file id, as Pyrogram builds it."""
+    if file_id.file_type == FileType.PHOTO:
+        return raw.types.InputPhotoFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size
+        )
+    return raw.types.InputDocumentFileLocation(
+        id=file_id.media_id,
+        access_hash=file_id.access_hash,
+        file_reference=file_id.file_reference,
+        thumb_size=file_id.thumbnail_size
+    )
+
+
+async def download_parallel(client: Client, file_id: str, path: str, file_size: int, checkpoint, connections: int, progress=None, throttle=None):
+    """
+    Fetches the missing chunks of `file_id` concurrently, one worker per media connection to the
+    file's DC, and writes each chunk at its offset in a preallocated file. Returns `path`.
+    """
+    decoded = FileId.decode(file_id)
+    location = _file_location(decoded)
+    total_chunks = max(1, math.ceil(file_size / CHUNK_SIZE))
+    if not os.path.exists(path):
+        checkpoint.downloaded.clear()
+    missing = iter([index for index in range(total_chunks) if index not in checkpoint.downloaded])
+    done_bytes = min(len(checkpoint.downloaded) * CHUNK_SIZE, file_size)
+    sessions = await media_pool.get(client, decoded.dc_id, connections)
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        if os.fstat(fd).st_size != file_size:
+            # Reserve the whole file up front: no fragmentation, and a full disk fails now rather than mid-way
+            if hasattr(os, "posix_fallocate"):
+                os.posix_fallocate(fd, 0, file_size)
+            else:
+                os.ftruncate(fd, file_size)
+
+        async def worker(session):
+            nonlocal done_bytes
+            for index in missing: # Shared iterator: each chunk is taken by exactly one worker
+                if throttle:
+                    await throttle(min(CHUNK_SIZE, file_size - index * CHUNK_SIZE))
+                result = await session.invoke(
+                    raw.functions.upload.GetFile(location=location, offset=index * CHUNK_SIZE, limit=CHUNK_SIZE)
+                )
+                if isinstance(result, raw.types.upload.FileCdnRedirect):
+                    raise CdnRedirect()
+                os.pwrite(fd, result.bytes, index * CHUNK_SIZE)
+                done_bytes += len(result.bytes)
+                await checkpoint.mark_downloaded(index)
+                await call_progress(progress, min(done_bytes, file_size), file_size)
+
+        workers = [asyncio.create_task(worker(session)) for session in sessions]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True) # Let them stop before the file is closed
+    finally:
+        os.close(fd)
+
+    if len(checkpoint.downloaded) < total_chunks:
+        raise ConnectionError(f"Download of {path} stopped after {len(checkpoint.downloaded)} of {total_chunks} chunks")
+    return path
+
+
+async def download_resumable(client: Client, file_id: str, path: str, file_size: int, checkpoint, progress=None, throttle=None):
+    """Downloads `file_id` to `path`, skipping chunks the checkpoint already has. Returns `path`."""
+    total_chunks = max(1, math.ceil(file_size / CHUNK_SIZE))
+    if not os.path.exists(path):
+        checkpoint.downloaded.clear() # The partial file is gone, so are its chunks
+
+    missing = [index for index in range(total_chunks) if index not in checkpoint.downloaded]
+    if not missing:
+        logger.info(f"Download of {path} already complete according to its checkpoint.")
+        return path
+
+    first = missing[0]
+    done_bytes = min(len(checkpoint.downloaded) * CHUNK_SIZE, file_size)
+    if first:
+        logger.info(f"Resuming download of {path} at chunk {first}/{total_chunks}.")
+
+    with open(path, "r+b" if os.path.exists(path) else "wb") as output:
+        output.truncate(file_size) # Sparse preallocation so chunks can be written at their offsets
+        index = first
+        async for chunk in client.stream_media(file_id, offset=first):
+            if throttle:
+                await throttle(len(chunk)) # Pausing the generator also pauses the stream
+            if index not in checkpoint.downloaded:
+                output.seek(index * CHUNK_SIZE)
+                output.write(chunk)
+                output.flush()
+                done_bytes += len(chunk)
+                await checkpoint.mark_downloaded(index)
+                await call_progress(progress, min(done_bytes, file_size), file_size)
+            index += 1
+
+    if len(checkpoint.downloaded) < total_chunks:
+        raise ConnectionError(f"Download of {path} stopped after {len(checkpoint.downloaded)} of {total_chunks} chunks")
+    return path
@@ -94,3 +94,15 @@ async def force_subscribe_filter(_, client: Client, update: Message | CallbackQu
 
 # Instantiate the filter
 force_sub = filters.create(force_subscribe_filter)
+
+
+async def session_state_filter(flt, client: Client, update: Message):
+    """Passes updates from users whose conversation (sessions.py) is in one of `flt.states`."""
+    from sessions import sessions # Imported lazily: sessions needs the database, this module does not
+    if not update.from_user:
+        return False
+    return await sessions.get_state(update.from_user.id) in flt.states
+
+def session_state(*states):
+    """Filter for handlers that only apply in certain conversation states, e.g. session_state("collecting_batch")."""
+    return filters.create(session_state_filter, states=states)
@@ -1,30 +1,31 @@
-import os
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from pyrogram.errors import FloodWait, RPCError
+from pyrogram.errors import RPCError
 import asyncio
-import time 
-from utils import get_or_generate_thumbnail
-from database import db
+from utils import extract_media, new_active_operation
+from database import db, PLAN_FIELDS
+from sessions import sessions
+from prefetch import prefetcher
+from rename_rules import try_auto_rename
 from config import (
     UPDATE_CHANNEL_URL, SUPPORT_GROUP_URL, HELP_TEXT, ABOUT_TEXT,
-    START_UP_PIC, ADMINS, DOWNLOAD_DIR, THUMBNAIL_DIR
+    START_UP_PIC, ADMINS
 )
 from filter_plugins import force_sub
-from progress import progress_for_pyrogram
+from pipeline import submit_rename
 from logger import logger # Import logger
 
-# --- States for Custom Thumbnail/Caption ---
-# Using active_file_operation in DB for conversation state
-# "waiting_for_thumbnail": True/False
-# "waiting_for_caption": True/False
+# --- Conversation states ---
+# Kept in the session store (sessions.py), not in the user document:
+# "waiting_for_new_name", "waiting_for_thumbnail", "waiting_for_caption"
+# The file being processed is still stored in active_file_operation in the DB.
 
 @Client.on_message(filters.command("start") & filters.private & force_sub)
 async def start_command(client: Client, message: Message):
     """Handles the /start command and displays user plan info with inline keyboard."""
     user_id = message.from_user.id
     logger.info(f"User {user_id} sent /start command.")
-    user_data = db.get_user(user_id) # Get or create user
+    user_data = await db.get_user(user_id, fields=PLAN_FIELDS) # Get or create user
 
     plan_info = (
         f"**Current Plan:** `{user_data['current_plan'].upper()}`\n"
@@ -101,7 +102,7 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
         logger.warning(f"User {user_id} failed force_sub check on callback {data}.")
         return
 
-    active_op = db.get_active_operation(user_id)
+    active_op = await db.get_active_operation(user_id)
 
     if data == "help_command":
         await callback_query.message.edit_text(HELP_TEXT, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Back", callback_data="start_menu")]]))
@@ -114,7 +115,7 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("Back", callback_data="start_menu")]])
         )
     elif data == "start_menu":
-        user_data = db.get_user(user_id)
+        user_data = await db.get_user(user_id, fields=PLAN_FIELDS)
         plan_info = (
             f"**Current Plan:** `{user_data['current_plan'].upper()}`\n"
             f"**Daily Upload Limit:** `{user_data['daily_upload_limit_gb']} GB`\n"
@@ -176,23 +177,26 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
 
     elif data == "rename_file":
         if active_op:
-            db.update_user_field(user_id, "active_file_operation.state", "waiting_for_new_name")
+            await sessions.set_state(user_id, "waiting_for_new_name")
             original_name = active_op["original_name"]
             await callback_query.message.edit_text(
                 f"Okay, you want to rename `{original_name}`.\n\n"
-                "Please send me the **new name** for this file."
+                "Please send me the **new name** for this file.\n"
+                "To only change the caption, send the current name; the file is then resent instantly."
             )
             logger.info(f"User {user_id}: Initiated rename for {original_name}.")
         else:
             await callback_query.message.edit_text("No file found to rename. Please send a file first.")
             logger.warning(f"User {user_id}: Tried to rename but no active operation.")
     elif data == "cancel_operation":
-        db.clear_active_operation(user_id)
+        await db.clear_active_operation(user_id)
+        prefetcher.cancel(user_id)
+        await sessions.clear_state(user_id)
         await callback_query.message.edit_text("Operation cancelled. Send a new file to start over.")
         logger.info(f"User {user_id}: Cancelled active operation.")
     elif data == "add_thumbnail":
         if active_op:
-            db.update_user_field(user_id, "active_file_operation.state", "waiting_for_thumbnail")
+            await sessions.set_state(user_id, "waiting_for_thumbnail")
             await callback_query.message.edit_text("Please send the **image** you want to use as a custom thumbnail for this file. Send /skip_thumbnail to use default.")
             logger.info(f"User {user_id}: Initiated adding specific thumbnail.")
         else:
@@ -200,7 +204,7 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
             logger.warning(f"User {user_id}: Tried to add thumbnail but no active operation.")
     elif data == "add_caption":
         if active_op:
-            db.update_user_field(user_id, "active_file_operation.state", "waiting_for_caption")
+            await sessions.set_state(user_id, "waiting_for_caption")
             await callback_query.message.edit_text("Please send the **custom caption** you want to use for this file. Send /skip_caption to use default.")
             logger.info(f"User {user_id}: Initiated adding specific caption.")
         else:
@@ -215,13 +219,12 @@ async def handle_file(client: Client, message: Message):
     """Handles incoming file messages and prompts for action with inline buttons."""
     user_id = message.from_user.id
     logger.info(f"User {user_id} sent a file.")
-    user_data = db.get_user(user_id)
-
-    active_op = db.get_active_operation(user_id)
-    if active_op and active_op.get("state") == "waiting_for_thumbnail":
+    if await sessions.get_state(user_id) == "waiting_for_thumbnail":
         if message.photo:
-            db.update_user_field(user_id, "active_file_operation.custom_thumbnail_id", message.photo.file_id)
-            db.update_user_field(user_id, "active_file_operation.state", None) # Clear state
+            async with db.user_update(user_id) as update:
+                update.set("active_file_operation.custom_thumbnail_id", message.photo.file_id)
+                update.set("active_file_operation.custom_thumbnail_unique_id", message.photo.file_unique_id) # Dedup fingerprint
+            await sessions.clear_state(user_id)
             await message.reply_text("Custom thumbnail received! Now send the **new name** for the file.")
             logger.info(f"User {user_id}: Received custom thumbnail for active operation.")
             return
@@ -230,21 +233,8 @@ async def handle_file(client: Client, message: Message):
             logger.warning(f"User {user_id}: Sent non-image while waiting for thumbnail.")
             return
 
-    file_type = None
-    file_info = None
-
-    if message.document:
-        file_info = message.document
-        file_type = "document"
-    elif message.video:
-        file_info = message.video
-        file_type = "video"
-    elif message.audio:
-        file_info = message.audio
-        file_type = "audio"
-    elif message.photo:
-        file_info = sorted(message.photo, key=lambda p: p.file_size or 0, reverse=True)[0]
-        file_type = "photo"
+    user_data = await db.get_user(user_id)
+    file_info, file_type = extract_media(message)
 
     if file_info:
         file_size_gb = (file_info.file_size or 0) / (1024**3)
@@ -256,20 +246,14 @@ async def handle_file(client: Client, message: Message):
             logger.warning(f"User {user_id}: Daily upload limit reached. File size: {file_size_gb:.2f}GB.")
             return
 
-        original_name = getattr(file_info, "file_name", f"untitled_{file_type}")
-        mime_type = getattr(file_info, "mime_type", "application/octet-stream")
-
-        db.set_active_operation(user_id, {
-            "file_id": file_info.file_id,
-            "original_name": original_name,
-            "file_type": file_type,
-            "mime_type": mime_type,
-            "pyrogram_file_obj": file_info.to_dict(),
-            "file_size": file_info.file_size,
-            "state": None,
-            "custom_thumbnail_id": None,
-            "custom_caption_text": user_data.get("custom_caption") # Apply user's default caption if set
-        })
+        active_op = new_active_operation(file_info, file_type, user_data.get("custom_caption")) # Use user's default caption if set
+        original_name = active_op["original_name"]
+        if await try_auto_rename(client, message, user_data, active_op):
+            await sessions.clear_state(user_id)
+            return # Queued with the user's rename rules, no prompt needed
+        await db.set_active_operation(user_id, active_op)
+        prefetcher.start(client, user_id, active_op, user_data.get("parallel_processes", 1), user_data.get("current_plan", "free")) # Opt-in, replaces any earlier prefetch
+        await sessions.clear_state(user_id) # A new file starts a new conversation
         logger.info(f"User {user_id}: File received: {original_name} ({file_info.file_size} bytes).")
 
         keyboard = InlineKeyboardMarkup(
@@ -301,174 +285,61 @@ async def handle_file(client: Client, message: Message):
 async def handle_text_input(client: Client, message: Message):
     """Handles text messages based on the current state (new name or custom caption)."""
     user_id = message.from_user.id
-    active_op = db.get_active_operation(user_id)
+    current_state = await sessions.get_state(user_id)
     text_input = message.text.strip()
-    logger.info(f"User {user_id}: Received text input '{text_input}' in state: {active_op.get('state')}.")
+    logger.info(f"User {user_id}: Received text input '{text_input}' in state: {current_state}.")
+
+    # Only states that act on a file need the active operation from the DB
+    active_op = None
+    if current_state in ("waiting_for_new_name", "waiting_for_caption"):
+        active_op = await db.get_active_operation(user_id)
+        if not active_op:
+            await sessions.clear_state(user_id)
 
     if not active_op:
         await message.reply_text("I'm not expecting text input right now. Please send a file or use /start.")
         logger.warning(f"User {user_id}: Sent unexpected text input '{text_input}'.")
         return
 
-    current_state = active_op.get("state")
-
     if current_state == "waiting_for_new_name":
         new_name = text_input
         
-        db.update_user_field(user_id, "active_file_operation.state", None) # Clear state
-
-        sent_message = await message.reply_text("Starting operation...")
-        
-        download_path = None
-        renamed_path = None
-        thumbnail_path = None
-
-        try:
-            download_start_time = time.time()
-            logger.info(f"User {user_id}: Starting download of {active_op['original_name']}.")
-            download_path = await client.download_media(
-                active_op["file_id"],
-                file_name=os.path.join(DOWNLOAD_DIR, active_op["original_name"]), # Use DOWNLOAD_DIR
-                progress=progress_for_pyrogram,
-                progress_args=(
-                    active_op["pyrogram_file_obj"].get("file_size", 1),
-                    "DOWNLOADING",
-                    sent_message,
-                    download_start_time
-                )
+        # Admission control: one atomic round trip resets the daily counter if needed and reserves the quota
+        reserved_user = await db.reserve_upload(user_id, active_op["file_size"])
+        await sessions.clear_state(user_id)
+        if not reserved_user:
+            await db.clear_active_operation(user_id)
+            prefetcher.cancel(user_id, "daily limit reached")
+            await message.reply_text(
+                "Your daily upload limit has been reached. "
+                "Please upgrade your plan or try again tomorrow."
             )
-            logger.info(f"User {user_id}: Downloaded {download_path}.")
-            await sent_message.edit_text(f"Downloaded `{active_op['original_name']}`. Renaming to `{new_name}`...")
-
-            # Get or generate thumbnail
-            thumbnail_path = await get_or_generate_thumbnail(client, message, active_op, download_path)
-            if thumbnail_path:
-                logger.info(f"User {user_id}: Thumbnail prepared: {thumbnail_path}.")
-            else:
-                logger.warning(f"User {user_id}: No thumbnail prepared for upload.")
-
-            # Ensure download directory exists before attempting rename
-            os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-            renamed_path = os.path.join(DOWNLOAD_DIR, new_name) # Ensure renamed file is in DOWNLOAD_DIR
-
-            os.rename(download_path, renamed_path)
-            logger.info(f"User {user_id}: Renamed {download_path} to {renamed_path}.")
-
+            logger.warning(f"User {user_id}: Daily upload limit reached when starting {active_op['original_name']}.")
+            return
 
-            upload_params = {
-                "chat_id": message.chat.id,
-                "caption": active_op.get("custom_caption_text", f"Here is your renamed file: `{new_name}`")
-            }
-            if thumbnail_path:
-                upload_params["thumb"] = thumbnail_path
+        # The job carries its own snapshot of the operation, so the user can send the next file while it runs
+        await db.clear_active_operation(user_id)
+        await submit_rename(client, message, reserved_user, active_op, new_name)
 
-            upload_start_time = time.time()
-            logger.info(f"User {user_id}: Starting upload of {renamed_path}.")
-            if active_op["file_type"] == "document":
-                await client.send_document(
-                    document=renamed_path,
-                    progress=progress_for_pyrogram,
-                    progress_args=(
-                        os.path.getsize(renamed_path),
-                        "UPLOADING",
-                        sent_message,
-                        upload_start_time
-                    ),
-                    **upload_params
-                )
-            elif active_op["file_type"] == "video":
-                duration = active_op["pyrogram_file_obj"].get('duration', 0)
-                width = active_op["pyrogram_file_obj"].get('width', 0)
-                height = active_op["pyrogram_file_obj"].get('height', 0)
-                await client.send_video(
-                    video=renamed_path,
-                    duration=duration,
-                    width=width,
-                    height=height,
-                    progress=progress_for_pyrogram,
-                    progress_args=(
-                        os.path.getsize(renamed_path),
-                        "UPLOADING",
-                        sent_message,
-                        upload_start_time
-                    ),
-                    **upload_params
-                )
-            elif active_op["file_type"] == "audio":
-                duration = active_op["pyrogram_file_obj"].get('duration', 0)
-                title = active_op["pyrogram_file_obj"].get('title', None)
-                artist = active_op["pyrogram_file_obj"].get('artist', None)
-                await client.send_audio(
-                    audio=renamed_path,
-                    duration=duration,
-                    title=title,
-                    artist=artist,
-                    progress=progress_for_pyrogram,
-                    progress_args=(
-                        os.path.getsize(renamed_path),
-                        "UPLOADING",
-                        sent_message,
-                        upload_start_time
-                    ),
-                    **upload_params
-                )
-            elif active_op["file_type"] == "photo":
-                # For photos, Pyrogram send_photo directly uses file path;
-                # progress is not directly supported like download_media.
-                await client.send_photo(
-                    photo=renamed_path,
-                    **upload_params
-                )
-                await sent_message.edit_text("Uploading photo... (progress not shown)")
-            
-            await sent_message.edit_text(f"File successfully renamed and sent! New name: `{new_name}`")
-            db.increment_daily_upload(user_id, active_op["file_size"])
-            logger.info(f"User {user_id}: File {new_name} uploaded successfully.")
-
-        except FloodWait as e:
-            await sent_message.edit_text(f"Telegram is asking me to wait for {e.value} seconds. Please try again later.")
-            logger.warning(f"FloodWait Error for user {user_id} during file operation: {e}", exc_info=True)
-        except Exception as e:
-            await sent_message.edit_text(f"An error occurred: `{e}`")
-            logger.error(f"Error in handle_text_input for user {user_id} - File: {active_op.get('original_name', 'N/A')}: {e}", exc_info=True)
-        finally:
-            db.clear_active_operation(user_id)
-            # Cleanup downloaded/renamed files and thumbnails
-            if download_path and os.path.exists(download_path):
-                os.remove(download_path)
-                logger.debug(f"Cleaned up download: {download_path}")
-            if renamed_path and os.path.exists(renamed_path):
-                os.remove(renamed_path)
-                logger.debug(f"Cleaned up renamed file: {renamed_path}")
-            if thumbnail_path and os.path.exists(thumbnail_path):
-                os.remove(thumbnail_path)
-                logger.debug(f"Cleaned up thumbnail: {thumbnail_path}")
-            
-            # Ensure base directories exist for next operations
-            os.makedirs(DOWNLOAD_DIR, exist_ok=True)
-            os.makedirs(THUMBNAIL_DIR, exist_ok=True)
-            logger.debug(f"Ensured {DOWNLOAD_DIR} and {THUMBNAIL_DIR} exist.")
-    
     elif current_state == "waiting_for_caption":
-        if text_input == "/skip_caption":
-            db.update_user_field(user_id, "active_file_operation.custom_caption_text", None)
+        custom_caption_text = None if text_input == "/skip_caption" else text_input
+        await db.update_user_field(user_id, "active_file_operation.custom_caption_text", custom_caption_text)
+        await sessions.clear_state(user_id)
+
+        if custom_caption_text is None:
             await message.reply_text("Skipped custom caption. Default caption will be used.")
             logger.info(f"User {user_id}: Skipped custom caption for active operation.")
         else:
-            db.update_user_field(user_id, "active_file_operation.custom_caption_text", text_input)
             await message.reply_text("Custom caption saved!")
             logger.info(f"User {user_id}: Saved custom caption for active operation.")
         
-        db.update_user_field(user_id, "active_file_operation.state", None)
-        active_op = db.get_active_operation(user_id) # Refresh active_op after update
-        
         keyboard = InlineKeyboardMarkup(
             [
                 [InlineKeyboardButton("Rename File", callback_data="rename_file")]
             ]
         )
         await message.reply_text(
-            f"Now you can proceed with renaming. Custom caption will be: `{active_op.get('custom_caption_text', 'Default')}`",
+            f"Now you can proceed with renaming. Custom caption will be: `{custom_caption_text or 'Default'}`",
             reply_markup=keyboard
         )
 
@@ -479,10 +350,11 @@ async def handle_text_input(client: Client, message: Message):
 @Client.on_message(filters.command("skip_thumbnail") & filters.private & force_sub)
 async def skip_thumbnail_command(client: Client, message: Message):
     user_id = message.from_user.id
-    active_op = db.get_active_operation(user_id)
-    if active_op and active_op.get("state") == "waiting_for_thumbnail":
-        db.update_user_field(user_id, "active_file_operation.custom_thumbnail_id", None)
-        db.update_user_field(user_id, "active_file_operation.state", None)
+    if await sessions.get_state(user_id) == "waiting_for_thumbnail":
+        async with db.user_update(user_id) as update:
+            update.set("active_file_operation.custom_thumbnail_id", None)
+            update.unset("active_file_operation.custom_thumbnail_unique_id")
+        await sessions.clear_state(user_id)
         await message.reply_text("Skipped custom thumbnail. Default thumbnail will be used. Now send the **new name** for the file.")
         logger.info(f"User {user_id}: Skipped custom thumbnail for active operation.")
     else:
@@ -492,10 +364,9 @@ async def skip_thumbnail_command(client: Client, message: Message):
 @Client.on_message(filters.command("skip_caption") & filters.private & force_sub)
 async def skip_caption_command(client: Client, message: Message):
     user_id = message.from_user.id
-    active_op = db.get_active_operation(user_id)
-    if active_op and active_op.get("state") == "waiting_for_caption":
-        db.update_user_field(user_id, "active_file_operation.custom_caption_text", None)
-        db.update_user_field(user_id, "active_file_operation.state", None)
+    if await sessions.get_state(user_id) == "waiting_for_caption":
+        await db.update_user_field(user_id, "active_file_operation.custom_caption_text", None)
+        await sessions.clear_state(user_id)
         keyboard = InlineKeyboardMarkup(
             [
                 [InlineKeyboardButton("Rename File", callback_data="rename_file")]
@@ -0,0 +1,161 @@
+import asyncio
+import os
+import shutil
+import time
+from transfers import checkpoints
+from prefetch import prefetcher
+from config import (
+    DOWNLOAD_DIR, THUMBNAIL_DIR, JANITOR_INTERVAL, DOWNLOAD_MAX_AGE, THUMBNAIL_MAX_AGE,
+    DOWNLOAD_DIR_BUDGET_MB, THUMBNAIL_DIR_BUDGET_MB, SCRATCH_RAM_DIR, SCRATCH_RAM_BUDGET_MB
+)
+from logger import logger # Import logger
+
+# Background janitor for DOWNLOAD_DIR and THUMBNAIL_DIR.
+# Jobs clean up after themselves, but a crash, a kill or an abandoned conversation can leave files
+# behind. Every JANITOR_INTERVAL seconds each top-level entry of both directories that no running
+# job or live prefetch owns (see `checkpoints.directories` and `prefetcher.directories`) is removed
+# once it is older than the directory's max age; then, while a directory is over its byte budget,
+# the oldest unowned entries go first. Resumable checkpoints are kept until DOWNLOAD_MAX_AGE.
+# The optional RAM scratch directory (SCRATCH_RAM_DIR) is swept the same way.
+# Scanning and deleting run in a worker thread; the ownership check and the rename to a
+# ".trash" name happen together on the event loop, so a job can never claim a directory that is
+# being deleted.
+
+TRASH_SUFFIX = ".trash"
+KEEP_NAMES = {"default_thumbnail.jpg"} # Shared files that are always kept
+
+
+def _scan(root: str):
+    """Lists the top-level entries of `root` as (path, bytes, newest mtime). Runs in a thread."""
+    entries = []
+    if not os.path.isdir(root):
+        return entries
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        try:
+            if os.path.isdir(path) and not os.path.islink(path):
+                size, mtime = 0, os.path.getmtime(path)
+                for directory, _, files in os.walk(path):
+                    for file_name in files:
+                        stat = os.stat(os.path.join(directory, file_name))
+                        size += stat.st_blocks * 512 if hasattr(stat, "st_blocks") else stat.st_size # Sparse partial downloads
+                        mtime = max(mtime, stat.st_mtime)
+            else:
+                stat = os.lstat(path)
+                size, mtime = stat.st_size, stat.st_mtime
+        except FileNotFoundError:
+            continue # Removed by its job while we were looking
+        entries.append((path, size, mtime))
+    return entries
+
+
+def _remove(path: str):
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path, ignore_errors=True)
+    else:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class Janitor:
+    def __init__(self, interval: int, targets: list):
+        self.interval = interval
+        self.targets = targets # [(name, directory, max age in seconds, budget in bytes)]
+        self.task = None
+        # Metrics
+        self.sweeps = 0
+        self.removed = 0
+        self.reclaimed_bytes = 0
+        self.last_sweep_seconds = 0.0
+        self.usage = {} # target name -> bytes after the last sweep
+
+    def start(self):
+        if self.task is None and self.interval > 0:
+            self.task = asyncio.create_task(self._loop())
+            logger.info(f"Janitor: Sweeping {', '.join(name for name, *_ in self.targets)} every {self.interval}s.")
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.sweep()
+            except Exception as e:
+                logger.error(f"Janitor: Sweep failed: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    @staticmethod
+    def owned():
+        return checkpoints.directories | prefetcher.directories
+
+    async def sweep(self):
+        """Runs one pass over every target. Returns the bytes reclaimed."""
+        started_at = time.monotonic()
+        reclaimed = 0
+        for name, root, max_age, budget in self.targets:
+            entries = await asyncio.to_thread(_scan, os.path.abspath(root))
+            now = time.time()
+            owned = self.owned()
+            candidates = sorted(
+                (entry for entry in entries
+                 if entry[0] not in owned and os.path.basename(entry[0]) not in KEEP_NAMES),
+                key=lambda entry: entry[2] # Oldest first
+            )
+            total = sum(size for _, size, _ in entries)
+            doomed = []
+            for path, size, mtime in candidates:
+                expired = path.endswith(TRASH_SUFFIX) or now - mtime > max_age
+                if expired or total > budget:
+                    doomed.append((path, size))
+                    total -= size
+            reclaimed += await self._delete(doomed)
+            self.usage[name] = total
+            if total > budget:
+                logger.warning(f"Janitor: {name} uses {total / (1024**2):.0f} MB, over its {budget / (1024**2):.0f} MB budget, but the rest is in use.")
+        self.sweeps += 1
+        self.last_sweep_seconds = time.monotonic() - started_at
+        if reclaimed:
+            logger.info(f"Janitor: Reclaimed {reclaimed / (1024**2):.1f} MB in {self.last_sweep_seconds:.1f}s.")
+        return reclaimed
+
+    async def _delete(self, doomed: list):
+        trash = []
+        owned = self.owned() # Re-checked after the scan: a job may have started meanwhile
+        for path, size in doomed:
+            if path in owned:
+                continue
+            target = path if path.endswith(TRASH_SUFFIX) else path + TRASH_SUFFIX
+            try:
+                if target != path:
+                    os.rename(path, target) # Same event loop step as the ownership check
+            except FileNotFoundError:
+                continue
+            trash.append((target, size))
+        for target, size in trash:
+            await asyncio.to_thread(_remove, target)
+            self.removed += 1
+            self.reclaimed_bytes += size
+            logger.debug(f"Janitor: Removed {target} ({size} bytes).")
+        return sum(size for _, size in trash)
+
+    def stats(self):
+        return {
+            "running": self.task is not None,
+            "sweeps": self.sweeps,
+            "removed": self.removed,
+            "reclaimed_bytes": self.reclaimed_bytes,
+            "last_sweep_seconds": self.last_sweep_seconds,
+            "usage": dict(self.usage),
+            "budgets": {name: budget for name, _, _, budget in self.targets},
+        }
+
+
+janitor = Janitor(JANITOR_INTERVAL, [
+    ("downloads", DOWNLOAD_DIR, DOWNLOAD_MAX_AGE, DOWNLOAD_DIR_BUDGET_MB * 1024 * 1024),
+    ("thumbnails", THUMBNAIL_DIR, THUMBNAIL_MAX_AGE, THUMBNAIL_DIR_BUDGET_MB * 1024 * 1024),
+] + ([("ram scratch", SCRATCH_RAM_DIR, DOWNLOAD_MAX_AGE, SCRATCH_RAM_BUDGET_MB * 1024 * 1024)] if SCRATCH_RAM_DIR else []))
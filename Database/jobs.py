@@ -0,0 +1,160 @@
+import asyncio
+import datetime
+import os
+import socket
+import uuid
+from bson import ObjectId
+from pymongo import ReturnDocument
+from database import db
+from config import JOB_HISTORY_DAYS, JOB_LEASE_SECONDS
+from logger import logger # Import logger
+
+# Durable job journal ("jobs" collection).
+# The scheduler only keeps jobs in memory, so every rename job is also written here when it is
+# submitted and its `stage` is updated as it moves through the pipeline. After a restart the jobs
+# still in an active stage are the ones that were interrupted; `recover_jobs` in pipeline.py
+# requeues them (their checkpoints make the transfer resume) or cleans them up.
+# Several instances can share the collection, so every active entry is leased: it names the
+# instance (`owner`) that runs it, and that instance renews `lease_until` every third of
+# JOB_LEASE_SECONDS while the job is queued or running. Only entries whose lease has expired count as
+# interrupted, and an instance takes one over with an atomic find_one_and_update, so a job still
+# running elsewhere is never started twice.
+# Finished jobs are kept for JOB_HISTORY_DAYS (TTL index on `finished_at`).
+
+ACTIVE_STAGES = ("queued", "downloading", "streaming", "thumbnailing", "uploading")
+FINAL_STAGES = ("done", "failed", "cancelled", "abandoned")
+
+
+class JobJournal:
+    def __init__(self, collection, history_days: int, lease_seconds: int):
+        self.collection = collection
+        self.history = history_days * 24 * 3600
+        self.lease = datetime.timedelta(seconds=max(lease_seconds, 3))
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.entries = {} # scheduler job id -> journal document id, for jobs of this process
+        self.task = None
+        # Metrics
+        self.recovered = 0
+        self.abandoned = 0
+
+    async def setup(self):
+        if self.collection is not None:
+            await self.collection.create_index("finished_at", expireAfterSeconds=self.history)
+            await self.collection.create_index([("stage", 1), ("lease_until", 1)])
+
+    def start(self):
+        """Starts renewing the leases of this instance's jobs."""
+        if self.task is None and self.collection is not None:
+            self.task = asyncio.create_task(self._heartbeat())
+
+    def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def _lease_fields(self):
+        return {"owner": self.instance_id, "lease_until": datetime.datetime.utcnow() + self.lease}
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.lease.total_seconds() / 3)
+            if not self.entries:
+                continue
+            try:
+                await self.collection.update_many(
+                    {"_id": {"$in": list(self.entries.values())}, "owner": self.instance_id},
+                    {"$set": {"lease_until": datetime.datetime.utcnow() + self.lease}}
+                )
+            except Exception as e:
+                logger.warning(f"Jobs: Could not renew the leases of {len(self.entries)} jobs: {e}")
+
+    async def record(self, job, message, active_op: dict, new_name: str, journal_id=None):
+        """Journals a submitted job. `journal_id` continues the document of a recovered job."""
+        if self.collection is None:
+            return None
+        now = datetime.datetime.utcnow()
+        try:
+            if journal_id is None:
+                journal_id = ObjectId()
+                await self.collection.insert_one({
+                    "_id": journal_id,
+                    "user_id": job.user_id,
+                    "chat_id": message.chat.id,
+                    "message_id": message.id,
+                    "plan": job.plan,
+                    "active_op": active_op,
+                    "new_name": new_name,
+                    "stage": "queued",
+                    "attempts": 1,
+                    "created_at": now,
+                    "updated_at": now,
+                    **self._lease_fields(),
+                })
+            else:
+                await self.collection.update_one(
+                    {"_id": journal_id},
+                    {"$set": {"stage": "queued", "updated_at": now, **self._lease_fields()}, "$inc": {"attempts": 1}}
+                )
+        except Exception as e:
+            logger.warning(f"Jobs: Could not journal job {job.id} for user {job.user_id}: {e}")
+            return None
+        self.entries[job.id] = journal_id
+        return journal_id
+
+    async def stage(self, job, stage: str, **fields):
+        """Records the stage a job has reached (plus extra fields such as its scratch directory)."""
+        journal_id = self.entries.get(job.id)
+        if journal_id is None:
+            return
+        if stage in FINAL_STAGES:
+            del self.entries[job.id]
+            await self.finish(journal_id, stage, **fields)
+        else:
+            await self._update(journal_id, stage, {**fields, "lease_until": datetime.datetime.utcnow() + self.lease}, owned=True)
+
+    async def finish(self, journal_id, stage: str, **fields):
+        """Moves a journal document to a final stage, which starts its history TTL."""
+        await self._update(journal_id, stage, {"finished_at": datetime.datetime.utcnow(), **fields})
+
+    async def _update(self, journal_id, stage: str, fields: dict, owned: bool = False):
+        query = {"_id": journal_id, "owner": self.instance_id} if owned else {"_id": journal_id}
+        try:
+            await self.collection.update_one(
+                query,
+                {"$set": {"stage": stage, "updated_at": datetime.datetime.utcnow(), **fields}}
+            )
+        except Exception as e:
+            logger.warning(f"Jobs: Could not record stage {stage} of journal entry {journal_id}: {e}")
+
+    async def claim_interrupted(self):
+        """
+        Takes over the next active job whose lease has expired (its instance stopped or died), oldest
+        first, and returns its document; None when there is none. The claim holds the lease for one
+        JOB_LEASE_SECONDS, so the caller must requeue (`record`) or finish the job within that time.
+        """
+        if self.collection is None:
+            return None
+        now = datetime.datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {
+                "stage": {"$in": list(ACTIVE_STAGES)},
+                "$or": [{"lease_until": {"$lt": now}}, {"lease_until": {"$exists": False}}], # Entries from before leases
+            },
+            {"$set": self._lease_fields()},
+            sort=[("created_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    async def stats(self):
+        if self.collection is None:
+            return {"enabled": False}
+        counts = {stage: 0 for stage in ACTIVE_STAGES + FINAL_STAGES}
+        async for row in self.collection.aggregate([{"$group": {"_id": "$stage", "count": {"$sum": 1}}}]):
+            counts[row["_id"]] = row["count"]
+        return {
+            "enabled": True, "stages": counts, "recovered": self.recovered, "abandoned": self.abandoned,
+            "owned": len(self.entries), "instance": self.instance_id,
+        }
+
+
+job_journal = JobJournal(db.db["jobs"] if db.db is not None else None, JOB_HISTORY_DAYS, JOB_LEASE_SECONDS)
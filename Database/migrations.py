@@ -0,0 +1,104 @@
+from config import DEFAULT_USER_PLAN
+from logger import logger # Import logger
+
+# Versioned, one-shot schema migrations for the users collection.
+# Every user document carries a `schema_version`; each migration only touches documents
+# below its version and then stamps them, so running this again is cheap and idempotent.
+# To change the schema, add a coroutine below and append it to MIGRATIONS with the next version.
+
+
+def _below(version: int):
+    """Filter matching user documents that have not been migrated to `version` yet."""
+    return {"$or": [{"schema_version": {"$exists": False}}, {"schema_version": {"$lt": version}}]}
+
+
+async def _backfill_default_fields(users, pending_filter: dict):
+    """Adds any DEFAULT_USER_PLAN field missing from existing documents."""
+    modified = 0
+    for key, default_value in DEFAULT_USER_PLAN.items():
+        result = await users.update_many(
+            {"$and": [pending_filter, {key: {"$exists": False}}]},
+            {"$set": {key: default_value}}
+        )
+        modified += result.modified_count
+    return modified
+
+
+async def _compact_active_operation_media(users, pending_filter: dict):
+    """
+    Replaces the full Pyrogram object dump stored in `active_file_operation.pyrogram_file_obj`
+    with the compact `media` record built by `utils.media_record`.
+    """
+    source = "$active_file_operation.pyrogram_file_obj"
+    result = await users.update_many(
+        {"$and": [pending_filter, {"active_file_operation.pyrogram_file_obj": {"$exists": True}}]},
+        [
+            {"$set": {"active_file_operation.media": {
+                "file_id": f"{source}.file_id",
+                "file_unique_id": f"{source}.file_unique_id",
+                "file_size": f"{source}.file_size",
+                "duration": f"{source}.duration",
+                "width": f"{source}.width",
+                "height": f"{source}.height",
+                "title": f"{source}.title",
+                "performer": f"{source}.performer",
+                "thumbs": {"$map": {
+                    "input": {"$ifNull": [f"{source}.thumbs", []]},
+                    "as": "thumb",
+                    "in": {"file_id": "$$thumb.file_id", "file_size": "$$thumb.file_size"}
+                }}
+            }}},
+            {"$unset": "active_file_operation.pyrogram_file_obj"}
+        ]
+    )
+    return result.modified_count
+
+
+async def _move_state_out_of_active_operation(users, pending_filter: dict):
+    """
+    Conversation state now lives in the session store (sessions.py). Drops placeholder
+    active operations that only carried a state, and the `state` key from real ones.
+    """
+    placeholders = await users.update_many(
+        {"$and": [
+            pending_filter,
+            {"active_file_operation": {"$type": "object"}},
+            {"active_file_operation.file_id": {"$exists": False}}
+        ]},
+        {"$set": {"active_file_operation": None}}
+    )
+    stale_states = await users.update_many(
+        {"$and": [pending_filter, {"active_file_operation.state": {"$exists": True}}]},
+        {"$unset": {"active_file_operation.state": ""}}
+    )
+    return placeholders.modified_count + stale_states.modified_count
+
+
+MIGRATIONS = [
+    (1, "Backfill DEFAULT_USER_PLAN fields", _backfill_default_fields),
+    (2, "Compact active operation media records", _compact_active_operation_media),
+    (3, "Move conversation state to the session store", _move_state_out_of_active_operation),
+    (4, "Backfill auto-rename settings", _backfill_default_fields),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+
+async def run_migrations(users):
+    """
+    Applies all pending migrations to the users collection.
+    Returns a list of (version, description, modified_count, stamped_count) for the migrations that ran.
+    """
+    applied = []
+    for version, description, migration in MIGRATIONS:
+        pending_filter = _below(version)
+        if not await users.find_one(pending_filter, {"_id": 1}):
+            continue
+        logger.info(f"Running schema migration v{version}: {description}")
+        modified = await migration(users, pending_filter)
+        stamped = await users.update_many(pending_filter, {"$set": {"schema_version": version}})
+        logger.info(f"Schema migration v{version} done: {modified} field updates, {stamped.modified_count} documents stamped.")
+        applied.append((version, description, modified, stamped.modified_count))
+    if not applied:
+        logger.info(f"User documents are at schema v{SCHEMA_VERSION}, no migrations needed.")
+    return applied
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from pyrogram import Client, raw
+from pyrogram.errors import AuthBytesInvalid
+from pyrogram.session import Session, Auth
+from config import MAX_MEDIA_CONNECTIONS
+from logger import logger # Import logger
+
+# Extra MTProto connections for file transfers.
+# Pyrogram keeps a single media session per data center, so every transfer to that DC shares one
+# connection. The pool below opens up to `max_per_dc` media sessions per DC (authorizing them the
+# same way Pyrogram does for foreign DCs) and hands them out round-robin, so a single large file
+# can be fetched or sent over several connections at once.
+
+
+class MediaSessionPool:
+    def __init__(self, max_per_dc: int):
+        self.max_per_dc = max(1, max_per_dc)
+        self.sessions = {} # dc id -> list of started Sessions
+        self._next = {} # dc id -> round-robin cursor
+        self._lock = asyncio.Lock()
+
+    async def get(self, client: Client, dc_id: int, count: int):
+        """Returns `count` sessions for `dc_id` (capped by `max_per_dc`), opening new ones if needed."""
+        count = max(1, min(count, self.max_per_dc))
+        async with self._lock:
+            pool = self.sessions.setdefault(dc_id, [])
+            while len(pool) < count:
+                pool.append(await self._create(client, dc_id))
+                logger.info(f"MTProto pool: Opened media connection {len(pool)} to DC {dc_id}.")
+            start = self._next.get(dc_id, 0)
+            self._next[dc_id] = (start + count) % len(pool)
+            return [pool[(start + i) % len(pool)] for i in range(count)]
+
+    @staticmethod
+    async def _create(client: Client, dc_id: int):
+        test_mode = await client.storage.test_mode()
+        if dc_id == await client.storage.dc_id():
+            session = Session(client, dc_id, await client.storage.auth_key(), test_mode, is_media=True)
+            await session.start()
+            return session
+
+        # Foreign DC: new auth key, then import the bot's authorization into it
+        session = Session(client, dc_id, await Auth(client, dc_id, test_mode).create(), test_mode, is_media=True)
+        await session.start()
+        for _ in range(3):
+            exported = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+            try:
+                await session.invoke(raw.functions.auth.ImportAuthorization(id=exported.id, bytes=exported.bytes))
+                return session
+            except AuthBytesInvalid:
+                continue
+        await session.stop()
+        raise AuthBytesInvalid
+
+    async def close(self):
+        for pool in self.sessions.values():
+            for session in pool:
+                try:
+                    await session.stop()
+                except Exception as e:
+                    logger.debug(f"MTProto pool: Error closing session: {e}")
+        self.sessions.clear()
+
+
+class TransferMetrics:
+    """Throughput counters for one transfer direction, shown in /stats."""
+
+    def __init__(self):
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.peak = 0.0 # Best bytes/second of a single file
+        self.last = 0.0
+
+    def record(self, size: int, started_at: float):
+        elapsed = max(time.monotonic() - started_at, 0.001)
+        self.files += 1
+        self.bytes += size
+        self.seconds += elapsed
+        self.last = size / elapsed
+        self.peak = max(self.peak, self.last)
+        return self.last
+
+    def stats(self):
+        return {
+            "files": self.files,
+            "bytes": self.bytes,
+            "avg_speed": (self.bytes / self.seconds) if self.seconds else 0.0,
+            "last_speed": self.last,
+            "peak_speed": self.peak,
+        }
+
+
+media_pool = MediaSessionPool(MAX_MEDIA_CONNECTIONS)
@@ -0,0 +1,520 @@
+import os
+import datetime
+import asyncio
+import functools
+from pyrogram import Client
+from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
+from pyrogram.errors import FloodWait, FilePartMissing
+from utils import get_or_generate_thumbnail, safe_filename
+from database import db, PLAN_FIELDS
+from scheduler import scheduler, Job, JobCancelled, RESOURCE_RETRY_SECONDS
+from prefetch import prefetcher
+from dedup import dedup
+from uploader import upload_stream, upload_file, build_input_media, send_uploaded_media
+from downloader import download_file
+from transfers import checkpoints, with_retries, checkpoint_key
+from jobs import job_journal
+from bandwidth import download_governor, upload_governor
+from diskspace import scratch_space
+from config import (
+    STREAM_RENAME, STREAM_BUFFER_CHUNKS, PLAN_DOWNLOAD_CONNECTIONS, UPLOAD_POOL_SIZE,
+    JOB_RECOVERY_ATTEMPTS, JOB_LEASE_SECONDS, CHECKPOINT_TTL
+)
+from progress import ProgressReporter
+from logger import logger # Import logger
+
+# The rename pipeline: download (straight to the new name) -> thumbnail -> upload.
+# Every job works in its own scratch directory under DOWNLOAD_DIR, so concurrent jobs never
+# collide on paths (e.g. two forwarded copies of the same file) and no rename step is needed.
+# Downloads and uploads are chunked and checkpointed (transfers.py): transient errors are retried
+# from the last finished chunk, and a failed job can be resumed by sending the same file and name again.
+# With STREAM_RENAME the download is piped into the upload instead (see `stream_rename`).
+# If the file was prefetched (prefetch.py) the job takes over those bytes instead of downloading again.
+# Renames that need no new bytes are answered with one send_cached_media call, without queueing a job:
+# caption-only changes resend the original file, and a rename we have already done once (same file,
+# name and thumbnail) resends the earlier output from the dedup index (dedup.py).
+# Handlers never run it inline; they submit it to the global scheduler with `submit_rename`.
+# Jobs can be cancelled at any point (/cancel or the Cancel button under the status message, see
+# scheduler.py): the token is checked on every progress callback, and cleanup releases the quota
+# reservation, the prefetch and the scratch directory including its checkpoint.
+# Every chunk in either direction passes the bandwidth governor (bandwidth.py) for the job's user and plan.
+# Each job's stage is journaled (jobs.py); after a restart `recover_jobs` requeues the interrupted ones,
+# and `watch_jobs` keeps taking over jobs whose instance stopped renewing their lease.
+# A job only starts once its scratch space fits on the volume (diskspace.py); small files may use a RAM tier.
+
+
+class JobStatus:
+    """Wraps a job's status message so every progress edit keeps the job's Cancel button."""
+
+    def __init__(self, message: Message):
+        self.message = message
+        self.job_id = None
+
+    async def edit_text(self, text: str, **kwargs):
+        if self.job_id is not None:
+            # Final edits pass reply_markup=None to drop the button
+            kwargs.setdefault("reply_markup", InlineKeyboardMarkup([[InlineKeyboardButton("Cancel", callback_data=f"cancel_job:{self.job_id}")]]))
+        return await self.message.edit_text(text, **kwargs)
+
+
+def cancellable_progress(token, reporter: ProgressReporter):
+    """A progress callback that stops the transfer once `token` is cancelled and otherwise feeds `reporter`."""
+    def progress(current, total):
+        token.raise_if_cancelled()
+        reporter.update(current, total)
+    return progress
+
+
+async def submit_rename(client: Client, message: Message, user_data: dict, active_op: dict, new_name: str, status_message=None, on_finish=None, journal_id=None):
+    """
+    Queues a rename job for `active_op`. The caller must already hold a quota reservation
+    for the file (see `Database.reserve_upload`); the job releases it if it does not complete.
+    `status_message` receives progress edits (a new reply by default) and the optional coroutine
+    function `on_finish` is called with True/False when the rename is done.
+    `journal_id` continues the journal entry of a job recovered after a restart.
+    Returns the scheduled Job, or None if the rename was answered without a transfer or could not be queued.
+    Errors before the job reaches the scheduler (e.g. a FloodWait on the status reply) release the
+    reservation and are reported to the user instead of being raised.
+    """
+    user_id = message.from_user.id
+    state = {"reserved": True, "prefetched": None}
+    try:
+        return await _submit_rename(client, message, user_data, active_op, new_name, status_message, on_finish, journal_id, state)
+    except Exception as e:
+        logger.error(f"User {user_id}: Could not queue the rename of {active_op.get('original_name', 'N/A')}: {e}", exc_info=True)
+        if not state["reserved"]:
+            return None # Already answered, rejected or handed to the scheduler; only a status edit failed
+        await db.release_upload(user_id, active_op["file_size"])
+        prefetched = state["prefetched"] or prefetcher.claim(user_id, active_op["file_id"])
+        if prefetched:
+            prefetched.discard()
+        if journal_id is not None:
+            await job_journal.finish(journal_id, "failed", reason=str(e))
+        try:
+            text = f"Could not start renaming `{new_name}`: `{e}`\n\nPlease send the file again."
+            if status_message:
+                await status_message.edit_text(text, reply_markup=None)
+            else:
+                await message.reply_text(text)
+        except Exception as notify_error:
+            logger.debug(f"User {user_id}: Could not report the failed submission: {notify_error}")
+        if on_finish:
+            await on_finish(False)
+        return None
+
+
+async def _submit_rename(client: Client, message: Message, user_data: dict, active_op: dict, new_name: str, status_message, on_finish, journal_id, state: dict):
+    """The body of `submit_rename`; `state` tracks what still has to be undone if it raises."""
+    if await send_without_transfer(client, message, active_op, new_name):
+        state["reserved"] = False # Released by send_without_transfer
+        if status_message:
+            await status_message.edit_text(f"Sent `{new_name}` instantly (no transfer needed).")
+        if journal_id is not None:
+            await job_journal.finish(journal_id, "done")
+        if on_finish:
+            await on_finish(True)
+        return None
+
+    prefetched = state["prefetched"] = prefetcher.claim(message.from_user.id, active_op["file_id"])
+    scratch = scratch_space.request(
+        active_op["file_size"], streamed=STREAM_RENAME and active_op["file_type"] != "photo", prefetched=prefetched is not None
+    )
+    if scratch is None:
+        state["reserved"] = False
+        await db.release_upload(message.from_user.id, active_op["file_size"])
+        if prefetched:
+            prefetched.discard()
+        text = f"`{new_name}` is too large for the free space on this server right now. Please try again later."
+        if status_message:
+            await status_message.edit_text(text)
+        else:
+            await message.reply_text(text)
+        if journal_id is not None:
+            await job_journal.finish(journal_id, "abandoned", reason="not enough scratch space")
+        if on_finish:
+            await on_finish(False)
+        return None
+
+    if status_message is None:
+        status_message = JobStatus(await message.reply_text("Preparing your file..."))
+
+    async def report_position(position):
+        await status_message.edit_text(
+            f"Queued `{new_name}`.\n\n"
+            f"**Position in queue:** `{position}`\n"
+            "It will start automatically when a slot is free."
+        )
+
+    run = functools.partial(run_rename, client, message, active_op, new_name, status_message, prefetched)
+    if on_finish:
+        async def run_and_report(job):
+            completed = False
+            try:
+                completed = await run(job)
+            finally:
+                await on_finish(completed)
+            return completed
+
+    async def cancel_queued():
+        """Cleanup for a job cancelled before it started: run_rename never runs for it."""
+        if prefetched:
+            prefetched.discard()
+        await db.release_upload(message.from_user.id, active_op["file_size"])
+        await job_journal.stage(job, "cancelled")
+        await status_message.edit_text(f"Cancelled `{new_name}` before it started.", reply_markup=None)
+        if on_finish:
+            await on_finish(False)
+
+    job = Job(
+        user_id=message.from_user.id,
+        slots=user_data.get("parallel_processes", 1),
+        run=run_and_report if on_finish else run,
+        on_position=report_position,
+        plan=user_data.get("current_plan", "free"),
+        on_cancel=cancel_queued,
+        resources=scratch,
+        slot_hold=prefetched.slot if prefetched else None
+    )
+    if isinstance(status_message, JobStatus):
+        status_message.job_id = job.id
+    await job_journal.record(job, message, active_op, new_name, journal_id)
+    state["reserved"] = False # From here on the job releases it
+    position = scheduler.submit(job)
+    logger.info(f"User {job.user_id}: Rename job {job.id} for {active_op['original_name']} submitted (queue position {position}).")
+    return job
+
+
+def is_caption_only(active_op: dict, new_name: str):
+    """
+    True when a rename would reproduce the original file byte for byte: no custom thumbnail and
+    the name is unchanged (photos carry no file name, so only the thumbnail matters for them).
+    """
+    if active_op.get("custom_thumbnail_id"):
+        return False
+    return active_op["file_type"] == "photo" or new_name == active_op["original_name"]
+
+
+async def send_without_transfer(client: Client, message: Message, active_op: dict, new_name: str):
+    """
+    Answers a rename with a single send_cached_media call when no new bytes are needed:
+    caption-only changes resend the original file_id, and repeats of an earlier rename resend
+    its output from the dedup index. Nothing is transferred, so the quota reserved for the file
+    is released. Returns True if sent.
+    """
+    if is_caption_only(active_op, new_name):
+        file_id, source = active_op["file_id"], "caption-only"
+    else:
+        file_id, source = await dedup.lookup(active_op, new_name), "dedup"
+        if file_id is None:
+            return False
+    user_id = message.from_user.id
+    try:
+        await client.send_cached_media(
+            chat_id=message.chat.id,
+            file_id=file_id,
+            caption=active_op.get("custom_caption_text") or f"Here is your renamed file: `{new_name}`"
+        )
+    except FloodWait as e:
+        # Fall back to a normal rename job, which waits and retries its transfer calls
+        logger.warning(f"User {user_id}: FloodWait of {e.value}s while resending {new_name} without a transfer ({source}), queueing a normal rename.")
+        return False
+    except Exception as e:
+        # Fall back to a normal rename; a cached output that no longer works is dropped
+        logger.warning(f"User {user_id}: Could not resend {new_name} without a transfer ({source}): {e}")
+        if source == "dedup":
+            await dedup.forget(active_op, new_name)
+        return False
+    await db.release_upload(user_id, active_op["file_size"])
+    prefetcher.cancel(user_id, f"answered without a transfer ({source})")
+    logger.info(f"User {user_id}: {active_op['original_name']} -> {new_name} answered without a transfer ({source}).")
+    return True
+
+
+async def run_rename(client: Client, message: Message, active_op: dict, new_name: str, sent_message: Message, prefetched, job: Job):
+    """
+    Runs one rename job. Called by the scheduler once a worker slot is free.
+    `prefetched` is the PrefetchEntry claimed for this file, or None.
+    Returns True if the renamed file was sent.
+    """
+    user_id = message.from_user.id
+    checkpoint = None
+    streamed = False # Streamed renames keep no transfer checkpoint, so they cannot be resumed
+    thumbnail_path = None
+    completed = False
+    cancelled = False
+    interrupted = False
+    download_throttle = download_governor.limiter(user_id, job.plan)
+    upload_throttle = upload_governor.limiter(user_id, job.plan)
+
+    try:
+        await sent_message.edit_text("Starting operation...")
+        checkpoint = await checkpoints.open(user_id, active_op, new_name, job.id, root=job.resources.root)
+        job_dir = checkpoint.directory
+        job.resources.directory = job_dir # Lets admission control see how much of the reservation is written
+        target_path = os.path.join(job_dir, safe_filename(new_name))
+        download_path = None
+        if prefetched:
+            await sent_message.edit_text(f"Finishing the early download of `{active_op['original_name']}`...")
+            if await prefetched.handoff(target_path):
+                download_path = target_path
+                await checkpoint.mark_download_complete()
+        job.token.raise_if_cancelled()
+
+        if download_path is None and STREAM_RENAME and active_op["file_type"] != "photo":
+            streamed = True
+            await job_journal.stage(job, "streaming", directory=job_dir, checkpoint_key=checkpoint.key)
+            thumbnail_path = await get_or_generate_thumbnail(client, message, active_op, None, output_dir=job_dir, cancel_token=job.token)
+            with ProgressReporter(sent_message, "STREAMING") as reporter:
+                sent = await stream_rename(
+                    client, message.chat.id, active_op, new_name, thumbnail_path,
+                    cancellable_progress(job.token, reporter), download_throttle, upload_throttle
+                )
+            await dedup.remember(active_op, new_name, sent)
+            await sent_message.edit_text(f"File successfully renamed and sent! New name: `{new_name}`", reply_markup=None)
+            completed = True
+            logger.info(f"User {user_id}: File {new_name} streamed successfully.")
+            return True
+
+        if download_path is None:
+            if prefetched:
+                await grow_scratch(job, active_op["file_size"], sent_message) # Admitted for the headroom only
+            await job_journal.stage(job, "downloading", directory=job_dir, checkpoint_key=checkpoint.key)
+            logger.info(f"User {user_id}: Starting download of {active_op['original_name']} to {target_path}.")
+            with ProgressReporter(sent_message, "DOWNLOADING") as reporter:
+                download_path = await with_retries(
+                    lambda: download_file(
+                        client, active_op["file_id"], target_path, active_op["file_size"], checkpoint, # Written under the new name directly
+                        connections=PLAN_DOWNLOAD_CONNECTIONS.get(job.plan, 1),
+                        progress=cancellable_progress(job.token, reporter),
+                        throttle=download_throttle
+                    ),
+                    "Download", sent_message
+                )
+            logger.info(f"User {user_id}: Downloaded {download_path}.")
+        await sent_message.edit_text(f"Downloaded `{active_op['original_name']}` as `{new_name}`. Preparing upload...")
+
+        # Get or generate thumbnail
+        await job_journal.stage(job, "thumbnailing", directory=job_dir, checkpoint_key=checkpoint.key)
+        thumbnail_path = await get_or_generate_thumbnail(client, message, active_op, download_path, output_dir=job_dir, cancel_token=job.token)
+        job.token.raise_if_cancelled()
+        if thumbnail_path:
+            logger.info(f"User {user_id}: Thumbnail prepared: {thumbnail_path}.")
+        else:
+            logger.warning(f"User {user_id}: No thumbnail prepared for upload.")
+
+        caption = active_op.get("custom_caption_text") or f"Here is your renamed file: `{new_name}`"
+        await job_journal.stage(job, "uploading")
+        logger.info(f"User {user_id}: Starting upload of {download_path}.")
+        if active_op["file_type"] == "photo":
+            # Photos are small, so they are sent in one go without a checkpoint or progress.
+            await sent_message.edit_text("Uploading photo... (progress not shown)")
+            sent = await client.send_photo(chat_id=message.chat.id, photo=download_path, caption=caption)
+        else:
+            async def upload_and_send():
+                with ProgressReporter(sent_message, "UPLOADING") as reporter:
+                    input_file = await with_retries(
+                        lambda: upload_file(
+                            client, download_path, new_name, checkpoint,
+                            connections=UPLOAD_POOL_SIZE,
+                            progress=cancellable_progress(job.token, reporter),
+                            throttle=upload_throttle
+                        ),
+                        "Upload", sent_message
+                    )
+                thumb = await client.save_file(thumbnail_path) if thumbnail_path else None
+                input_media = build_input_media(
+                    input_file, active_op["file_type"], new_name, active_op.get("mime_type"), active_op.get("media") or {}, thumb
+                )
+                return await send_uploaded_media(client, message.chat.id, input_media, caption)
+
+            try:
+                sent = await upload_and_send()
+            except FilePartMissing:
+                # Parts resumed from an earlier attempt have expired on Telegram's side
+                logger.warning(f"User {user_id}: Resumed upload parts expired, uploading {new_name} again.")
+                checkpoint.reset_upload(client.rnd_id())
+                sent = await upload_and_send()
+        await dedup.remember(active_op, new_name, sent)
+
+        await sent_message.edit_text(f"File successfully renamed and sent! New name: `{new_name}`", reply_markup=None)
+        completed = True
+        logger.info(f"User {user_id}: File {new_name} uploaded successfully.")
+
+    except (JobCancelled, asyncio.CancelledError):
+        # CancelledError: the job ignored its token for too long and the scheduler cancelled the task
+        if not job.token.cancelled:
+            interrupted = True
+            raise # Bot shutdown, not a user cancellation: keep the checkpoint
+        cancelled = True
+        job.token.observe()
+        logger.info(f"User {user_id}: Rename job {job.id} for {new_name} cancelled ({job.token.reason}).")
+        try:
+            await sent_message.edit_text(f"Cancelled `{new_name}`.", reply_markup=None)
+        except Exception as e:
+            logger.debug(f"User {user_id}: Could not report cancellation of job {job.id}: {e}")
+    except FloodWait as e:
+        await sent_message.edit_text(f"Telegram is asking me to wait for {e.value} seconds. Please try again later.", reply_markup=None)
+        logger.warning(f"FloodWait Error for user {user_id} during file operation: {e}", exc_info=True)
+    except Exception as e:
+        if checkpoint is not None and not streamed:
+            hint = "Progress has been saved. Send the same file again with the same new name to resume."
+        else:
+            hint = "Please send the file again to retry."
+        await sent_message.edit_text(f"An error occurred: `{e}`\n\n{hint}", reply_markup=None)
+        logger.error(f"Error in rename job {job.id} for user {user_id} - File: {active_op.get('original_name', 'N/A')}: {e}", exc_info=True)
+    finally:
+        job.token.observe() # From here on the job only cleans up; a late /cancel must not interrupt that
+        if prefetched:
+            prefetched.discard() # No-op after a handoff
+        if interrupted:
+            # Shutdown: the quota reservation and journal entry stay for `recover_jobs` after the restart
+            if checkpoint is not None:
+                await checkpoints.release(checkpoint, False)
+        else:
+            await job_journal.stage(job, "done" if completed else "cancelled" if cancelled else "failed")
+            if not completed:
+                await db.release_upload(user_id, active_op["file_size"])
+            # A completed or cancelled job removes its scratch directory (download and per-job thumbnails) and
+            # checkpoint. A failed one keeps them so the transfer can be resumed. The shared default thumbnail is kept.
+            if checkpoint is not None:
+                await checkpoints.release(checkpoint, completed, discard=cancelled)
+                logger.debug(f"Released job directory {checkpoint.directory} (completed: {completed}).")
+    return completed
+
+
+async def grow_scratch(job: Job, file_size: int, sent_message: Message):
+    """
+    Grows the scratch reservation of a job whose prefetch fell through to the whole file before it
+    downloads it itself, waiting for space like a queued job would.
+    """
+    if job.resources.grow(file_size):
+        return
+    if not job.resources.possible(file_size):
+        raise OSError("There is not enough disk space on this server for this file.")
+    await sent_message.edit_text("Waiting for free disk space...")
+    while not job.resources.grow(file_size):
+        job.token.raise_if_cancelled()
+        await asyncio.sleep(RESOURCE_RETRY_SECONDS)
+
+
+async def recover_jobs(client: Client):
+    """
+    Called at startup, after the client has started, and then by `watch_jobs`. Jobs the journal shows
+    as active with an expired lease were interrupted (their instance restarted or died): each is claimed
+    for this instance and submitted again (its checkpoint resumes the transfer and its quota reservation
+    is still held), or given up and cleaned up if it cannot be resumed.
+    """
+    while True:
+        doc = await job_journal.claim_interrupted()
+        if doc is None:
+            break
+        user_id, active_op, new_name = doc["user_id"], doc["active_op"], doc["new_name"]
+        reason, message = None, None
+        if doc.get("attempts", 1) > JOB_RECOVERY_ATTEMPTS:
+            reason = "it was interrupted by too many restarts"
+        elif (datetime.datetime.utcnow() - doc["created_at"]).total_seconds() > CHECKPOINT_TTL:
+            reason = "it is too old to resume"
+        else:
+            try:
+                message = await client.get_messages(doc["chat_id"], doc["message_id"])
+            except Exception as e:
+                logger.warning(f"Jobs: Could not fetch the message of interrupted job {doc['_id']}: {e}")
+            if message is None or message.empty or message.from_user is None:
+                reason = "its message is no longer available"
+
+        if reason:
+            await abandon_job(client, doc, reason)
+            continue
+        try:
+            await message.reply_text(f"The bot restarted while working on `{new_name}`. Resuming it now...")
+            user_data = await db.get_user(user_id, fields=PLAN_FIELDS)
+            job = await submit_rename(client, message, user_data, active_op, new_name, journal_id=doc["_id"])
+        except Exception as e:
+            logger.error(f"Jobs: Could not requeue interrupted job {doc['_id']} for user {user_id}: {e}", exc_info=True)
+            await abandon_job(client, doc, "it could not be restarted")
+            continue
+        job_journal.recovered += 1
+        logger.info(f"Jobs: Requeued interrupted job {doc['_id']} ({new_name}) for user {user_id}{'' if job else ' (not queued)'}.")
+
+
+async def watch_jobs(client: Client):
+    """
+    Runs `recover_jobs` every JOB_LEASE_SECONDS. This picks up jobs whose lease was still running at
+    startup (a quick restart) and jobs of another instance that died while this one keeps running.
+    """
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS)
+        try:
+            await recover_jobs(client)
+        except Exception as e:
+            logger.error(f"Jobs: Recovery pass failed: {e}", exc_info=True)
+
+
+async def abandon_job(client: Client, doc: dict, reason: str):
+    """Gives up an interrupted job: frees its quota reservation and scratch files and tells the user."""
+    user_id, active_op, new_name = doc["user_id"], doc["active_op"], doc["new_name"]
+    job_journal.abandoned += 1
+    await db.release_upload(user_id, active_op["file_size"])
+    await checkpoints.discard(doc.get("checkpoint_key") or checkpoint_key(user_id, active_op, new_name), doc.get("directory"))
+    await job_journal.finish(doc["_id"], "abandoned", reason=reason)
+    logger.warning(f"Jobs: Abandoned interrupted job {doc['_id']} ({new_name}) for user {user_id}: {reason}.")
+    try:
+        await client.send_message(
+            doc["chat_id"],
+            f"Your rename to `{new_name}` was interrupted by a bot restart and could not be resumed because {reason}. "
+            "Please send the file again."
+        )
+    except Exception as e:
+        logger.debug(f"Jobs: Could not notify user {user_id} about abandoned job {doc['_id']}: {e}")
+
+
+async def stream_rename(client: Client, chat_id, active_op: dict, new_name: str, thumbnail_path: str, progress=None, download_throttle=None, upload_throttle=None):
+    """
+    Pipes the file from `client.stream_media` into a raw upload under `new_name`.
+    At most STREAM_BUFFER_CHUNKS chunks are held in memory, so the download runs ahead of the
+    upload only by that much and the job takes about max(download, upload) instead of their sum.
+    """
+    buffer = asyncio.Queue(maxsize=max(1, STREAM_BUFFER_CHUNKS))
+    download_error = []
+
+    async def produce():
+        try:
+            async for chunk in client.stream_media(active_op["file_id"]):
+                if download_throttle:
+                    await download_throttle(len(chunk))
+                await buffer.put(chunk)
+        except Exception as e:
+            download_error.append(e)
+        # Not in a `finally`: after a cancel nobody reads the buffer, so a full queue would block forever
+        await buffer.put(None)
+
+    async def consume():
+        while True:
+            chunk = await buffer.get()
+            if chunk is None:
+                if download_error:
+                    raise download_error[0]
+                return
+            yield chunk
+
+    producer = asyncio.create_task(produce())
+    try:
+        input_file = await upload_stream(
+            client,
+            consume(),
+            active_op["file_size"],
+            new_name,
+            progress=progress,
+            throttle=upload_throttle
+        )
+    finally:
+        producer.cancel()
+        await asyncio.wait({producer}) # Lets the cancel close `stream_media` and its media session
+
+    thumb = await client.save_file(thumbnail_path) if thumbnail_path else None
+    input_media = build_input_media(
+        input_file, active_op["file_type"], new_name, active_op.get("mime_type"), active_op.get("media") or {}, thumb
+    )
+    return await send_uploaded_media(
+        client, chat_id, input_media, active_op.get("custom_caption_text") or f"Here is your renamed file: `{new_name}`"
+    )
@@ -0,0 +1,188 @@
+import asyncio
+import os
+import shutil
+import time
+from pyrogram import Client
+from utils import create_job_dir, safe_filename, place_file
+from scheduler import scheduler
+from bandwidth import download_governor
+from diskspace import scratch_space
+from config import PREFETCH_ENABLED, PREFETCH_DISK_BUDGET_MB, PREFETCH_TIMEOUT
+from logger import logger # Import logger
+
+# Speculative prefetch (opt-in with PREFETCH_ENABLED).
+# As soon as a file is detected we start downloading it into a scratch directory while the user
+# is still choosing a thumbnail/caption and typing the new name. When the rename job starts it
+# takes over the prefetched file (hardlinked to the new name, or moved if links are unsupported)
+# and only waits for whatever is left of the download.
+# A prefetch only starts if the user has a free plan slot (`parallel_processes`), which it then holds
+# in the scheduler until the rename job that claims it starts on that slot (or it is dropped), and it fits the
+# global disk budget; it is dropped when the operation is cancelled, replaced or not claimed in time.
+# Its file is also reserved on the scratch disk tier (diskspace.py), so admission control counts the
+# bytes it is still writing and a prefetch never starts when the volume is short of space.
+# Prefetches count against the user's download bandwidth like any job (bandwidth.py).
+
+
+class PrefetchEntry:
+    """One speculative download for a user's active operation."""
+
+    def __init__(self, owner, user_id: int, file_id: str, size: int, directory: str, path: str, scratch=None, slot=None):
+        self.owner = owner
+        self.slot = slot # Scheduler SlotHold, handed to the job that claims the entry
+        self.scratch = scratch # ScratchRequest held on the disk tier while the file is ours
+        self.user_id = user_id
+        self.file_id = file_id
+        self.size = size
+        self.directory = directory
+        self.path = path
+        self.started_at = time.monotonic()
+        self.task = None
+        self.timer = None
+        self._released = False
+
+    async def handoff(self, target_path: str):
+        """
+        Waits for the download to finish and places the file at `target_path`.
+        Returns True on success, False if the prefetch failed (the caller then downloads normally).
+        The entry is discarded either way.
+        """
+        try:
+            await self.task
+            await asyncio.to_thread(place_file, self.path, target_path) # May be a copy across filesystems
+            self.owner.hits += 1
+            logger.info(f"Prefetch: User {self.user_id}: Handed off {self.path} to {target_path}.")
+            return True
+        except asyncio.CancelledError:
+            if self.task.cancelled():
+                return False
+            raise
+        except Exception as e:
+            logger.warning(f"Prefetch: User {self.user_id}: Prefetched download failed, falling back: {e}")
+            return False
+        finally:
+            self.discard()
+
+    def discard(self):
+        """Stops the download (if still running) and frees its disk space and budget."""
+        if self.timer:
+            self.timer.cancel()
+        if self.task and not self.task.done():
+            self.task.cancel()
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.owner.directories.discard(self.directory)
+        if self.scratch is not None:
+            self.scratch.release()
+        if self.slot is not None:
+            self.slot.release() # No-op once the claiming job has started on it
+        if not self._released:
+            self._released = True
+            self.owner.reserved_bytes -= self.size
+
+
+class Prefetcher:
+    def __init__(self, enabled: bool, budget_bytes: int, timeout: float):
+        self.enabled = enabled
+        self.budget_bytes = budget_bytes
+        self.timeout = timeout
+        self.entries = {} # user id -> PrefetchEntry for the current active operation
+        self.reserved_bytes = 0
+        self.directories = set() # Scratch directories of live prefetches, claimed or not
+        # Metrics
+        self.started = 0
+        self.hits = 0
+        self.cancelled = 0
+        self.expired = 0
+        self.skipped = 0
+
+    def start(self, client: Client, user_id: int, active_op: dict, slots: int, plan: str = "free"):
+        """Starts prefetching `active_op` for the user if allowed. Returns the entry or None."""
+        self.cancel(user_id, "replaced by a new file")
+        if not self.enabled:
+            return None
+
+        size = active_op.get("file_size") or 0
+        if self.reserved_bytes + size > self.budget_bytes:
+            self.skipped += 1
+            logger.debug(f"Prefetch: User {user_id}: {size} bytes would exceed the disk budget, not prefetching.")
+            return None
+        slot = scheduler.hold(user_id, slots)
+        if slot is None:
+            self.skipped += 1
+            logger.debug(f"Prefetch: User {user_id}: All {slots} plan slots busy, not prefetching.")
+            return None
+
+        directory = create_job_dir(user_id, "prefetch")
+        scratch = scratch_space.reserve(size, directory)
+        if scratch is None:
+            shutil.rmtree(directory, ignore_errors=True)
+            slot.release()
+            self.skipped += 1
+            logger.debug(f"Prefetch: User {user_id}: Not enough scratch space for {size} bytes, not prefetching.")
+            return None
+        path = os.path.join(directory, safe_filename(active_op["original_name"]))
+        entry = PrefetchEntry(self, user_id, active_op["file_id"], size, directory, path, scratch, slot)
+        self.directories.add(directory)
+        self.reserved_bytes += size
+        self.started += 1
+        entry.task = asyncio.create_task(self._download(client, entry, download_governor.limiter(user_id, plan)))
+        entry.timer = asyncio.get_running_loop().call_later(self.timeout, self._expire, entry)
+        self.entries[user_id] = entry
+        logger.info(f"Prefetch: User {user_id}: Prefetching {active_op['original_name']} ({size} bytes).")
+        return entry
+
+    @staticmethod
+    async def _download(client: Client, entry: PrefetchEntry, throttle):
+        received = 0
+
+        async def progress(current, total):
+            # Pyrogram awaits this after every chunk, so sleeping here paces the download
+            nonlocal received
+            await throttle(current - received)
+            received = current
+
+        await client.download_media(entry.file_id, file_name=entry.path, progress=progress)
+        logger.info(f"Prefetch: User {entry.user_id}: Prefetched {entry.path} in {time.monotonic() - entry.started_at:.1f}s.")
+
+    def claim(self, user_id: int, file_id: str):
+        """
+        Hands the user's prefetch for `file_id` to a rename job, or returns None.
+        A claimed entry no longer expires; the job must call `handoff` or `discard` on it.
+        """
+        entry = self.entries.get(user_id)
+        if entry is None or entry.file_id != file_id:
+            return None
+        del self.entries[user_id]
+        entry.timer.cancel()
+        return entry
+
+    def cancel(self, user_id: int, reason: str = "cancelled"):
+        """Drops the user's unclaimed prefetch, if any."""
+        entry = self.entries.pop(user_id, None)
+        if entry is None:
+            return
+        self.cancelled += 1
+        entry.discard()
+        logger.info(f"Prefetch: User {user_id}: Dropped prefetch ({reason}).")
+
+    def _expire(self, entry: PrefetchEntry):
+        if self.entries.get(entry.user_id) is entry:
+            del self.entries[entry.user_id]
+            self.expired += 1
+            entry.discard()
+            logger.info(f"Prefetch: User {entry.user_id}: Prefetch not claimed within {self.timeout}s, dropped.")
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "active": len(self.entries),
+            "reserved_bytes": self.reserved_bytes,
+            "budget_bytes": self.budget_bytes,
+            "started": self.started,
+            "hits": self.hits,
+            "cancelled": self.cancelled,
+            "expired": self.expired,
+            "skipped": self.skipped,
+        }
+
+
+prefetcher = Prefetcher(PREFETCH_ENABLED, PREFETCH_DISK_BUDGET_MB * 1024 * 1024, PREFETCH_TIMEOUT)
@@ -1,75 +1,105 @@
+import asyncio
 import time
 from pyrogram.types import Message
+from pyrogram.errors import FloodWait
 import math
+from config import PROGRESS_MIN_INTERVAL
 from logger import logger # Import logger
 
-async def progress_for_pyrogram(
-    current,
-    total,
-    ud_type,
-    message: Message,
-    start_time
-):
-    """
-    Callback function to update a message with download/upload progress.
-    Args:
-        current (int): Bytes transferred so far.
-        total (int): Total bytes of the file.
-        ud_type (str): Type of operation (e.g., "Downloading", "Uploading").
-        message (Message): The Pyrogram message object to update.
-        start_time (float): Time when the operation started (time.time()).
-    """
-    now = time.time()
-    diff = now - start_time
-    # Update every 5 seconds or when complete, to avoid flooding Telegram API
-    if round(diff % 5.00) == 0 or current == total:
-        percentage = current * 100 / total
-        
-        if diff > 0: # Avoid division by zero
-            speed = current / diff
-        else:
-            speed = 0 # No speed yet if no time elapsed
+# Progress display for transfers.
+# Transfer loops report every chunk to a ProgressReporter, which only records the numbers: it never
+# awaits Telegram. Edits run in a background task, at most one per `min_interval` seconds, always
+# showing the latest numbers, and are skipped when the progress itself has not moved: the comparison
+# leaves out the Elapsed timer, which changes every second, and speed/ETA, which change with it.
+# Speed and ETA come from an exponentially weighted moving average, so they follow the current rate
+# instead of the average since the start. A FloodWait on an edit pushes the next edit back.
 
-        elapsed_time = round(diff)
-        
-        # Calculate time to completion, handle cases where speed is 0
-        if speed > 0:
-            time_to_completion = round((total - current) / speed)
-        else:
-            time_to_completion = 0 # Cannot estimate if no speed
 
-        # Calculate human-readable sizes
-        converted_current = humanbytes(current)
-        converted_total = humanbytes(total)
+class ProgressReporter:
+    """Rate-limited, coalescing progress for one status message. Use as `with ProgressReporter(...) as reporter:`."""
 
-        # Calculate human-readable speed
-        converted_speed = humanbytes(speed)
+    SPEED_HALF_LIFE = 5.0 # Seconds; weight of older speed samples halves every SPEED_HALF_LIFE
+    MIN_SAMPLE = 0.2 # Seconds between speed samples, so tiny chunk intervals do not add noise
 
-        # Create progress bar
-        progress_bar_length = 10
-        filled_blocks = math.floor(percentage / 100 * progress_bar_length)
-        empty_blocks = progress_bar_length - filled_blocks
-        
-        progress_bar = "".join(['█' for _ in range(filled_blocks)])
-        empty_bar = "".join([' ' for _ in range(empty_blocks)])
-        
-        progress_string = (
-            f"**{ud_type}**\n\n"
-            f"**Progress**: `{progress_bar}{empty_bar}` `{percentage:.2f}%`\n"
-            f"**Size**: `{converted_current}` / `{converted_total}`\n"
-            f"**Speed**: `{converted_speed}/s`\n"
-            f"**ETA**: `{TimeFormatter(time_to_completion)}`\n"
-            f"**Elapsed**: `{TimeFormatter(elapsed_time)}`"
+    def __init__(self, message: Message, ud_type: str, min_interval: float = PROGRESS_MIN_INTERVAL):
+        self.message = message
+        self.ud_type = ud_type
+        self.min_interval = min_interval
+        self.started_at = time.monotonic()
+        self.current = 0
+        self.total = 0
+        self.speed = None # EWMA bytes/second
+        self._sample = None # (time, bytes) of the last speed sample
+        self._next_edit = 0.0
+        self._last_key = None
+        self._task = None
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def update(self, current: int, total: int):
+        """Records progress. Cheap and synchronous; can be used directly as a progress callback."""
+        now = time.monotonic()
+        self.current, self.total = current, total
+        if self._sample is None:
+            self._sample = (now, current) # Resumed transfers start from here, not from 0
+        elif now - self._sample[0] >= self.MIN_SAMPLE:
+            elapsed = now - self._sample[0]
+            rate = (current - self._sample[1]) / elapsed
+            weight = 1 - 0.5 ** (elapsed / self.SPEED_HALF_LIFE)
+            self.speed = rate if self.speed is None else self.speed + weight * (rate - self.speed)
+            self._sample = (now, current)
+        if not self._closed and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._edit_later(max(0.0, self._next_edit - now)))
+
+    def _key(self):
+        """What an edit must change to be worth sending: the stage, the displayed size and the percentage."""
+        total = self.total or 1
+        return self.ud_type, humanbytes(self.current), f"{min(self.current * 100 / total, 100.0):.2f}"
+
+    def render(self):
+        total = self.total or 1
+        percentage = min(self.current * 100 / total, 100.0)
+        speed = self.speed or 0
+        eta = round((total - self.current) / speed) if speed > 0 else 0
+        filled_blocks = math.floor(percentage / 100 * 10)
+        return (
+            f"**{self.ud_type}**\n\n"
+            f"**Progress**: `{'█' * filled_blocks}{' ' * (10 - filled_blocks)}` `{percentage:.2f}%`\n"
+            f"**Size**: `{humanbytes(self.current)}` / `{humanbytes(self.total)}`\n"
+            f"**Speed**: `{humanbytes(speed)}/s`\n"
+            f"**ETA**: `{TimeFormatter(eta)}`\n"
+            f"**Elapsed**: `{TimeFormatter(round(time.monotonic() - self.started_at))}`"
         )
-        
+
+    async def _edit_later(self, delay: float):
+        if delay:
+            await asyncio.sleep(delay)
+        if self._closed:
+            return
+        key = self._key()
+        self._next_edit = time.monotonic() + self.min_interval
+        if key == self._last_key:
+            return
         try:
-            await message.edit_text(
-                text=progress_string
-            )
+            await self.message.edit_text(text=self.render())
+            self._last_key = key
+        except FloodWait as e:
+            self._next_edit = time.monotonic() + e.value
+            logger.debug(f"Progress updates paused for {e.value}s (FloodWait).")
         except Exception as e:
-            # Suppress frequent errors if message doesn't need modification
-            # or if Telegram API limits are hit, but log for debugging
-            logger.debug(f"Error updating progress message: {e}") 
+            logger.debug(f"Error updating progress message: {e}")
+
+    def close(self):
+        """Stops pending edits, so they cannot overwrite the status that follows the transfer."""
+        self._closed = True
+        if self._task and not self._task.done():
+            self._task.cancel()
+
 
 def humanbytes(size):
     """Converts bytes to human-readable format."""
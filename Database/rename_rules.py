@@ -0,0 +1,175 @@
+import asyncio
+import functools
+import os
+import re
+import regex
+from pyrogram import Client
+from pyrogram.types import Message
+from database import db
+from pipeline import submit_rename
+from config import MAX_RENAME_RULES
+from logger import logger # Import logger
+
+# Per-user auto-rename rules.
+# Rules live on the user document (`rename_rules`, a list of small dicts) and run in order on the
+# file name without its extension. With `auto_rename` on, detected files skip the
+# "send the new name" prompt and go straight into the job queue.
+#
+# Rule types:
+#   {"type": "replace", "pattern": <regex>, "repl": <text>}  - re.sub on the name
+#   {"type": "strip_tags"}                                  - drop [..], (..), {..} tags and @mentions
+#   {"type": "prefix", "text": <text>}                      - prepend text
+#   {"type": "suffix", "text": <text>}                      - append text (before the extension)
+#   {"type": "case", "mode": "lower" | "upper" | "title"}   - normalize case
+#
+# User regexes run with the `regex` module in a worker thread, each with a RULE_TIMEOUT. A pattern
+# that backtracks catastrophically (e.g. `(a+)+$`) times out instead of freezing the bot; it is
+# skipped, and try_auto_rename removes it from the user's rules.
+
+RULE_TYPES = ("replace", "strip_tags", "prefix", "suffix", "case")
+CASE_MODES = ("lower", "upper", "title")
+MAX_PATTERN_LENGTH = 200
+RULE_TIMEOUT = 0.1 # Seconds one replace rule may take on one name
+_TAGS = re.compile(r"\[[^\]]*\]|\([^)]*\)|\{[^}]*\}|@\w+")
+_SPACES = re.compile(r"\s{2,}")
+
+RULES_HELP = (
+    "`/addrule replace <regex> => <replacement>` (quote it to keep spaces: `=> \" \"`)\n"
+    "`/addrule strip_tags` - remove [tags], (tags), {tags} and @mentions\n"
+    "`/addrule prefix <text>`\n"
+    "`/addrule suffix <text>`\n"
+    "`/addrule case lower|upper|title`"
+)
+
+
+def parse_rule(text: str):
+    """Parses the arguments of /addrule into a rule dict. Raises ValueError with a user-facing message."""
+    rule_type, _, args = text.strip().partition(" ")
+    rule_type = rule_type.lower()
+    args = args.strip()
+    if rule_type == "replace":
+        pattern, separator, repl = args.partition("=>")
+        pattern, repl = pattern.strip(), repl.strip()
+        if len(repl) >= 2 and repl[0] == repl[-1] == '"':
+            repl = repl[1:-1] # Quotes allow leading/trailing spaces, e.g. => " "
+        if not separator or not pattern:
+            raise ValueError("Use `/addrule replace <regex> => <replacement>`.")
+        if len(pattern) > MAX_PATTERN_LENGTH:
+            raise ValueError(f"Patterns are limited to {MAX_PATTERN_LENGTH} characters.")
+        try:
+            regex.compile(pattern)
+        except regex.error as e:
+            raise ValueError(f"Invalid regex: {e}")
+        return {"type": "replace", "pattern": pattern, "repl": repl}
+    if rule_type == "strip_tags":
+        return {"type": "strip_tags"}
+    if rule_type in ("prefix", "suffix"):
+        if not args:
+            raise ValueError(f"Use `/addrule {rule_type} <text>`.")
+        return {"type": rule_type, "text": args}
+    if rule_type == "case":
+        if args.lower() not in CASE_MODES:
+            raise ValueError("Use `/addrule case lower`, `upper` or `title`.")
+        return {"type": "case", "mode": args.lower()}
+    raise ValueError(f"Unknown rule type `{rule_type}`. Available: {', '.join(RULE_TYPES)}.")
+
+
+def describe_rule(rule: dict):
+    if rule["type"] == "replace":
+        return f"replace `{rule['pattern']}` => `{rule['repl']}`"
+    if rule["type"] in ("prefix", "suffix"):
+        return f"{rule['type']} `{rule['text']}`"
+    if rule["type"] == "case":
+        return f"case {rule['mode']}"
+    return rule["type"]
+
+
+def _rules_key(rules):
+    """A hashable form of a rule list, used as the compile cache key."""
+    return tuple(tuple(sorted(rule.items())) for rule in rules)
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile(rules_key: tuple):
+    """Turns a rule list into a list of str -> str steps. Cached, so each distinct rule set is compiled once."""
+    steps = []
+    for items in rules_key:
+        rule = dict(items)
+        if rule["type"] == "replace":
+            pattern = regex.compile(rule["pattern"])
+            # concurrent=True releases the GIL, so a slow match does not stall the event loop thread either
+            steps.append(functools.partial(pattern.sub, rule["repl"], concurrent=True, timeout=RULE_TIMEOUT))
+        elif rule["type"] == "strip_tags":
+            steps.append(lambda name: _TAGS.sub("", name))
+        elif rule["type"] == "prefix":
+            steps.append(lambda name, text=rule["text"]: text + name)
+        elif rule["type"] == "suffix":
+            steps.append(lambda name, text=rule["text"]: name + text)
+        elif rule["type"] == "case":
+            steps.append(getattr(str, rule["mode"]))
+    return steps
+
+
+def _apply_rules(rules: list, original_name: str, timed_out: list):
+    stem, ext = os.path.splitext(original_name)
+    try:
+        for rule, step in zip(rules, _compile(_rules_key(rules))):
+            try:
+                stem = step(stem)
+            except TimeoutError:
+                logger.warning(f"Auto-rename: Rule {rule} timed out on {original_name}, skipping it.")
+                timed_out.append(rule)
+    except (regex.error, IndexError) as e: # e.g. a replacement referring to a missing group
+        logger.warning(f"Auto-rename: Could not apply rules to {original_name}: {e}")
+        return None
+    stem = _SPACES.sub(" ", stem).strip(" ._-")
+    return f"{stem}{ext}" if stem else None
+
+
+async def apply_rules(rules: list, original_name: str):
+    """
+    Runs `rules` on the name (keeping the extension) in a worker thread.
+    Returns (new name or None if nothing is left, rules that timed out and were skipped).
+    """
+    timed_out = []
+    new_name = await asyncio.to_thread(_apply_rules, rules, original_name, timed_out)
+    return new_name, timed_out
+
+
+async def drop_rules(user_id: int, rules: list, dropped: list):
+    """Removes rules that timed out from the user's rules. Returns the remaining rules."""
+    remaining = [rule for rule in rules if rule not in dropped]
+    await db.update_user_field(user_id, "rename_rules", remaining)
+    logger.warning(f"User {user_id}: Removed {len(rules) - len(remaining)} rename rule(s) that timed out.")
+    return remaining
+
+
+async def try_auto_rename(client: Client, message: Message, user_data: dict, active_op: dict):
+    """
+    Queues the detected file straight away if the user has auto-rename on.
+    Returns True if the file was handled (queued, or rejected by the daily limit).
+    """
+    rules = user_data.get("rename_rules") or []
+    if not user_data.get("auto_rename") or not rules:
+        return False
+    user_id = message.from_user.id
+    new_name, timed_out = await apply_rules(rules[:MAX_RENAME_RULES], active_op["original_name"])
+    if timed_out:
+        await drop_rules(user_id, rules, timed_out)
+        await message.reply_text(
+            "These rules took too long and were removed:\n" + "\n".join(describe_rule(rule) for rule in timed_out)
+        )
+    if not new_name:
+        return False
+
+    reserved_user = await db.reserve_upload(user_id, active_op["file_size"])
+    if not reserved_user:
+        await message.reply_text(
+            "Your daily upload limit has been reached. "
+            "Please upgrade your plan or try again tomorrow."
+        )
+        return True
+    logger.info(f"User {user_id}: Auto-renaming {active_op['original_name']} to {new_name}.")
+    await message.reply_text(f"Auto-rename: `{active_op['original_name']}` → `{new_name}`\n\nTurn it off with /autorename off.")
+    await submit_rename(client, message, reserved_user, active_op, new_name)
+    return True
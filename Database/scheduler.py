@@ -0,0 +1,379 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+from config import MAX_CONCURRENT_JOBS, PLAN_PRIORITY_WEIGHTS, STARVATION_SECONDS
+from logger import logger # Import logger
+
+# Global job scheduler for file transfers.
+# A bounded number of jobs run at once across the whole bot (MAX_CONCURRENT_JOBS), and each
+# user can only occupy as many running slots as their plan's `parallel_processes` allows.
+# Jobs that cannot start yet wait in per-plan queues served by weighted fair queuing:
+# each plan advances a virtual clock by 1/weight per started job and the plan with the
+# lowest clock goes next, so with weights 1/3/6 a gold job starts six times as often as a
+# free one under contention. Any job waiting longer than STARVATION_SECONDS goes first.
+#
+# The scheduler is also the job registry used for cancellation. Every job carries a CancelToken:
+# `cancel` drops a queued job from its queue (calling its `on_cancel` so it can release what it
+# holds), and for a running job sets the token, which the job checks from its progress callback and
+# transfer loops. A running job that has not reacted to its token after CANCEL_GRACE_SECONDS has its
+# task cancelled. A job that has seen the token (or is already running its cleanup) is left alone, so
+# its cleanup (status edit, quota release, journal) is never cut short.
+#
+# A job may also need `resources` besides a slot (e.g. scratch disk space, see diskspace.py): an object
+# with `fits()`, `acquire()` and `release()`. The job only starts once they fit; while a queued job is
+# waiting for them the dispatcher looks again every RESOURCE_RETRY_SECONDS.
+#
+# Work outside the scheduler that still transfers for a user (a prefetch, see prefetch.py) takes one
+# of the user's slots with `hold`. A job that takes over that work is created with the SlotHold and
+# starts on the held slot instead of waiting for another one.
+
+CANCEL_GRACE_SECONDS = 1.0
+RESOURCE_RETRY_SECONDS = 5.0
+
+
+class JobCancelled(Exception):
+    """Raised inside a job once its CancelToken is set."""
+
+
+class CancelToken:
+    def __init__(self):
+        self.reason = None
+        self.observed = False # The job has seen the cancellation or is already cleaning up
+        self._event = asyncio.Event()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled"):
+        if not self._event.is_set():
+            self.reason = reason
+            self._event.set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            self.observed = True
+            raise JobCancelled(self.reason)
+
+    def observe(self):
+        """Tells the scheduler the job is stopping on its own (e.g. in its cleanup), so it is not force-cancelled."""
+        self.observed = True
+
+    async def wait(self):
+        await self._event.wait()
+
+
+class SlotHold:
+    """One of a user's slots taken by work outside the scheduler. `release` frees it (idempotent)."""
+
+    def __init__(self, scheduler, user_id: int):
+        self.scheduler = scheduler
+        self.user_id = user_id
+        self.active = True
+
+    def release(self):
+        if self.active:
+            self.active = False
+            self.scheduler._release_hold(self)
+
+
+class Job:
+    """
+    A unit of work for the scheduler. `run` is a coroutine function called with the job itself;
+    it may return False to report a failure it has already handled.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(self, user_id: int, slots: int, run, on_position=None, plan: str = "free", on_cancel=None, resources=None, slot_hold=None):
+        self.id = next(self._ids)
+        self.user_id = user_id
+        self.plan = plan
+        self.slots = max(1, int(slots or 1))
+        self.run = run
+        self.on_position = on_position # Optional coroutine function called with the 1-based queue position
+        self.on_cancel = on_cancel # Optional coroutine function called if the job is cancelled before it starts
+        self.token = CancelToken()
+        self.resources = resources # Optional, acquired when the job starts and released when it ends
+        self.slot_hold = slot_hold # Optional SlotHold the job starts on (e.g. of the prefetch it takes over)
+        self.enqueued_at = time.monotonic()
+        self.started_at = None
+        self.task = None
+        self._last_position = None
+
+    @property
+    def wait_time(self):
+        end = self.started_at if self.started_at is not None else time.monotonic()
+        return end - self.enqueued_at
+
+
+class JobScheduler:
+    def __init__(self, max_workers: int, weights: dict, starvation_seconds: float):
+        self.max_workers = max(1, max_workers)
+        self.weights = weights
+        self.starvation_seconds = starvation_seconds
+        self.queues = {} # plan -> deque of queued jobs, oldest first
+        self.virtual_time = {} # plan -> virtual finish time of its last started job
+        self.clock = 0.0 # virtual time of the last started job, so idle plans cannot bank credit
+        self.running = {} # job id -> Job
+        self.user_running = {} # user id -> number of running jobs
+        self.user_held = {} # user id -> number of slots taken by SlotHolds
+        # Metrics
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.starvation_promotions = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.plan_wait = {} # plan -> [started jobs, total wait]
+        self.resource_waits = 0 # Dispatch passes in which a job could only not start for lack of resources
+        self._retry = None
+        self._blocked = False
+
+    def weight(self, plan: str):
+        return max(float(self.weights.get(plan, self.weights.get("free", 1))), 0.001)
+
+    @property
+    def pending(self):
+        """All queued jobs, oldest first (for metrics and lookups)."""
+        return sorted((job for queue in self.queues.values() for job in queue), key=lambda job: job.enqueued_at)
+
+    def submit(self, job: Job):
+        """Queues a job and starts whatever can run. Returns the job's queue position (0 if it started)."""
+        self.submitted += 1
+        queue = self.queues.setdefault(job.plan, deque())
+        if not queue:
+            # A plan that was idle rejoins at the current virtual time
+            self.virtual_time[job.plan] = max(self.virtual_time.get(job.plan, 0.0), self.clock)
+        queue.append(job)
+        self._dispatch()
+        return self.position(job)
+
+    def position(self, job: Job):
+        """Estimated 1-based position in the dispatch order, or 0 if the job is running or finished."""
+        for position, queued in enumerate(self._dispatch_order(), start=1):
+            if queued is job:
+                return position
+        return 0
+
+    def user_jobs(self, user_id: int):
+        """Counts (running, queued) jobs for a user."""
+        queued = sum(1 for queue in self.queues.values() for job in queue if job.user_id == user_id)
+        return self.user_running.get(user_id, 0), queued
+
+    def slots_in_use(self, user_id: int):
+        """The user's slots taken by running jobs and SlotHolds."""
+        return self.user_running.get(user_id, 0) + self.user_held.get(user_id, 0)
+
+    def hold(self, user_id: int, slots: int):
+        """Takes one of the user's `slots` for work outside the scheduler. Returns a SlotHold, or None if all are busy."""
+        if self.slots_in_use(user_id) >= max(1, int(slots or 1)):
+            return None
+        self.user_held[user_id] = self.user_held.get(user_id, 0) + 1
+        return SlotHold(self, user_id)
+
+    def _drop_hold(self, user_id: int):
+        remaining = self.user_held.get(user_id, 1) - 1
+        if remaining > 0:
+            self.user_held[user_id] = remaining
+        else:
+            self.user_held.pop(user_id, None)
+
+    def _release_hold(self, hold: SlotHold):
+        self._drop_hold(hold.user_id)
+        self._dispatch() # A queued job of the user may start now
+
+    def find(self, job_id: int):
+        """The running or queued job with this id, or None."""
+        if job_id in self.running:
+            return self.running[job_id]
+        return next((job for queue in self.queues.values() for job in queue if job.id == job_id), None)
+
+    def jobs_for(self, user_id: int):
+        """A user's running jobs followed by their queued ones."""
+        running = [job for job in self.running.values() if job.user_id == user_id]
+        return running + [job for job in self.pending if job.user_id == user_id]
+
+    def cancel(self, job: Job, reason: str = "cancelled by user"):
+        """Cancels a queued or running job. Returns False if it had already finished or been cancelled."""
+        if job.token.cancelled:
+            return False
+        queue = self.queues.get(job.plan)
+        if queue is not None and job in queue:
+            queue.remove(job)
+            job.token.cancel(reason)
+            self.cancelled += 1
+            logger.info(f"Scheduler: Removed queued job {job.id} for user {job.user_id} ({reason}).")
+            if job.on_cancel:
+                asyncio.create_task(self._safe_call(job, job.on_cancel))
+            self._notify_positions()
+            return True
+        if job.id in self.running:
+            job.token.cancel(reason)
+            self.cancelled += 1
+            logger.info(f"Scheduler: Cancelling running job {job.id} for user {job.user_id} ({reason}).")
+            asyncio.get_running_loop().call_later(CANCEL_GRACE_SECONDS, self._force_cancel, job)
+            return True
+        return False
+
+    def cancel_user(self, user_id: int, reason: str = "cancelled by user"):
+        """Cancels every running and queued job of a user. Returns how many were cancelled."""
+        return sum(1 for job in self.jobs_for(user_id) if self.cancel(job, reason))
+
+    def _force_cancel(self, job: Job):
+        """Stops a job that did not react to its token (e.g. stuck in a network call)."""
+        if job.token.observed:
+            return # Stopping by itself; cancelling now would interrupt its cleanup
+        if job.id in self.running and job.task and not job.task.done():
+            logger.warning(f"Scheduler: Job {job.id} did not stop within {CANCEL_GRACE_SECONDS}s, cancelling its task.")
+            job.task.cancel()
+
+    def _can_start(self, job: Job):
+        in_use = self.slots_in_use(job.user_id)
+        if job.slot_hold is not None and job.slot_hold.active:
+            in_use -= 1 # The job starts on its own held slot
+        if in_use >= job.slots:
+            return False
+        if job.resources is not None and not job.resources.fits():
+            self._blocked = True
+            return False
+        return True
+
+    def _next_job(self):
+        """Picks the next job to start, honouring starvation protection, plan weights and per-user slots."""
+        now = time.monotonic()
+        starving = [
+            job for queue in self.queues.values() for job in queue
+            if self._can_start(job) and now - job.enqueued_at >= self.starvation_seconds
+        ]
+        if starving:
+            self.starvation_promotions += 1
+            return min(starving, key=lambda job: job.enqueued_at)
+
+        best = None
+        for plan, queue in self.queues.items():
+            job = next((job for job in queue if self._can_start(job)), None)
+            if job is None:
+                continue
+            key = (self.virtual_time.get(plan, 0.0) + 1 / self.weight(plan), -self.weight(plan), job.enqueued_at)
+            if best is None or key < best[0]:
+                best = (key, job)
+        return best[1] if best else None
+
+    def _dispatch_order(self):
+        """Simulates the weighted order in which queued jobs would start (ignores per-user slots)."""
+        queues = {plan: list(queue) for plan, queue in self.queues.items() if queue}
+        virtual_time = dict(self.virtual_time)
+        order = []
+        while queues:
+            plan = min(queues, key=lambda p: (virtual_time.get(p, 0.0) + 1 / self.weight(p), -self.weight(p)))
+            virtual_time[plan] = virtual_time.get(plan, 0.0) + 1 / self.weight(plan)
+            order.append(queues[plan].pop(0))
+            if not queues[plan]:
+                del queues[plan]
+        return order
+
+    def _dispatch(self):
+        self._blocked = False
+        while len(self.running) < self.max_workers:
+            job = self._next_job()
+            if job is None:
+                break
+            self.queues[job.plan].remove(job)
+            finish = self.virtual_time.get(job.plan, 0.0) + 1 / self.weight(job.plan)
+            self.virtual_time[job.plan] = finish
+            self.clock = max(self.clock, finish - 1 / self.weight(job.plan))
+            self._start(job)
+        if self._blocked and self._retry is None:
+            # Freed space does not always come from a finishing job (e.g. the janitor), so look again later
+            self.resource_waits += 1
+            self._retry = asyncio.get_running_loop().call_later(RESOURCE_RETRY_SECONDS, self._retry_dispatch)
+        self._notify_positions()
+
+    def _retry_dispatch(self):
+        self._retry = None
+        self._dispatch()
+
+    def _start(self, job: Job):
+        job.started_at = time.monotonic()
+        wait = job.wait_time
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        plan_wait = self.plan_wait.setdefault(job.plan, [0, 0.0])
+        plan_wait[0] += 1
+        plan_wait[1] += wait
+        if job.resources is not None:
+            job.resources.acquire()
+        if job.slot_hold is not None and job.slot_hold.active:
+            job.slot_hold.active = False # The held slot becomes the job's running slot
+            self._drop_hold(job.user_id)
+        self.running[job.id] = job
+        self.user_running[job.user_id] = self.user_running.get(job.user_id, 0) + 1
+        logger.info(f"Scheduler: Starting job {job.id} for user {job.user_id} after {wait:.1f}s in queue.")
+        job.task = asyncio.create_task(self._run(job))
+
+    async def _run(self, job: Job):
+        try:
+            result = await job.run(job)
+            if result is False:
+                if not job.token.cancelled: # Cancelled jobs are already counted in `cancelled`
+                    self.failed += 1
+            else:
+                self.completed += 1
+                if job.token.cancelled:
+                    self.cancelled -= 1 # Cancelled too late: it finished anyway
+        except asyncio.CancelledError:
+            if not job.token.cancelled:
+                self.failed += 1
+            raise
+        except JobCancelled:
+            logger.info(f"Scheduler: Job {job.id} for user {job.user_id} stopped after cancellation.")
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Scheduler: Job {job.id} for user {job.user_id} failed: {e}", exc_info=True)
+        finally:
+            if job.resources is not None:
+                job.resources.release()
+            self.running.pop(job.id, None)
+            remaining = self.user_running.get(job.user_id, 1) - 1
+            if remaining > 0:
+                self.user_running[job.user_id] = remaining
+            else:
+                self.user_running.pop(job.user_id, None)
+            self._dispatch()
+
+    def _notify_positions(self):
+        for position, job in enumerate(self._dispatch_order(), start=1):
+            if job.on_position and job._last_position != position:
+                job._last_position = position
+                asyncio.create_task(self._safe_call(job, job.on_position, position))
+
+    @staticmethod
+    async def _safe_call(job: Job, callback, *args):
+        try:
+            await callback(*args)
+        except Exception as e:
+            logger.debug(f"Scheduler: Callback for job {job.id} of user {job.user_id} failed: {e}")
+
+    def stats(self):
+        started = sum(count for count, _ in self.plan_wait.values())
+        return {
+            "running": len(self.running),
+            "held": sum(self.user_held.values()),
+            "queued": len(self.pending),
+            "max_workers": self.max_workers,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "avg_wait": (self.total_wait / started) if started else 0.0,
+            "max_wait": self.max_wait,
+            "starvation_promotions": self.starvation_promotions,
+            "resource_waits": self.resource_waits,
+            "plan_avg_wait": {plan: total / count for plan, (count, total) in self.plan_wait.items() if count},
+        }
+
+
+scheduler = JobScheduler(MAX_CONCURRENT_JOBS, PLAN_PRIORITY_WEIGHTS, STARVATION_SECONDS)
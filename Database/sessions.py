@@ -0,0 +1,123 @@
+import datetime
+import time
+from config import SESSION_BACKEND, SESSION_TTL
+from database import db
+from logger import logger # Import logger
+
+# Conversation state (e.g. "waiting_for_new_name", "waiting_for_thumbnail", "waiting_for_global_caption")
+# lives in a session store instead of the user document, so text/photo messages can be routed
+# without a database round trip on single-node deployments.
+#
+# Backends:
+#   "memory" - per-process dict with TTL expiry (default, single instance)
+#   "mongo"  - "sessions" collection with a TTL index, shared by several bot instances
+
+
+class SessionStore:
+    """Base class for session backends. Sessions are small dicts keyed by user ID."""
+
+    def __init__(self, ttl: int):
+        self.ttl = ttl
+
+    async def setup(self):
+        """Prepares the backend (indexes etc.). Called once at startup."""
+
+    async def get(self, user_id: int):
+        raise NotImplementedError
+
+    async def set(self, user_id: int, data: dict):
+        raise NotImplementedError
+
+    async def clear(self, user_id: int):
+        raise NotImplementedError
+
+    async def get_state(self, user_id: int):
+        session = await self.get(user_id)
+        return session.get("state") if session else None
+
+    async def set_state(self, user_id: int, state: str, **extra):
+        """Replaces the user's session with a new state (plus any extra context)."""
+        await self.set(user_id, {"state": state, **extra})
+
+    async def clear_state(self, user_id: int):
+        await self.clear(user_id)
+
+
+class MemorySessionStore(SessionStore):
+    """In-process session store. Expired sessions are dropped on access and by periodic sweeps."""
+
+    SWEEP_EVERY = 500 # Writes between full sweeps of expired sessions
+
+    def __init__(self, ttl: int):
+        super().__init__(ttl)
+        self._sessions = {} # user_id -> (expires_at, data)
+        self._writes = 0
+
+    async def get(self, user_id: int):
+        entry = self._sessions.get(user_id)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._sessions[user_id]
+            return None
+        return entry[1]
+
+    async def set(self, user_id: int, data: dict):
+        self._sessions[user_id] = (time.monotonic() + self.ttl, data)
+        self._writes += 1
+        if self._writes % self.SWEEP_EVERY == 0:
+            self._sweep()
+
+    async def clear(self, user_id: int):
+        self._sessions.pop(user_id, None)
+
+    def _sweep(self):
+        now = time.monotonic()
+        expired = [user_id for user_id, (expires_at, _) in self._sessions.items() if expires_at < now]
+        for user_id in expired:
+            del self._sessions[user_id]
+        if expired:
+            logger.debug(f"Session store: swept {len(expired)} expired sessions.")
+
+
+class MongoSessionStore(SessionStore):
+    """Session store backed by a MongoDB collection with a TTL index, for multi-instance deployments."""
+
+    def __init__(self, ttl: int, collection):
+        super().__init__(ttl)
+        self.collection = collection
+
+    async def setup(self):
+        await self.collection.create_index("expires_at", expireAfterSeconds=0)
+
+    async def get(self, user_id: int):
+        doc = await self.collection.find_one({"_id": user_id})
+        # MongoDB's TTL monitor runs about once a minute, so check expiry ourselves as well
+        if not doc or doc["expires_at"] < datetime.datetime.utcnow():
+            return None
+        return doc.get("data")
+
+    async def set(self, user_id: int, data: dict):
+        await self.collection.replace_one(
+            {"_id": user_id},
+            {"data": data, "expires_at": datetime.datetime.utcnow() + datetime.timedelta(seconds=self.ttl)},
+            upsert=True
+        )
+
+    async def clear(self, user_id: int):
+        await self.collection.delete_one({"_id": user_id})
+
+
+def create_session_store():
+    if SESSION_BACKEND == "mongo":
+        if db.db is None:
+            logger.warning("SESSION_BACKEND is 'mongo' but MongoDB is not available, using in-memory sessions.")
+        else:
+            logger.info("Using MongoDB session store.")
+            return MongoSessionStore(SESSION_TTL, db.db["sessions"])
+    elif SESSION_BACKEND != "memory":
+        logger.warning(f"Unknown SESSION_BACKEND '{SESSION_BACKEND}', using in-memory sessions.")
+    return MemorySessionStore(SESSION_TTL)
+
+
+sessions = create_session_store()
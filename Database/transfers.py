@@ -0,0 +1,225 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import time
+from pyrogram.errors import FloodWait, InternalServerError
+from database import db
+from utils import create_job_dir
+from downloader import CHUNK_SIZE
+from config import DOWNLOAD_DIR, TRANSFER_RETRIES, TRANSFER_RETRY_BACKOFF, CHECKPOINT_TTL, CHECKPOINT_FLUSH_SECONDS
+from logger import logger # Import logger
+
+# Resumable transfers.
+# A rename job records which download chunks and upload parts are done in a checkpoint, kept in a
+# local journal file next to the partial download (written on every chunk) and in the
+# "transfer_checkpoints" collection (written every CHECKPOINT_FLUSH_SECONDS). Transient errors are
+# retried with exponential backoff and continue from the checkpoint; after a failure or restart,
+# sending the same file with the same new name again resumes the transfer instead of starting over.
+# Uploads resume under the same upload id, because Telegram keeps uploaded parts for about a day.
+
+JOURNAL_NAME = "journal.json"
+
+
+def _to_ranges(indices):
+    """Packs a set of chunk indices into [[start, end], ...] (inclusive) to keep checkpoints small."""
+    ranges = []
+    for index in sorted(indices):
+        if ranges and index == ranges[-1][1] + 1:
+            ranges[-1][1] = index
+        else:
+            ranges.append([index, index])
+    return ranges
+
+
+def _from_ranges(ranges):
+    return {index for start, end in (ranges or []) for index in range(start, end + 1)}
+
+
+def checkpoint_key(user_id: int, active_op: dict, new_name: str):
+    file_key = (active_op.get("media") or {}).get("file_unique_id") or active_op["file_id"]
+    digest = hashlib.sha1(f"{user_id}:{file_key}:{new_name}".encode("utf-8")).hexdigest()[:20]
+    return f"{user_id}_{digest}"
+
+
+class TransferCheckpoint:
+    """Progress of one resumable rename job."""
+
+    def __init__(self, store, key: str, directory: str, file_size: int):
+        self.store = store
+        self.key = key
+        self.directory = directory
+        self.file_size = file_size
+        self.downloaded = set() # Indices of completed download chunks
+        self.upload_id = None
+        self.uploaded = set() # Indices of completed upload parts
+        self._last_flush = 0.0
+
+    @property
+    def journal_path(self):
+        return os.path.join(self.directory, JOURNAL_NAME)
+
+    def to_dict(self):
+        return {
+            "directory": self.directory,
+            "file_size": self.file_size,
+            "downloaded": _to_ranges(self.downloaded),
+            "upload_id": self.upload_id,
+            "uploaded": _to_ranges(self.uploaded),
+        }
+
+    def load(self, data: dict):
+        self.downloaded = _from_ranges(data.get("downloaded"))
+        self.upload_id = data.get("upload_id")
+        self.uploaded = _from_ranges(data.get("uploaded"))
+
+    async def mark_downloaded(self, index: int):
+        self.downloaded.add(index)
+        await self.save()
+
+    async def mark_uploaded(self, index: int):
+        self.uploaded.add(index)
+        await self.save()
+
+    async def mark_download_complete(self):
+        """Marks every chunk as downloaded (the file was provided by other means, e.g. a prefetch)."""
+        self.downloaded = set(range(max(1, -(-self.file_size // CHUNK_SIZE))))
+        await self.save()
+
+    def reset_upload(self, upload_id: int):
+        self.upload_id = upload_id
+        self.uploaded = set()
+
+    async def save(self, force: bool = False):
+        """Writes the local journal, and MongoDB at most every CHECKPOINT_FLUSH_SECONDS unless `force`."""
+        data = self.to_dict()
+        temp_path = self.journal_path + ".tmp"
+        with open(temp_path, "w") as journal:
+            json.dump(data, journal)
+        os.replace(temp_path, self.journal_path) # Atomic, so a crash never leaves a half-written journal
+
+        now = time.monotonic()
+        if force or now - self._last_flush >= CHECKPOINT_FLUSH_SECONDS:
+            self._last_flush = now
+            await self.store.persist(self.key, data)
+
+
+class CheckpointStore:
+    def __init__(self, collection, ttl: int):
+        self.collection = collection
+        self.ttl = ttl
+        self.active = set() # Keys of checkpoints used by running jobs
+        self.directories = set() # Scratch directories of running jobs (the janitor never touches these)
+
+    async def setup(self):
+        if self.collection is not None:
+            await self.collection.create_index("updated_at", expireAfterSeconds=self.ttl)
+
+    async def open(self, user_id: int, active_op: dict, new_name: str, job_id, root: str = DOWNLOAD_DIR):
+        """
+        Returns the checkpoint for this user/file/new name, resuming earlier progress if there is any.
+        A second job for the same transfer while the first is still running gets a fresh, isolated one.
+        The scratch directory is created under `root` (the scratch tier the job was given).
+        """
+        key = checkpoint_key(user_id, active_op, new_name)
+        if key in self.active:
+            directory = create_job_dir(user_id, job_id, root)
+            self.directories.add(directory)
+            return TransferCheckpoint(self, f"{key}_{job_id}", directory, active_op["file_size"])
+        self.active.add(key)
+
+        directory = os.path.join(os.path.abspath(root), key)
+        self.directories.add(directory)
+        checkpoint = TransferCheckpoint(self, key, directory, active_op["file_size"])
+        data = None
+        if os.path.exists(checkpoint.journal_path):
+            try:
+                with open(checkpoint.journal_path) as journal:
+                    data = json.load(journal)
+            except (OSError, ValueError) as e:
+                logger.warning(f"Checkpoints: Ignoring unreadable journal {checkpoint.journal_path}: {e}")
+        if data is None and self.collection is not None:
+            data = await self.collection.find_one({"_id": key})
+            if data:
+                # The partial file did not survive (e.g. a new container), but uploaded parts still count
+                data["downloaded"] = []
+
+        os.makedirs(directory, exist_ok=True)
+        if data and data.get("file_size") == checkpoint.file_size:
+            checkpoint.load(data)
+            logger.info(
+                f"Checkpoints: Resuming {key}: {len(checkpoint.downloaded)} chunks downloaded, "
+                f"{len(checkpoint.uploaded)} parts uploaded."
+            )
+        return checkpoint
+
+    async def persist(self, key: str, data: dict):
+        if self.collection is None:
+            return
+        try:
+            await self.collection.update_one(
+                {"_id": key},
+                {"$set": {**data, "updated_at": datetime.datetime.utcnow()}},
+                upsert=True
+            )
+        except Exception as e:
+            logger.warning(f"Checkpoints: Could not persist checkpoint {key}: {e}")
+
+    async def release(self, checkpoint: TransferCheckpoint, completed: bool, discard: bool = False):
+        """
+        Called when the job ends. Completed transfers drop their checkpoint and files; failed ones
+        that made progress are flushed and kept so the next attempt can resume, unless `discard`
+        is set (the user cancelled the job).
+        """
+        self.active.discard(checkpoint.key)
+        self.directories.discard(checkpoint.directory)
+        if not completed and not discard and (checkpoint.downloaded or checkpoint.uploaded):
+            await checkpoint.save(force=True)
+            return
+        shutil.rmtree(checkpoint.directory, ignore_errors=True)
+        if self.collection is not None:
+            try:
+                await self.collection.delete_one({"_id": checkpoint.key})
+            except Exception as e:
+                logger.warning(f"Checkpoints: Could not delete checkpoint {checkpoint.key}: {e}")
+
+    async def discard(self, key: str, directory: str = None):
+        """Removes a checkpoint that no job holds any more (e.g. of a job abandoned after a restart)."""
+        shutil.rmtree(directory or os.path.join(os.path.abspath(DOWNLOAD_DIR), key), ignore_errors=True)
+        if self.collection is not None:
+            try:
+                await self.collection.delete_one({"_id": key})
+            except Exception as e:
+                logger.warning(f"Checkpoints: Could not delete checkpoint {key}: {e}")
+
+
+async def with_retries(action, description: str, status_message=None):
+    """
+    Runs the coroutine function `action`, retrying transient failures (FloodWait, Telegram 5xx,
+    dropped connections) up to TRANSFER_RETRIES times with exponential backoff.
+    `action` is expected to continue from its checkpoint, so a retry does not redo finished chunks.
+    """
+    for attempt in range(TRANSFER_RETRIES + 1):
+        try:
+            return await action()
+        except FloodWait as e:
+            error, delay = e, e.value
+        except (InternalServerError, ConnectionError, asyncio.TimeoutError) as e:
+            error, delay = e, TRANSFER_RETRY_BACKOFF * 2 ** attempt
+        if attempt == TRANSFER_RETRIES:
+            raise error
+        logger.warning(f"{description} interrupted ({error}), retrying in {delay}s (attempt {attempt + 1}/{TRANSFER_RETRIES}).")
+        if status_message:
+            try:
+                await status_message.edit_text(
+                    f"{description} was interrupted. Resuming in {delay} seconds "
+                    f"(retry {attempt + 1}/{TRANSFER_RETRIES})..."
+                )
+            except Exception:
+                pass
+        await asyncio.sleep(delay)
+
+
+checkpoints = CheckpointStore(db.db["transfer_checkpoints"] if db.db is not None else None, CHECKPOINT_TTL)
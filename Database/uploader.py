@@ -0,0 +1,214 @@
+import asyncio
+import hashlib
+import inspect
+import math
+import os
+import time
+from pyrogram import Client, raw, types
+from pyrogram import utils as pyrogram_utils
+from pyrogram.errors import FloodWait, InternalServerError
+from mtproto import media_pool, TransferMetrics
+from config import UPLOAD_PART_RETRIES
+from logger import logger # Import logger
+
+# Low-level upload helpers built on raw MTProto calls.
+# Unlike `client.send_document(path)`, these accept the file as an async stream of bytes with a
+# known total size, so an upload can start before the whole file exists on disk (`upload_stream`),
+# or spread the parts of a file on disk over several pooled connections (`upload_file`).
+
+PART_SIZE = 512 * 1024 # Maximum part size accepted by upload.saveFilePart / saveBigFilePart
+BIG_FILE_THRESHOLD = 10 * 1024 * 1024 # Files above this must use saveBigFilePart
+
+upload_metrics = TransferMetrics()
+
+
+async def iter_parts(chunks, part_size: int = PART_SIZE):
+    """Re-slices an async iterator of arbitrary-sized byte chunks into fixed-size upload parts."""
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer.extend(chunk)
+        while len(buffer) >= part_size:
+            yield bytes(buffer[:part_size])
+            del buffer[:part_size]
+    if buffer:
+        yield bytes(buffer)
+
+
+async def call_progress(progress, current: int, total: int):
+    if not progress:
+        return
+    if inspect.iscoroutinefunction(progress):
+        await progress(current, total)
+    else:
+        progress(current, total)
+
+
+async def upload_stream(client: Client, chunks, file_size: int, file_name: str, progress=None, throttle=None):
+    """
+    Uploads `file_size` bytes read from the async iterator `chunks` and returns the
+    InputFile/InputFileBig to attach to a message. `throttle(nbytes)` is awaited before every part.
+    """
+    upload_id = client.rnd_id()
+    is_big = file_size > BIG_FILE_THRESHOLD
+    total_parts = max(1, math.ceil(file_size / PART_SIZE))
+    md5 = hashlib.md5() if not is_big else None
+    uploaded = 0
+
+    part_index = -1
+    async for part_index, part in _enumerate(iter_parts(chunks)):
+        if md5:
+            md5.update(part)
+        if throttle:
+            await throttle(len(part))
+        await _save_part(client.invoke, _part_request(upload_id, part_index, total_parts, part, is_big), part_index, file_name)
+        uploaded += len(part)
+        await call_progress(progress, min(uploaded, file_size), file_size)
+
+    if part_index + 1 != total_parts:
+        raise RuntimeError(f"Stream for {file_name} ended after {part_index + 1} of {total_parts} parts")
+
+    logger.debug(f"Uploaded {file_name} in {total_parts} parts ({uploaded} bytes).")
+    if is_big:
+        return raw.types.InputFileBig(id=upload_id, parts=total_parts, name=file_name)
+    return raw.types.InputFile(id=upload_id, parts=total_parts, name=file_name, md5_checksum=md5.hexdigest())
+
+
+def _part_request(upload_id: int, part_index: int, total_parts: int, part: bytes, is_big: bool):
+    if is_big:
+        return raw.functions.upload.SaveBigFilePart(
+            file_id=upload_id, file_part=part_index, file_total_parts=total_parts, bytes=part
+        )
+    return raw.functions.upload.SaveFilePart(file_id=upload_id, file_part=part_index, bytes=part)
+
+
+async def _save_part(invoke, rpc, part_index: int, file_name: str):
+    """Sends one part, retrying it on its own (FloodWait, Telegram 5xx, dropped connection) before giving up."""
+    for attempt in range(UPLOAD_PART_RETRIES + 1):
+        try:
+            if await invoke(rpc):
+                return
+            error, delay = RuntimeError(f"Telegram rejected part {part_index} of {file_name}"), 2 ** attempt
+        except FloodWait as e:
+            error, delay = e, e.value
+        except (InternalServerError, ConnectionError, asyncio.TimeoutError) as e:
+            error, delay = e, 2 ** attempt
+        if attempt == UPLOAD_PART_RETRIES:
+            raise error
+        logger.debug(f"Part {part_index} of {file_name} failed ({error}), retrying in {delay}s.")
+        await asyncio.sleep(delay)
+
+
+async def upload_file(client: Client, path: str, file_name: str, checkpoint, connections: int = 1, progress=None, throttle=None):
+    """
+    Uploads the file at `path` and returns the InputFile/InputFileBig.
+    Parts are sent concurrently over up to `connections` media sessions from the shared pool, each
+    part retried on its own. Parts already recorded in `checkpoint` are skipped and the checkpoint's
+    upload id is reused, so an interrupted upload continues where it stopped.
+    `throttle(nbytes)` (a bandwidth.py limiter) is awaited before every part.
+    """
+    started_at = time.monotonic()
+    file_size = os.path.getsize(path)
+    is_big = file_size > BIG_FILE_THRESHOLD
+    total_parts = max(1, math.ceil(file_size / PART_SIZE))
+    if checkpoint.upload_id is None:
+        checkpoint.reset_upload(client.rnd_id())
+    else:
+        logger.info(f"Resuming upload of {file_name}: {len(checkpoint.uploaded)}/{total_parts} parts already on Telegram.")
+    upload_id = checkpoint.upload_id
+    resumed = min(len(checkpoint.uploaded) * PART_SIZE, file_size)
+    uploaded = resumed
+
+    if connections > 1 and total_parts > 1:
+        invokers = [session.invoke for session in await media_pool.get(client, await client.storage.dc_id(), connections)]
+    else:
+        invokers = [client.invoke]
+    missing = iter([index for index in range(total_parts) if index not in checkpoint.uploaded])
+
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        md5 = None
+        if not is_big:
+            # Small files need an MD5 of the whole file; they are at most BIG_FILE_THRESHOLD
+            md5 = hashlib.md5(os.pread(fd, file_size, 0))
+
+        async def worker(invoke):
+            nonlocal uploaded
+            for part_index in missing: # Shared iterator: each part is sent by exactly one worker
+                part = os.pread(fd, PART_SIZE, part_index * PART_SIZE)
+                if throttle:
+                    await throttle(len(part))
+                await _save_part(invoke, _part_request(upload_id, part_index, total_parts, part, is_big), part_index, file_name)
+                await checkpoint.mark_uploaded(part_index)
+                uploaded += len(part)
+                await call_progress(progress, min(uploaded, file_size), file_size)
+
+        workers = [asyncio.create_task(worker(invoke)) for invoke in invokers]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True) # Let them stop before the file is closed
+    finally:
+        os.close(fd)
+
+    speed = upload_metrics.record(file_size - resumed, started_at)
+    logger.info(f"Uploaded {file_name} in {total_parts} parts at {speed / (1024 * 1024):.2f} MB/s over {len(invokers)} connections.")
+    if is_big:
+        return raw.types.InputFileBig(id=upload_id, parts=total_parts, name=file_name)
+    return raw.types.InputFile(id=upload_id, parts=total_parts, name=file_name, md5_checksum=md5.hexdigest())
+
+
+async def _enumerate(aiterable):
+    index = 0
+    async for item in aiterable:
+        yield index, item
+        index += 1
+
+
+def build_input_media(input_file, file_type: str, file_name: str, mime_type: str, media: dict, thumb=None):
+    """Builds the raw InputMedia for an uploaded file, mirroring what send_document/video/audio/photo send."""
+    if file_type == "photo":
+        return raw.types.InputMediaUploadedPhoto(file=input_file)
+
+    attributes = [raw.types.DocumentAttributeFilename(file_name=file_name)]
+    if file_type == "video":
+        attributes.insert(0, raw.types.DocumentAttributeVideo(
+            supports_streaming=True,
+            duration=media.get("duration", 0),
+            w=media.get("width", 0),
+            h=media.get("height", 0)
+        ))
+        mime_type = mime_type or "video/mp4"
+    elif file_type == "audio":
+        attributes.insert(0, raw.types.DocumentAttributeAudio(
+            duration=media.get("duration", 0),
+            title=media.get("title"),
+            performer=media.get("performer")
+        ))
+        mime_type = mime_type or "audio/mpeg"
+
+    return raw.types.InputMediaUploadedDocument(
+        mime_type=mime_type or "application/octet-stream",
+        file=input_file,
+        thumb=thumb,
+        attributes=attributes
+    )
+
+
+async def send_uploaded_media(client: Client, chat_id, input_media, caption: str = None):
+    """Sends an InputMedia built by `build_input_media` and returns the parsed Message."""
+    result = await client.invoke(
+        raw.functions.messages.SendMedia(
+            peer=await client.resolve_peer(chat_id),
+            media=input_media,
+            random_id=client.rnd_id(),
+            **await pyrogram_utils.parse_text_entities(client, caption or "", None, None)
+        )
+    )
+    users = {user.id: user for user in result.users}
+    chats = {chat.id: chat for chat in result.chats}
+    for update in result.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await types.Message._parse(client, update.message, users, chats)
+    return None
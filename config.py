@@ -23,6 +23,14 @@ ADMINS = list(map(int, os.getenv("ADMINS", "").split(','))) if os.getenv("ADMINS
 MONGO_DB_URI = os.getenv("MONGO_DB_URI")
 DB_NAME = os.getenv("DB_NAME", "renamer_bot_db")
 
+# In-process cache of user documents (see Database.get_user)
+USER_CACHE_MAX_SIZE = int(os.getenv("USER_CACHE_MAX_SIZE", "5000")) # Max cached users, least recently used are evicted
+USER_CACHE_TTL = int(os.getenv("USER_CACHE_TTL", "300")) # Seconds before a cached user is re-read from MongoDB
+
+# Conversation state store: "memory" (single instance) or "mongo" (shared TTL collection for several instances)
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory").lower()
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600")) # Seconds before an idle conversation state expires
+
 # Ensure all essential configurations are present
 if not all([API_ID, API_HASH, BOT_TOKEN, MONGO_DB_URI]):
     raise ValueError(
@@ -43,6 +51,68 @@ SESSION_NAME = "file_renamer_bot"
 DOWNLOAD_DIR = "downloads/"
 THUMBNAIL_DIR = "thumbnails/"
 
+# --- JOB SCHEDULER ---
+# Max rename jobs running at once across all users. Per-user limits come from `parallel_processes` in the plan.
+MAX_CONCURRENT_JOBS = int(os.getenv("MAX_CONCURRENT_JOBS", "4"))
+# Share of job starts each plan gets when the queue is contended (weighted fair queuing, keyed on `current_plan`)
+PLAN_PRIORITY_WEIGHTS = {
+    "free": int(os.getenv("FREE_PRIORITY_WEIGHT", "1")),
+    "silver": int(os.getenv("SILVER_PRIORITY_WEIGHT", "3")),
+    "gold": int(os.getenv("GOLD_PRIORITY_WEIGHT", "6"))
+}
+# A queued job older than this starts next regardless of plan, so free users are never starved
+STARVATION_SECONDS = int(os.getenv("STARVATION_SECONDS", "600"))
+
+# --- TRANSFER SETTINGS ---
+# Streaming mode pipes downloaded chunks straight into the upload instead of writing the file to DOWNLOAD_DIR.
+# No scratch disk is used, but thumbnails cannot be generated from the video with FFmpeg in this mode.
+STREAM_RENAME = os.getenv("STREAM_RENAME", "False").lower() in ("true", "1", "yes")
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", "5")) # Min seconds between progress edits of one status message
+STREAM_BUFFER_CHUNKS = int(os.getenv("STREAM_BUFFER_CHUNKS", "8")) # 1 MiB chunks buffered between download and upload
+# Large downloads are split over several MTProto connections (raw upload.GetFile requests)
+PLAN_DOWNLOAD_CONNECTIONS = {
+    "free": int(os.getenv("FREE_DOWNLOAD_CONNECTIONS", "1")),
+    "silver": int(os.getenv("SILVER_DOWNLOAD_CONNECTIONS", "4")),
+    "gold": int(os.getenv("GOLD_DOWNLOAD_CONNECTIONS", "8"))
+}
+PARALLEL_DOWNLOAD_MIN_MB = int(os.getenv("PARALLEL_DOWNLOAD_MIN_MB", "20")) # Smaller files use a single stream
+MAX_MEDIA_CONNECTIONS = int(os.getenv("MAX_MEDIA_CONNECTIONS", "8")) # Extra media connections kept open per data center
+# Uploads spread file parts over a pool of media connections to the bot's DC (shares MAX_MEDIA_CONNECTIONS)
+UPLOAD_POOL_SIZE = int(os.getenv("UPLOAD_POOL_SIZE", "4")) # Connections per upload
+UPLOAD_PART_RETRIES = int(os.getenv("UPLOAD_PART_RETRIES", "3")) # Retries of a single failed part before the upload fails
+# Repeat renames (same file, new name and thumbnail) are answered by resending the earlier output
+DEDUP_ENABLED = os.getenv("DEDUP_ENABLED", "True").lower() in ("true", "1", "yes")
+DEDUP_TTL_DAYS = int(os.getenv("DEDUP_TTL_DAYS", "30")) # Entries unused for this long are evicted
+# Batch mode (/batch): many files renamed with one template
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "50"))
+# Auto-rename (/addrule, /autorename)
+MAX_RENAME_RULES = int(os.getenv("MAX_RENAME_RULES", "20"))
+# Interrupted transfers are retried from their last checkpoint (see Database/transfers.py)
+TRANSFER_RETRIES = int(os.getenv("TRANSFER_RETRIES", "3")) # Retries per download/upload after a transient error
+TRANSFER_RETRY_BACKOFF = int(os.getenv("TRANSFER_RETRY_BACKOFF", "5")) # Seconds before the first retry, doubled each time
+CHECKPOINT_TTL = int(os.getenv("CHECKPOINT_TTL", "86400")) # Seconds a failed transfer can be resumed (Telegram drops uploaded parts after about a day)
+CHECKPOINT_FLUSH_SECONDS = int(os.getenv("CHECKPOINT_FLUSH_SECONDS", "5")) # Min seconds between checkpoint writes to MongoDB
+# Jobs are journaled in MongoDB and requeued after a restart (see Database/jobs.py)
+JOB_RECOVERY_ATTEMPTS = int(os.getenv("JOB_RECOVERY_ATTEMPTS", "2")) # Restarts a job may be requeued after before it is given up
+JOB_HISTORY_DAYS = int(os.getenv("JOB_HISTORY_DAYS", "7")) # Finished jobs stay in the journal this long
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60")) # A job whose instance stops renewing it for this long is taken over by another
+# Jobs reserve scratch space (file size + headroom) before they start (see Database/diskspace.py)
+SCRATCH_MIN_FREE_MB = int(os.getenv("SCRATCH_MIN_FREE_MB", "512")) # Jobs never take the DOWNLOAD_DIR volume below this
+SCRATCH_HEADROOM_MB = int(os.getenv("SCRATCH_HEADROOM_MB", "16")) # Extra space per job for thumbnails and the journal
+SCRATCH_RAM_DIR = os.getenv("SCRATCH_RAM_DIR", "") # Optional tmpfs/RAM directory for small files, e.g. /dev/shm/renamer
+SCRATCH_RAM_MAX_FILE_MB = int(os.getenv("SCRATCH_RAM_MAX_FILE_MB", "64")) # Files up to this size use SCRATCH_RAM_DIR
+SCRATCH_RAM_BUDGET_MB = int(os.getenv("SCRATCH_RAM_BUDGET_MB", "512")) # Total reserved in SCRATCH_RAM_DIR at once
+# The janitor sweeps DOWNLOAD_DIR and THUMBNAIL_DIR for files no running job owns (see Database/janitor.py)
+JANITOR_INTERVAL = int(os.getenv("JANITOR_INTERVAL", "600")) # Seconds between sweeps
+DOWNLOAD_MAX_AGE = int(os.getenv("DOWNLOAD_MAX_AGE", str(CHECKPOINT_TTL))) # Unowned downloads older than this are removed (keeps resumable ones)
+THUMBNAIL_MAX_AGE = int(os.getenv("THUMBNAIL_MAX_AGE", "3600")) # Stray thumbnails older than this are removed
+DOWNLOAD_DIR_BUDGET_MB = int(os.getenv("DOWNLOAD_DIR_BUDGET_MB", "20480")) # Over this, the oldest unowned downloads go first
+THUMBNAIL_DIR_BUDGET_MB = int(os.getenv("THUMBNAIL_DIR_BUDGET_MB", "256"))
+# Prefetch starts downloading a file as soon as it is detected, while the user is still typing the new name
+PREFETCH_ENABLED = os.getenv("PREFETCH_ENABLED", "False").lower() in ("true", "1", "yes")
+PREFETCH_DISK_BUDGET_MB = int(os.getenv("PREFETCH_DISK_BUDGET_MB", "4096")) # Total size of all prefetched files at once
+PREFETCH_TIMEOUT = int(os.getenv("PREFETCH_TIMEOUT", "900")) # Seconds a prefetched file waits for its rename before being dropped
+
 # Custom Start-up pic (URL or file path)
 START_UP_PIC = os.getenv("START_UP_PIC", "https://telegra.ph/file/a0123456789abcdefg.jpg") # Replace with your image URL
 
@@ -56,7 +126,9 @@ DEFAULT_USER_PLAN = {
     "plan_expiry_date": None, # Will be datetime object
     "active_file_operation": None, # For storing context of ongoing rename
     "uploaded_thumbnail_id": None, # Store user's last uploaded custom thumbnail ID
-    "custom_caption": None # Store user's last custom caption
+    "custom_caption": None, # Store user's last custom caption
+    "rename_rules": [], # Auto-rename rules, see Database/rename_rules.py
+    "auto_rename": False # Apply rename_rules to incoming files without asking for a name
 }
 
 # Add premium plan tiers (example)
@@ -73,6 +145,29 @@ PREMIUM_PLANS = {
     }
 }
 
+# --- BANDWIDTH ---
+# Transfer rates in MB/s (0 = unlimited), enforced with token buckets on every download and upload chunk
+# (see Database/bandwidth.py). A chunk must fit the global, the plan and the user bucket, so one plan
+# cannot saturate the node and one user cannot take a whole plan's share. Limits apply per direction.
+GLOBAL_DOWNLOAD_MBPS = float(os.getenv("GLOBAL_DOWNLOAD_MBPS", "0"))
+GLOBAL_UPLOAD_MBPS = float(os.getenv("GLOBAL_UPLOAD_MBPS", "0"))
+PLAN_BANDWIDTH = {
+    # "plan_mbps": all users of the plan together, "user_mbps": each user of the plan
+    "free": {
+        "plan_mbps": float(os.getenv("FREE_PLAN_MBPS", "20")),
+        "user_mbps": float(os.getenv("FREE_USER_MBPS", "5"))
+    },
+    "silver": {
+        "plan_mbps": float(os.getenv("SILVER_PLAN_MBPS", "0")),
+        "user_mbps": float(os.getenv("SILVER_USER_MBPS", "20"))
+    },
+    "gold": {
+        "plan_mbps": float(os.getenv("GOLD_PLAN_MBPS", "0")),
+        "user_mbps": float(os.getenv("GOLD_USER_MBPS", "0"))
+    }
+}
+BANDWIDTH_BURST_SECONDS = float(os.getenv("BANDWIDTH_BURST_SECONDS", "2")) # Unused rate a bucket may save up for a burst
+
 # --- BOT BUTTONS/TEXTS ---
 UPDATE_CHANNEL_URL = os.getenv("UPDATE_CHANNEL_URL", "https://t.me/TBOT_UPDATE") # Replace with your channel link
 SUPPORT_GROUP_URL = os.getenv("SUPPORT_GROUP_URL", "https://t.me/your_support_group") # Replace with your support group link
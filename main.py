@@ -1,14 +1,42 @@
-from pyrogram import Client
+import asyncio
+from pyrogram import Client, idle
 from config import API_ID, API_HASH, BOT_TOKEN, SESSION_NAME
 from database import db
+from sessions import sessions
+from transfers import checkpoints
+from dedup import dedup
+from jobs import job_journal
+from pipeline import recover_jobs, watch_jobs
+from janitor import janitor
+
+async def run_bot(app: Client):
+    """Starts the client, requeues jobs interrupted by the last shutdown, then runs until stopped."""
+    await app.start()
+    job_journal.start() # Keeps the leases of this instance's jobs alive
+    await recover_jobs(app)
+    watcher = asyncio.create_task(watch_jobs(app))
+    janitor.start() # Periodic cleanup of files no job owns
+    print("Bot is running.")
+    await idle()
+    janitor.stop()
+    watcher.cancel()
+    job_journal.stop()
+    await app.stop()
 
 def main():
     """Initializes and runs the Telegram bot."""
     print("Initializing Pyrogram client...")
-    # Ensure MongoDB connection is attempted at startup
-    if not db.client:
+    # Ensure MongoDB connection is attempted at startup.
+    # Pyrogram's Client runs on the default event loop, so the Motor client is verified on that same loop.
+    loop = asyncio.get_event_loop()
+    if not loop.run_until_complete(db.ping()):
         print("MongoDB connection failed at startup. Exiting.")
         return # Or implement retry logic
+    loop.run_until_complete(db.migrate()) # One-shot bulk schema migrations
+    loop.run_until_complete(sessions.setup())
+    loop.run_until_complete(checkpoints.setup())
+    loop.run_until_complete(dedup.setup())
+    loop.run_until_complete(job_journal.setup())
 
     app = Client(
         SESSION_NAME,
@@ -19,7 +47,7 @@ def main():
     )
 
     print("Bot is starting...")
-    app.run()
+    loop.run_until_complete(run_bot(app))
     print("Bot has stopped.")
     db.close() # Close DB connection when bot stops
 
@@ -1,24 +1,103 @@
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from config import ADMINS
+from config import ADMINS, JOB_HISTORY_DAYS
 from database import db
+from scheduler import scheduler
+from prefetch import prefetcher
+from downloader import download_metrics
+from uploader import upload_metrics
+from bandwidth import download_governor, upload_governor
+from dedup import dedup
+from jobs import job_journal, ACTIVE_STAGES
+from janitor import janitor
+from diskspace import scratch_space
 import asyncio
 from logger import logger # Import logger
 
+def format_bandwidth(direction: str, stats: dict):
+    """One /stats line per direction: live rate against the limit for the node and each plan."""
+    def level(name, bucket):
+        text = f"{name} `{bucket['rate'] / (1024**2):.1f}"
+        if bucket["limit"]:
+            text += f"/{bucket['limit'] / (1024**2):.0f} MB/s` (`{bucket['utilization'] * 100:.0f}%`)"
+        else:
+            text += " MB/s`"
+        return text
+
+    parts = [level("all", stats["global"])]
+    for plan, bucket in stats["plans"].items():
+        parts.append(level(plan, bucket) + f" {bucket['active_users']} users")
+    return f"\n**Bandwidth {direction}:** " + ", ".join(parts) + \
+           f", throttled `{stats['throttled_seconds']:.0f}s` over `{stats['throttled_chunks']}` chunks"
+
+
 @Client.on_message(filters.command("stats") & filters.user(ADMINS) & filters.private)
 async def stats_command(client: Client, message: Message):
     """Admin-only command to show bot statistics."""
     user_id = message.from_user.id
     logger.info(f"Admin {user_id} requested /stats.")
     
-    total_users = await db.users_collection.count_documents({})
-    
+    total_users = await db.count_users()
+    cache_stats = db.user_cache.stats()
+    job_stats = scheduler.stats()
+    prefetch_stats = prefetcher.stats()
+    download_stats = download_metrics.stats()
+    upload_stats = upload_metrics.stats()
+    dedup_stats = await dedup.stats()
+    journal_stats = await job_journal.stats()
+    janitor_stats = janitor.stats()
+    scratch_stats = scratch_space.stats()
+
     # You can add more stats here, e.g., active users, premium users, etc.
-    # For now, just total users.
 
     stats_text = f"**📊 Bot Statistics 📊**\n\n" \
                  f"**Total Users:** `{total_users}`\n" \
-                 f"**Active Operations:** (Not implemented yet)" # You'd need to track this in your DB
+                 f"**Active Operations:** `{job_stats['running']}/{job_stats['max_workers']}` running, " \
+                 f"`{job_stats['queued']}` queued\n" \
+                 f"**Jobs:** `{job_stats['completed']}` completed, `{job_stats['failed']}` failed, `{job_stats['cancelled']}` cancelled\n" \
+                 f"**Queue Wait:** avg `{job_stats['avg_wait']:.1f}s`, max `{job_stats['max_wait']:.1f}s`, " \
+                 f"`{job_stats['starvation_promotions']}` starvation promotions\n"
+    for plan, wait in job_stats["plan_avg_wait"].items():
+        stats_text += f"  - {plan.upper()}: avg `{wait:.1f}s`\n"
+
+    stats_text += f"\n**User Cache:** `{cache_stats['size']}/{cache_stats['max_size']}` entries, " \
+                  f"`{cache_stats['hits']}` hits / `{cache_stats['misses']}` misses " \
+                  f"(`{cache_stats['hit_rate'] * 100:.1f}%`)"
+    stats_text += f"\n**Downloads:** `{download_stats['files']}` files, `{download_stats['bytes'] / (1024**3):.2f} GB`, " \
+                  f"avg `{download_stats['avg_speed'] / (1024**2):.2f} MB/s`, last `{download_stats['last_speed'] / (1024**2):.2f} MB/s`, " \
+                  f"peak `{download_stats['peak_speed'] / (1024**2):.2f} MB/s`"
+    stats_text += f"\n**Uploads:** `{upload_stats['files']}` files, `{upload_stats['bytes'] / (1024**3):.2f} GB`, " \
+                  f"avg `{upload_stats['avg_speed'] / (1024**2):.2f} MB/s`, last `{upload_stats['last_speed'] / (1024**2):.2f} MB/s`, " \
+                  f"peak `{upload_stats['peak_speed'] / (1024**2):.2f} MB/s`"
+    for direction, governor in (("Down", download_governor), ("Up", upload_governor)):
+        stats_text += format_bandwidth(direction, governor.stats())
+    if journal_stats["enabled"]:
+        stats_text += f"\n**Job Journal:** `{sum(journal_stats['stages'][stage] for stage in ACTIVE_STAGES)}` active, " \
+                      f"`{journal_stats['stages']['done']}` done, `{journal_stats['stages']['failed']}` failed " \
+                      f"(last {JOB_HISTORY_DAYS} days); `{journal_stats['recovered']}` recovered and " \
+                      f"`{journal_stats['abandoned']}` abandoned after the last restart"
+    scratch = ", ".join(
+        f"{name} `{tier['free'] / (1024**3):.1f} GB` free, `{tier['reserved'] / (1024**3):.2f} GB` reserved by `{tier['jobs']}` jobs"
+        for name, tier in scratch_stats["tiers"].items()
+    )
+    stats_text += f"\n**Scratch Space:** {scratch}; `{job_stats['resource_waits']}` waits for space, " \
+                  f"`{scratch_stats['rejected']}` too large, `{scratch_stats['ram_jobs']}` jobs in RAM"
+    if janitor_stats["running"]:
+        usage = ", ".join(
+            f"{name} `{used / (1024**2):.0f}/{janitor_stats['budgets'][name] / (1024**2):.0f} MB`"
+            for name, used in janitor_stats["usage"].items()
+        )
+        stats_text += f"\n**Janitor:** {usage}; `{janitor_stats['removed']}` stale entries removed, " \
+                      f"`{janitor_stats['reclaimed_bytes'] / (1024**3):.2f} GB` reclaimed in `{janitor_stats['sweeps']}` sweeps"
+    if dedup_stats["enabled"]:
+        stats_text += f"\n**Dedup Cache:** `{dedup_stats['entries']}` entries, " \
+                      f"`{dedup_stats['hits']}` hits / `{dedup_stats['misses']}` misses " \
+                      f"(`{dedup_stats['hit_rate'] * 100:.1f}%`), `{dedup_stats['evictions']}` stale entries dropped"
+    if prefetch_stats["enabled"]:
+        stats_text += f"\n**Prefetch:** `{prefetch_stats['active']}` active, " \
+                      f"`{prefetch_stats['reserved_bytes'] / (1024**2):.0f}/{prefetch_stats['budget_bytes'] / (1024**2):.0f} MB` budget used, " \
+                      f"`{prefetch_stats['hits']}/{prefetch_stats['started']}` used, " \
+                      f"`{prefetch_stats['cancelled']}` cancelled, `{prefetch_stats['expired']}` expired, `{prefetch_stats['skipped']}` skipped"
 
     await message.reply_text(stats_text)
 
@@ -35,6 +114,19 @@ async def ping_command(client: Client, message: Message):
     await sent_message.edit_text(f"Pong! 🏓 `{ping_time}ms`")
     logger.info(f"Admin {user_id}: Ping response {ping_time}ms.")
 
+@Client.on_message(filters.command("migrate") & filters.user(ADMINS) & filters.private)
+async def migrate_command(client: Client, message: Message):
+    """Admin-only command to run pending user schema migrations without a restart."""
+    user_id = message.from_user.id
+    logger.info(f"Admin {user_id} sent /migrate command.")
+    applied = await db.migrate()
+    if not applied:
+        await message.reply_text("User documents are already up to date.")
+        return
+    lines = [f"v{version} - {description}: `{stamped}` documents" for version, description, _, stamped in applied]
+    await message.reply_text("**Migrations applied:**\n\n" + "\n".join(lines))
+    logger.info(f"Admin {user_id}: Applied migrations {[version for version, *_ in applied]}.")
+
 # You can add more admin commands here as needed
 # For example, commands to manage user plans, broadcast messages (already in broadcast.py),
 # ban/unban users, etc.
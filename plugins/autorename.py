@@ -0,0 +1,112 @@
+from pyrogram import Client, filters
+from pyrogram.types import Message
+from database import db
+from rename_rules import parse_rule, describe_rule, apply_rules, drop_rules, RULES_HELP
+from config import MAX_RENAME_RULES
+from filter_plugins import force_sub
+from logger import logger # Import logger
+
+# This plugin manages a user's auto-rename rules (see Database/rename_rules.py).
+
+RULE_FIELDS = ("rename_rules", "auto_rename")
+
+
+@Client.on_message(filters.command("rules") & filters.private & force_sub)
+async def list_rules_command(client: Client, message: Message):
+    """Shows the user's rename rules and whether auto-rename is on."""
+    user_id = message.from_user.id
+    user_data = await db.get_user(user_id, fields=RULE_FIELDS)
+    rules = user_data.get("rename_rules") or []
+    status = "ON" if user_data.get("auto_rename") else "OFF"
+    if rules:
+        rules_text = "\n".join(f"{index}. {describe_rule(rule)}" for index, rule in enumerate(rules, start=1))
+    else:
+        rules_text = "No rules yet."
+    await message.reply_text(
+        f"**Auto-rename:** `{status}`\n\n{rules_text}\n\n"
+        f"**Add a rule:**\n{RULES_HELP}\n\n"
+        "`/delrule <number>`, `/clearrules`, `/testrules <file name>`, `/autorename on|off`"
+    )
+
+
+@Client.on_message(filters.command("addrule") & filters.private & force_sub)
+async def add_rule_command(client: Client, message: Message):
+    user_id = message.from_user.id
+    user_data = await db.get_user(user_id, fields=RULE_FIELDS)
+    rules = list(user_data.get("rename_rules") or [])
+    if len(rules) >= MAX_RENAME_RULES:
+        await message.reply_text(f"You can have at most {MAX_RENAME_RULES} rules. Remove one with /delrule first.")
+        return
+    try:
+        rule = parse_rule(message.text.split(" ", 1)[1] if " " in message.text else "")
+    except ValueError as e:
+        await message.reply_text(f"{e}\n\n{RULES_HELP}")
+        return
+    rules.append(rule)
+    await db.update_user_field(user_id, "rename_rules", rules)
+    await message.reply_text(f"Rule {len(rules)} added: {describe_rule(rule)}")
+    logger.info(f"User {user_id}: Added rename rule {rule}.")
+
+
+@Client.on_message(filters.command("delrule") & filters.private & force_sub)
+async def delete_rule_command(client: Client, message: Message):
+    user_id = message.from_user.id
+    user_data = await db.get_user(user_id, fields=RULE_FIELDS)
+    rules = list(user_data.get("rename_rules") or [])
+    try:
+        index = int(message.command[1]) - 1
+        if not 0 <= index < len(rules):
+            raise IndexError
+    except (IndexError, ValueError):
+        await message.reply_text("Use `/delrule <number>` with a number from /rules.")
+        return
+    removed = rules.pop(index)
+    await db.update_user_field(user_id, "rename_rules", rules)
+    await message.reply_text(f"Removed rule: {describe_rule(removed)}")
+
+
+@Client.on_message(filters.command("clearrules") & filters.private & force_sub)
+async def clear_rules_command(client: Client, message: Message):
+    user_id = message.from_user.id
+    async with db.user_update(user_id) as update:
+        update.set("rename_rules", [])
+        update.set("auto_rename", False)
+    await message.reply_text("All rename rules removed and auto-rename turned off.")
+
+
+@Client.on_message(filters.command("testrules") & filters.private & force_sub)
+async def test_rules_command(client: Client, message: Message):
+    """Shows what the rules would turn a file name into."""
+    user_id = message.from_user.id
+    if len(message.command) < 2:
+        await message.reply_text("Use `/testrules <file name>`.")
+        return
+    user_data = await db.get_user(user_id, fields=RULE_FIELDS)
+    sample = message.text.split(" ", 1)[1].strip()
+    rules = user_data.get("rename_rules") or []
+    result, timed_out = await apply_rules(rules, sample)
+    text = f"`{sample}`\n→ `{result}`" if result else "The rules leave nothing of that name."
+    if timed_out:
+        await drop_rules(user_id, rules, timed_out)
+        text += "\n\nThese rules took too long and were removed:\n" + "\n".join(describe_rule(rule) for rule in timed_out)
+    await message.reply_text(text)
+
+
+@Client.on_message(filters.command("autorename") & filters.private & force_sub)
+async def auto_rename_command(client: Client, message: Message):
+    user_id = message.from_user.id
+    choice = message.command[1].lower() if len(message.command) > 1 else ""
+    if choice not in ("on", "off"):
+        await message.reply_text("Use `/autorename on` or `/autorename off`.")
+        return
+    if choice == "on":
+        user_data = await db.get_user(user_id, fields=RULE_FIELDS)
+        if not user_data.get("rename_rules"):
+            await message.reply_text(f"Add at least one rule first.\n\n{RULES_HELP}")
+            return
+    await db.update_user_field(user_id, "auto_rename", choice == "on")
+    await message.reply_text(
+        "Auto-rename is **on**: files you send are renamed with your rules and queued right away."
+        if choice == "on" else "Auto-rename is **off**: you will be asked for a name again."
+    )
+    logger.info(f"User {user_id}: Auto-rename turned {choice}.")
@@ -0,0 +1,116 @@
+import asyncio
+from collections import defaultdict
+from pyrogram import Client, filters
+from pyrogram.types import Message
+from database import db
+from sessions import sessions
+from utils import extract_media, new_active_operation
+from batch import run_batch, validate_template, TEMPLATE_HELP
+from config import BATCH_MAX_FILES
+from filter_plugins import force_sub, session_state
+from logger import logger # Import logger
+
+# This plugin handles batch renames: /batch, send files (albums welcome), /done, then a name template.
+# Batch handlers run in group -1, ahead of the single-file handlers, and stop propagation
+# while a batch conversation is active.
+
+_batch_locks = defaultdict(asyncio.Lock) # Album files arrive concurrently; appends to the session must not race
+
+
+def _drop_batch_lock(user_id: int):
+    """Forgets the user's lock once their batch stops collecting files."""
+    lock = _batch_locks.get(user_id)
+    if lock is not None and not lock.locked():
+        del _batch_locks[user_id]
+
+
+@Client.on_message(filters.command("batch") & filters.private & force_sub)
+async def start_batch_command(client: Client, message: Message):
+    """Starts collecting files for a batch rename."""
+    user_id = message.from_user.id
+    logger.info(f"User {user_id} sent /batch.")
+    await sessions.set_state(user_id, "collecting_batch", files=[])
+    await message.reply_text(
+        "**Batch mode started.**\n\n"
+        f"Send up to {BATCH_MAX_FILES} files (albums are fine), then send /done.\n"
+        "Send /cancel_batch to stop."
+    )
+
+
+@Client.on_message(
+    filters.private & (filters.document | filters.video | filters.audio | filters.photo)
+    & session_state("collecting_batch") & force_sub,
+    group=-1
+)
+async def collect_batch_file(client: Client, message: Message):
+    """Adds an incoming file to the user's batch instead of starting a single-file conversation."""
+    user_id = message.from_user.id
+    file_info, file_type = extract_media(message)
+    async with _batch_locks[user_id]:
+        session = await sessions.get(user_id) or {}
+        files = list(session.get("files", []))
+        if len(files) >= BATCH_MAX_FILES:
+            await message.reply_text(f"A batch can hold at most {BATCH_MAX_FILES} files. Send /done to continue.")
+        else:
+            user_data = await db.get_user(user_id, fields=("custom_caption",))
+            files.append(new_active_operation(file_info, file_type, user_data.get("custom_caption")))
+            await sessions.set_state(user_id, "collecting_batch", files=files)
+            if len(files) == 1 or len(files) % 10 == 0:
+                await message.reply_text(f"{len(files)} file(s) in the batch. Send more, or /done when finished.")
+    message.stop_propagation()
+
+
+@Client.on_message(filters.command("done") & filters.private & session_state("collecting_batch") & force_sub, group=-1)
+async def finish_batch_collection(client: Client, message: Message):
+    """Stops collecting and asks for the name template."""
+    user_id = message.from_user.id
+    session = await sessions.get(user_id) or {}
+    files = session.get("files", [])
+    if not files:
+        await message.reply_text("The batch is empty. Send some files first, or /cancel_batch.")
+        message.stop_propagation()
+    await sessions.set_state(user_id, "waiting_for_batch_template", files=files)
+    _drop_batch_lock(user_id)
+    await message.reply_text(
+        f"Got {len(files)} file(s). Now send the **name template**, for example:\n"
+        "`Show S01E{n:02d} {orig_stem}{ext}`\n\n"
+        f"Placeholders:\n{TEMPLATE_HELP}"
+    )
+    message.stop_propagation()
+
+
+@Client.on_message(filters.command("cancel_batch") & filters.private & force_sub, group=-1)
+async def cancel_batch_command(client: Client, message: Message):
+    user_id = message.from_user.id
+    if await sessions.get_state(user_id) in ("collecting_batch", "waiting_for_batch_template"):
+        await sessions.clear_state(user_id)
+        _drop_batch_lock(user_id)
+        await message.reply_text("Batch cancelled.")
+        logger.info(f"User {user_id}: Cancelled batch.")
+    else:
+        await message.reply_text("There is no batch to cancel.")
+    message.stop_propagation()
+
+
+@Client.on_message(
+    filters.private & filters.text & ~filters.regex(r"^/")
+    & session_state("waiting_for_batch_template") & force_sub,
+    group=-1
+)
+async def handle_batch_template(client: Client, message: Message):
+    """Validates the template and submits the whole batch to the job queue."""
+    user_id = message.from_user.id
+    template = message.text.strip()
+    try:
+        validate_template(template)
+    except (ValueError, KeyError, IndexError) as e:
+        await message.reply_text(f"That template doesn't work: {e}\n\nPlaceholders:\n{TEMPLATE_HELP}")
+        message.stop_propagation()
+
+    session = await sessions.get(user_id) or {}
+    files = session.get("files", [])
+    await sessions.clear_state(user_id)
+    _drop_batch_lock(user_id)
+    user_data = await db.get_user(user_id, fields=("parallel_processes", "current_plan"))
+    await run_batch(client, message, user_data, files, template)
+    message.stop_propagation()
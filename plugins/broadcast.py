@@ -17,16 +17,11 @@ async def broadcast_command(client: Client, message: Message):
         logger.warning(f"Admin {user_id}: Broadcast failed - no replied message.")
         return
 
-    all_users_cursor = db.users_collection.find({}) # Get all users from DB
     success_count = 0
     fail_count = 0
-    
-    # Count documents asynchronously. PyMongo's count_documents is synchronous,
-    # so we need to run it in a thread or use aiohttp with motor/asyncio driver if available.
-    # For simplicity here, we'll fetch and count, or assume a synchronous call.
-    # A more robust solution for large DBs would be motor.
+
     try:
-        total_users = await asyncio.to_thread(db.users_collection.count_documents, {})
+        total_users = await db.count_users()
     except Exception as e:
         logger.error(f"Error counting total users for broadcast: {e}", exc_info=True)
         total_users = "unknown" # Fallback
@@ -35,10 +30,8 @@ async def broadcast_command(client: Client, message: Message):
     status_message = await message.reply_text(f"Starting broadcast to {total_users} users...")
     logger.info(f"Admin {user_id}: Broadcast started for {total_users} users.")
 
-    # Convert cursor to list in a thread for non-blocking iteration
-    users_list = await asyncio.to_thread(list, all_users_cursor)
-
-    for user_doc in users_list:
+    # Stream user IDs from the cursor instead of loading every document into memory
+    async for user_doc in db.iter_user_ids():
         user_id_to_send = user_doc["_id"]
         if user_id_to_send == message.from_user.id: # Don't send to self
             continue
@@ -0,0 +1,47 @@
+from pyrogram import Client, filters
+from pyrogram.types import Message, CallbackQuery
+from database import db
+from sessions import sessions
+from scheduler import scheduler
+from prefetch import prefetcher
+from filter_plugins import force_sub
+from logger import logger # Import logger
+
+# This plugin stops rename jobs: /cancel stops everything the user has running or queued,
+# the Cancel button under a job's status message stops that one job (see Database/scheduler.py).
+# Both run in group -1 so "/cancel" is never taken as a new file name by the text handlers.
+
+
+@Client.on_message(filters.command("cancel") & filters.private & force_sub, group=-1)
+async def cancel_command(client: Client, message: Message):
+    """Cancels all of the user's running and queued jobs and any file waiting for a name."""
+    user_id = message.from_user.id
+    cancelled = scheduler.cancel_user(user_id)
+    active_op = await db.get_active_operation(user_id)
+    if active_op:
+        await db.clear_active_operation(user_id)
+    prefetcher.cancel(user_id, "cancelled by user")
+    await sessions.clear_state(user_id)
+
+    if cancelled:
+        await message.reply_text(f"Cancelling {cancelled} job(s). Their files and reserved quota are being released.")
+    elif active_op:
+        await message.reply_text("Operation cancelled. Send a new file to start over.")
+    else:
+        await message.reply_text("You have nothing running to cancel.")
+    logger.info(f"User {user_id}: /cancel stopped {cancelled} job(s).")
+    message.stop_propagation()
+
+
+@Client.on_callback_query(filters.regex(r"^cancel_job:\d+$"), group=-1)
+async def cancel_job_callback(client: Client, callback_query: CallbackQuery):
+    user_id = callback_query.from_user.id
+    job = scheduler.find(int(callback_query.data.split(":", 1)[1]))
+    if job is None or job.user_id != user_id:
+        await callback_query.answer("This job has already finished.", show_alert=True)
+    elif scheduler.cancel(job):
+        await callback_query.answer("Cancelling...")
+        logger.info(f"User {user_id}: Cancelled job {job.id} from its status message.")
+    else:
+        await callback_query.answer("This job is already being cancelled.")
+    callback_query.stop_propagation()
@@ -1,6 +1,7 @@
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from database import db
+from sessions import sessions
 from filter_plugins import force_sub
 from logger import logger # Import logger
 
@@ -11,7 +12,7 @@ async def set_caption_command(client: Client, message: Message):
     """Allows user to set a default custom caption."""
     user_id = message.from_user.id
     logger.info(f"User {user_id} sent /set_caption.")
-    db.update_user_field(user_id, "active_file_operation", {"state": "waiting_for_global_caption"}) # Use a different state
+    await sessions.set_state(user_id, "waiting_for_global_caption") # Use a different state
     await message.reply_text(
         "Please send the **new default caption** you want to use for your uploads.\n\n"
         "You can use HTML tags (e.g., `<b>`, `<i>`, `<a href=...>`, `<code>`).\n"
@@ -23,7 +24,7 @@ async def view_caption_command(client: Client, message: Message):
     """Allows user to view their current default custom caption."""
     user_id = message.from_user.id
     logger.info(f"User {user_id} sent /view_caption.")
-    user_data = db.get_user(user_id)
+    user_data = await db.get_user(user_id, fields=("custom_caption",))
     current_caption = user_data.get("custom_caption")
     if current_caption:
         await message.reply_text(
@@ -40,7 +41,7 @@ async def clear_caption_command(client: Client, message: Message):
     """Allows user to clear their default custom caption."""
     user_id = message.from_user.id
     logger.info(f"User {user_id} sent /clear_caption.")
-    db.update_user_field(user_id, "custom_caption", None)
+    await db.update_user_field(user_id, "custom_caption", None)
     await message.reply_text("Your default custom caption has been cleared.")
     logger.info(f"User {user_id}: Default caption cleared.")
 
@@ -48,22 +49,19 @@ async def clear_caption_command(client: Client, message: Message):
 @Client.on_message(filters.private & filters.text & filters.incoming & force_sub)
 async def handle_caption_text_input(client: Client, message: Message):
     user_id = message.from_user.id
-    user_data = db.get_user(user_id)
-    
+
     # Check if the user is in the state of setting a global caption
-    if user_data.get("active_file_operation", {}).get("state") == "waiting_for_global_caption":
+    if await sessions.get_state(user_id) == "waiting_for_global_caption":
         logger.info(f"User {user_id}: Received text for global caption setting.")
         if message.text == "/cancel_caption":
-            db.update_user_field(user_id, "active_file_operation.state", None)
-            db.clear_active_operation(user_id) # Clear the temporary active_file_operation used for state
+            await sessions.clear_state(user_id)
             await message.reply_text("Setting default caption cancelled.")
             logger.info(f"User {user_id}: Cancelled default caption setting.")
             return
 
         new_caption = message.text.strip()
-        db.update_user_field(user_id, "custom_caption", new_caption)
-        db.update_user_field(user_id, "active_file_operation.state", None) # Clear state
-        db.clear_active_operation(user_id) # Clear the temporary active_file_operation used for state
+        await db.update_user_field(user_id, "custom_caption", new_caption)
+        await sessions.clear_state(user_id)
         await message.reply_text(f"Your new default caption has been set:\n\n`{new_caption}`")
         logger.info(f"User {user_id}: New default caption set.")
     # This handler should be placed carefully or given a lower group/order
@@ -1,6 +1,6 @@
 from pyrogram import Client, filters
 from pyrogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from database import db
+from database import db, PLAN_FIELDS
 from config import UPDATE_CHANNEL_URL, SUPPORT_GROUP_URL, HELP_TEXT, ABOUT_TEXT, START_UP_PIC
 from filter_plugins import force_sub
 from logger import logger # Import logger
@@ -62,7 +62,7 @@ async def handle_general_callback_data(client: Client, callback_query: CallbackQ
         logger.info(f"User {user_id}: Displayed upgrade premium options.")
 
     elif data == "start_menu":
-        user_data = db.get_user(user_id)
+        user_data = await db.get_user(user_id, fields=PLAN_FIELDS)
         plan_info = (
             f"**Current Plan:** `{user_data['current_plan'].upper()}`\n"
             f"**Daily Upload Limit:** `{user_data['daily_upload_limit_gb']} GB`\n"
@@ -1,6 +1,10 @@
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from database import db
+from sessions import sessions
+from prefetch import prefetcher
+from rename_rules import try_auto_rename
+from utils import extract_media, new_active_operation
 from config import DOWNLOAD_DIR, THUMBNAIL_DIR
 from filter_plugins import force_sub
 import os
@@ -11,16 +15,16 @@ import os
 async def detect_file_and_prompt(client: Client, message: Message):
     """Detects an incoming file and prompts the user for action."""
     user_id = message.from_user.id
-    user_data = db.get_user(user_id)
 
     # Check if a thumbnail is being sent as part of a previous operation
     # This check is crucial to avoid re-triggering the file detection flow
     # when a user is in the "waiting_for_thumbnail" state.
-    active_op = db.get_active_operation(user_id)
-    if active_op and active_op.get("state") == "waiting_for_thumbnail":
+    if await sessions.get_state(user_id) == "waiting_for_thumbnail":
         if message.photo:
-            db.update_user_field(user_id, "active_file_operation.custom_thumbnail_id", message.photo.file_id)
-            db.update_user_field(user_id, "active_file_operation.state", None) # Clear state
+            async with db.user_update(user_id) as update:
+                update.set("active_file_operation.custom_thumbnail_id", message.photo.file_id)
+                update.set("active_file_operation.custom_thumbnail_unique_id", message.photo.file_unique_id) # Dedup fingerprint
+            await sessions.clear_state(user_id)
             await message.reply_text("Custom thumbnail received! Now send the **new name** for the file.")
             return
         else:
@@ -28,21 +32,8 @@ async def detect_file_and_prompt(client: Client, message: Message):
             return
 
 
-    file_type = None
-    file_info = None
-
-    if message.document:
-        file_info = message.document
-        file_type = "document"
-    elif message.video:
-        file_info = message.video
-        file_type = "video"
-    elif message.audio:
-        file_info = message.audio
-        file_type = "audio"
-    elif message.photo:
-        file_info = sorted(message.photo, key=lambda p: p.file_size or 0, reverse=True)[0]
-        file_type = "photo"
+    user_data = await db.get_user(user_id)
+    file_info, file_type = extract_media(message)
 
     if file_info:
         file_size_gb = (file_info.file_size or 0) / (1024**3)
@@ -53,21 +44,14 @@ async def detect_file_and_prompt(client: Client, message: Message):
             )
             return
 
-        original_name = getattr(file_info, "file_name", f"untitled_{file_type}")
-        mime_type = getattr(file_info, "mime_type", "application/octet-stream")
-
-        # Store file data in the database for the active operation
-        db.set_active_operation(user_id, {
-            "file_id": file_info.file_id,
-            "original_name": original_name,
-            "file_type": file_type,
-            "mime_type": mime_type,
-            "pyrogram_file_obj": file_info.to_dict(), # Store full Pyrogram object data
-            "file_size": file_info.file_size,
-            "state": None, # No specific state yet, just stored file info
-            "custom_thumbnail_id": None,
-            "custom_caption_text": user_data.get("custom_caption") # Use user's default caption if set
-        })
+        active_op = new_active_operation(file_info, file_type, user_data.get("custom_caption")) # Use user's default caption if set
+        original_name = active_op["original_name"]
+        if await try_auto_rename(client, message, user_data, active_op):
+            await sessions.clear_state(user_id)
+            return # Queued with the user's rename rules, no prompt needed
+        await db.set_active_operation(user_id, active_op)
+        prefetcher.start(client, user_id, active_op, user_data.get("parallel_processes", 1), user_data.get("current_plan", "free")) # Opt-in, replaces any earlier prefetch
+        await sessions.clear_state(user_id) # A new file starts a new conversation
 
         keyboard = InlineKeyboardMarkup(
             [
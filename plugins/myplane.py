@@ -1,6 +1,6 @@
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
-from database import db
+from database import db, PLAN_FIELDS
 from config import PREMIUM_PLANS
 from filter_plugins import force_sub
 from logger import logger # Import logger
@@ -11,7 +11,7 @@ async def myplan_command(client: Client, message: Message):
     """Displays the user's current plan information."""
     user_id = message.from_user.id
     logger.info(f"User {user_id} sent /myplan.")
-    user_data = db.get_user(user_id)
+    user_data = await db.get_user(user_id, fields=PLAN_FIELDS)
 
     plan_info_text = (
         f"**✨ Your Current Plan ✨**\n\n"
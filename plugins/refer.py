@@ -9,7 +9,7 @@ async def refer_command(client: Client, message: Message):
     """Generates a referral link for the user."""
     user_id = message.from_user.id
     logger.info(f"User {user_id} sent /refer.")
-    user_data = db.get_user(user_id) # Ensures user exists
+    user_data = await db.get_user(user_id, fields=("_id",)) # Ensures user exists
 
     # Construct bot's username
     try:
@@ -64,13 +64,13 @@ async def handle_referral_start(client: Client, message: Message):
                     logger.warning(f"User {user_id}: Attempted self-referral.")
                     return # Do not proceed with referral logic, but let /start handler continue
                 
-                referrer_user_data = db.get_user(referred_by_id) # Get referrer data
+                referrer_user_data = await db.get_user(referred_by_id, fields=("_id",)) # Get referrer data
                 
                 if referrer_user_data:
-                    current_user_data = db.get_user(user_id) # Ensure current user is in DB
+                    current_user_data = await db.get_user(user_id, fields=("referred_by",)) # Ensure current user is in DB
                     
                     if not current_user_data.get("referred_by"): # Only set if not already referred
-                        db.update_user_field(user_id, "referred_by", referred_by_id)
+                        await db.update_user_field(user_id, "referred_by", referred_by_id)
                         await message.reply_text(f"You were referred by user `{referred_by_id}`! Welcome!")
                         logger.info(f"User {user_id} successfully referred by {referred_by_id}.")
                         # Here, you'd add logic to give benefits to the referrer
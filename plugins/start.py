@@ -1,7 +1,7 @@
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton
 from config import UPDATE_CHANNEL_URL, SUPPORT_GROUP_URL, HELP_TEXT, ABOUT_TEXT, START_UP_PIC
-from database import db
+from database import db, PLAN_FIELDS
 from filter_plugins import force_sub
 from logger import logger # Import logger
 
@@ -13,7 +13,7 @@ async def start_command_plugin(client: Client, message: Message):
     """Handles the /start command and displays user plan info with inline keyboard."""
     user_id = message.from_user.id
     logger.info(f"User {user_id} sent /start command (plugin).")
-    user_data = db.get_user(user_id) # Get or create user (handled by lazyusers.py as well)
+    user_data = await db.get_user(user_id, fields=PLAN_FIELDS + ("referred_by",)) # Get or create user (handled by lazyusers.py as well)
 
     plan_info = (
         f"**Current Plan:** `{user_data['current_plan'].upper()}`\n"
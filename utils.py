@@ -1,71 +1,163 @@
 import os
 import asyncio
+import shutil
+import tempfile
 from PIL import Image
 from pyrogram import Client
-from pyrogram.types import Message, Document, Video, Photo
+from pyrogram.types import Message
 from config import DOWNLOAD_DIR, THUMBNAIL_DIR
+from scheduler import JobCancelled
 from logger import logger # Import logger
 
-async def get_or_generate_thumbnail(client: Client, message: Message, file_data: dict, downloaded_file_path: str):
+def media_record(file_info) -> dict:
+    """
+    Builds the compact media record stored in `active_file_operation["media"]`.
+    Only the attributes needed to re-send the file are kept, instead of the full Pyrogram object dump.
+    """
+    record = {
+        "file_id": file_info.file_id,
+        "file_unique_id": getattr(file_info, "file_unique_id", None),
+        "file_size": getattr(file_info, "file_size", None),
+        "duration": getattr(file_info, "duration", None),
+        "width": getattr(file_info, "width", None),
+        "height": getattr(file_info, "height", None),
+        "title": getattr(file_info, "title", None),
+        "performer": getattr(file_info, "performer", None),
+        "thumbs": [
+            {"file_id": thumb.file_id, "file_size": thumb.file_size}
+            for thumb in (getattr(file_info, "thumbs", None) or [])
+        ],
+    }
+    return {key: value for key, value in record.items() if value is not None}
+
+def extract_media(message: Message):
+    """Returns (file_info, file_type) for a document/video/audio/photo message, or (None, None)."""
+    for file_type in ("document", "video", "audio", "photo"):
+        file_info = getattr(message, file_type, None)
+        if file_info:
+            return file_info, file_type
+    return None, None
+
+def new_active_operation(file_info, file_type: str, custom_caption: str = None) -> dict:
+    """Builds the `active_file_operation` record for a detected file."""
+    return {
+        "file_id": file_info.file_id,
+        "original_name": getattr(file_info, "file_name", None) or f"untitled_{file_type}",
+        "file_type": file_type,
+        "mime_type": getattr(file_info, "mime_type", None) or "application/octet-stream",
+        "media": media_record(file_info), # Compact record instead of the full Pyrogram object
+        "file_size": file_info.file_size,
+        "custom_thumbnail_id": None,
+        "custom_caption_text": custom_caption # The user's default caption, if set
+    }
+
+def safe_filename(name: str, fallback: str = "file") -> str:
+    """Reduces a user-supplied file name to a single path component that is safe to create on disk."""
+    name = os.path.basename(name.replace("\\", "/")).replace("\0", "").strip()
+    if name in ("", ".", ".."):
+        name = fallback
+    # Most filesystems cap names at 255 bytes; keep the extension when trimming
+    while len(name.encode("utf-8")) > 255:
+        stem, ext = os.path.splitext(name)
+        name = stem[:-1] + ext if stem else name[:-1]
+    return name
+
+def create_job_dir(user_id: int, job_id, root: str = DOWNLOAD_DIR) -> str:
+    """
+    Creates an isolated scratch directory for one job under `root` (DOWNLOAD_DIR by default).
+    Concurrent jobs never share paths, even for files with the same name.
+    """
+    os.makedirs(root, exist_ok=True)
+    return tempfile.mkdtemp(prefix=f"{user_id}_{job_id}_", dir=os.path.abspath(root))
+
+def place_file(source_path: str, target_path: str):
+    """
+    Makes an already-downloaded file available at `target_path`: a hardlink when the filesystem
+    supports it, otherwise a move (a copy if the target is on another filesystem, e.g. the RAM tier).
+    """
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        shutil.move(source_path, target_path)
+
+async def run_command(args: list, cancel_token=None):
+    """
+    Runs a command without a shell and returns (returncode, stdout, stderr).
+    The process is killed if `cancel_token` (a scheduler CancelToken) is set before it exits,
+    or if the calling task is cancelled; the token's JobCancelled is then raised.
+    """
+    process = await asyncio.create_subprocess_exec(*args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+    communicate = asyncio.ensure_future(process.communicate())
+    waiters = {communicate}
+    if cancel_token is not None:
+        waiters.add(asyncio.ensure_future(cancel_token.wait()))
+    try:
+        await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for waiter in waiters:
+            if waiter is not communicate:
+                waiter.cancel()
+        if not communicate.done():
+            process.kill()
+            communicate.cancel()
+            await process.wait()
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
+    stdout, stderr = communicate.result()
+    return process.returncode, stdout, stderr
+
+async def get_or_generate_thumbnail(client: Client, message: Message, file_data: dict, downloaded_file_path: str, output_dir: str = THUMBNAIL_DIR, cancel_token=None):
     """
     Attempts to get a thumbnail from the file data, or generates one if needed.
     Prioritizes existing thumbnails, then generates from video/document, then uses default.
+    Downloaded/generated thumbnails are written to `output_dir` (pass the job's scratch directory
+    to keep concurrent jobs apart); the shared default thumbnail stays in THUMBNAIL_DIR.
+    FFmpeg is killed as soon as `cancel_token` is set.
     """
     user_id = message.from_user.id
     thumbnail_path = None
     
     # Ensure directories exist
     os.makedirs(THUMBNAIL_DIR, exist_ok=True)
+    os.makedirs(output_dir, exist_ok=True)
+    output_dir = os.path.join(output_dir, "") # Trailing separator: Pyrogram treats file_name as a directory
 
     # 1. Check for custom thumbnail uploaded by user for this operation
     if file_data.get("custom_thumbnail_id"):
         logger.info(f"User {user_id}: Attempting to download custom thumbnail.")
         try:
-            custom_thumb_path = await client.download_media(file_data["custom_thumbnail_id"], file_name=THUMBNAIL_DIR)
+            custom_thumb_path = await client.download_media(file_data["custom_thumbnail_id"], file_name=output_dir)
             logger.info(f"User {user_id}: Custom thumbnail downloaded: {custom_thumb_path}")
             return custom_thumb_path
         except Exception as e:
             logger.error(f"User {user_id}: Error downloading custom thumbnail: {e}", exc_info=True)
             # Fallback to other methods if custom thumbnail fails
 
-    # 2. Try to get thumbnail from Pyrogram file object (if it's a video/document with a thumbnail)
+    # 2. Try to get thumbnail from the stored media record (if it's a video/document with a thumbnail)
     if file_data["file_type"] in ["video", "document"]:
-        # Reconstruct Pyrogram object from dict to access attributes like thumbs
-        # Note: This might not fully re-instantiate complex Pyrogram objects perfectly
-        # A more robust way might be to pass the actual Pyrogram object initially.
-        # For thumbs, it usually works as it's basic data.
-        file_obj = None
-        if file_data.get("pyrogram_file_obj") and isinstance(file_data["pyrogram_file_obj"], dict):
-            if file_data["file_type"] == "video":
-                file_obj = Video(**file_data["pyrogram_file_obj"])
-            elif file_data["file_type"] == "document":
-                file_obj = Document(**file_data["pyrogram_file_obj"])
-            # Add other types if necessary
-        
-        if file_obj and getattr(file_obj, 'thumbs', None):
-            logger.info(f"User {user_id}: Attempting to download existing thumbnail from file object.")
+        thumbs = (file_data.get("media") or {}).get("thumbs")
+        if thumbs:
+            logger.info(f"User {user_id}: Attempting to download existing thumbnail from media record.")
             try:
                 # Get the largest available thumbnail
-                thumbnail_id = sorted(file_obj.thumbs, key=lambda t: t.file_size or 0, reverse=True)[0].file_id
-                thumbnail_path = await client.download_media(thumbnail_id, file_name=THUMBNAIL_DIR)
+                thumbnail_id = sorted(thumbs, key=lambda t: t.get("file_size") or 0, reverse=True)[0]["file_id"]
+                thumbnail_path = await client.download_media(thumbnail_id, file_name=output_dir)
                 logger.info(f"User {user_id}: Existing thumbnail downloaded: {thumbnail_path}")
                 return thumbnail_path
             except Exception as e:
-                logger.error(f"User {user_id}: Error downloading existing thumbnail from Pyrogram object: {e}", exc_info=True)
+                logger.error(f"User {user_id}: Error downloading existing thumbnail from media record: {e}", exc_info=True)
 
     # 3. Generate thumbnail from video file (requires ffmpeg)
     if file_data["file_type"] == "video" and downloaded_file_path and os.path.exists(downloaded_file_path):
-        output_thumbnail_path = os.path.join(THUMBNAIL_DIR, f"{user_id}_temp_thumb.jpg")
+        output_thumbnail_path = os.path.join(output_dir, f"{user_id}_temp_thumb.jpg")
         logger.info(f"User {user_id}: Attempting to generate thumbnail from video using FFmpeg.")
         try:
             # Command to extract a frame from video using ffmpeg
-            process = await asyncio.create_subprocess_shell(
-                f"ffmpeg -i \"{downloaded_file_path}\" -ss 00:00:01 -vframes 1 \"{output_thumbnail_path}\"",
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
+            returncode, stdout, stderr = await run_command(
+                ["ffmpeg", "-y", "-i", downloaded_file_path, "-ss", "00:00:01", "-vframes", "1", output_thumbnail_path],
+                cancel_token
             )
-            stdout, stderr = await process.communicate()
-            if process.returncode == 0:
+            if returncode == 0:
                 logger.info(f"User {user_id}: FFmpeg thumbnail generated for {downloaded_file_path}")
                 # Resize and save as JPEG to ensure compatibility and small size
                 try:
@@ -78,6 +170,9 @@ async def get_or_generate_thumbnail(client: Client, message: Message, file_data:
                     logger.error(f"User {user_id}: Error processing FFmpeg generated thumbnail: {e}", exc_info=True)
             else:
                 logger.error(f"User {user_id}: FFmpeg failed for {downloaded_file_path}: {stderr.decode()}")
+        except JobCancelled:
+            logger.info(f"User {user_id}: FFmpeg thumbnail generation stopped, job cancelled.")
+            raise
         except FileNotFoundError:
             logger.warning(f"User {user_id}: FFmpeg not found. Cannot generate video thumbnails.")
         except Exception as e: